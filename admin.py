@@ -6,22 +6,55 @@ import os
 from django.contrib.auth.models import User
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
 from user_profile.settings import controller
-from user_profile.models import Website, DisplayImage
+from user_profile.models import Website, DisplayImage, ProfileSearchTerm, SpriteSheet
 from user_profile.forms import UserProfileForm, DisplayImageForm, AdminImageFieldWidget
+from user_profile.passwords import reset_passwords
 
 UserProfile = controller.get_profile_model()
 
+def get_profile(user):
+    """
+    Usage:  profile = get_profile(user)
+    After:  profile is the profile of user, taken from the one loaded by
+            ProfileChangeList if there is one
+            Raises UserProfile.DoesNotExist if the user has no profile
+    """
+    if getattr(user, '_profile_cache', False) is None:
+        raise UserProfile.DoesNotExist
+    return user.get_profile()
+
+def attach_profiles(users):
+    """
+    Usage:  attach_profiles(users)
+    Before: users is a list of users
+    After:  The profiles of users have been loaded in a single query and get_profile(user)
+            returns them without querying again
+    """
+    profiles = {}
+    for profile in UserProfile._default_manager.filter(user__in = [user.id for user in users]):
+        profiles[profile.user_id] = profile
+    for user in users:
+        profile = profiles.get(user.id)
+        if profile is not None:
+            profile.user = user
+        user._profile_cache = profile
+
 def display_user_fullname(user):
     """
     Usage:     user_fullname = display_user_fullname(user)
     Post:      user_fullname is the fullname of the user
     """
     try:
-        profile = user.get_profile()
+        profile = get_profile(user)
     except UserProfile.DoesNotExist:
         return u"%s %s" % (user.first_name, user.last_name)
     else:
@@ -35,7 +68,7 @@ def display_profile_attribute(attribute, short_description):
     """
     def display_attribute(user):
         try:
-            profile = user.get_profile()
+            profile = get_profile(user)
         except UserProfile.DoesNotExist:
             return "-"
         else:
@@ -49,7 +82,7 @@ def display_gender(user):
     After:  gender is an <img /> tag that humanly displays the gender of user
     """
     try:
-        profile = user.get_profile()
+        profile = get_profile(user)
     except UserProfile.DoesNotExist:
         return ""
     else:
@@ -59,6 +92,24 @@ def display_gender(user):
 display_gender.allow_tags = True
 display_gender.short_description = _(u"Kyn")
 
+def reset_selected_passwords(modeladmin, request, queryset):
+    """
+    Usage:  Admin action
+    After:  If the admin has confirmed it, the selected users have new passwords which have been
+            queued to be sent to them and the response lists who every password was sent to,
+            else the response asks the admin to confirm it, like delete_selected does
+    """
+    if not request.POST.get('post'):
+        return render_to_response('user_profile/admin/reset_passwords_confirmation.html',
+                                    {'queryset': queryset, 'opts': modeladmin.model._meta,
+                                        'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME },
+                                    context_instance = RequestContext(request))
+    result = reset_passwords(queryset)
+    return render_to_response('user_profile/admin/reset_passwords.html',
+                                {'result': result, 'opts': modeladmin.model._meta },
+                                context_instance = RequestContext(request))
+reset_selected_passwords.short_description = _(u"Frumstilla lykilorð valinna notenda")
+
 class UserProfileInline(admin.StackedInline):
     model = UserProfile
     extra = 1
@@ -74,6 +125,33 @@ class DisplayImageInline(admin.StackedInline):
     form = DisplayImageForm
 
 
+class ProfileChangeList(ChangeList):
+    """
+    Loads the profiles of all the users on a page in one query so the
+    profile columns of list_display do not query once per row
+
+    Searches go through the profile search index as well as search_fields, so users can
+    also be found by their kennitala, phone numbers and city
+    """
+    def get_query_set(self):
+        query = self.query
+        self.query = ''
+        try:
+            query_set = super(ProfileChangeList, self).get_query_set()
+        finally:
+            self.query = query
+        if query:
+            searched = super(ProfileChangeList, self).get_query_set()
+            query_set = query_set.filter(Q(id__in = ProfileSearchTerm.objects.search(query)) |
+                                            Q(id__in = searched.values('id')))
+        return query_set
+
+    def get_results(self, request):
+        super(ProfileChangeList, self).get_results(request)
+        self.result_list = list(self.result_list)
+        attach_profiles(self.result_list)
+
+
 class UserWithProfileAdmin(UserAdmin):
     """
     This will be unfinished until Django allows for inlines to be mixed in
@@ -103,7 +181,12 @@ class UserWithProfileAdmin(UserAdmin):
     ordering = ('username', )
 
     search_fields = ['username', 'email','first_name','last_name',]
+    actions = [reset_selected_passwords]
+
+    def get_changelist(self, request, **kwargs):
+        return ProfileChangeList
 
 
 admin.site.register(DisplayImage)
 admin.site.register(Website)
+admin.site.register(SpriteSheet)
@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Micro-benchmarks of the hot paths of user_profile
+
+    DJANGO_SETTINGS_MODULE=settings python -m user_profile.benchmarks.hot_paths
+        [--population 10000] [--profiles 200] [--repeat 5] [--only dates,names]
+        [--output results.jsonl] [--compare baseline.jsonl]
+
+A test database is created for the run and display images are written to a
+temporary MEDIA_ROOT. One JSON object is printed for every benchmark:
+
+    {"benchmark": "dates.calculate_age", "number": 10000, "repeat": 5,
+     "min_ms": 41.2, "median_ms": 42.0, "per_call_us": 4.12, "queries": 0.0}
+
+min_ms and median_ms are for a round of number calls and queries is the number
+of database queries per call. With --compare the records also get the median of
+the same benchmark in an earlier output and the ratio between the two.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from datetime import date, timedelta
+from optparse import OptionParser
+from StringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.conf import settings
+from django.core import signals
+from django.db import connection, reset_queries
+
+AREAS = ('dates', 'names', 'images', 'views')
+
+PHOTO_SIZES = (((3264, 2448), 'JPEG'), ((1200, 1600), 'PNG'))
+
+def measure(name, function, number = 1, repeat = 5, setup = None):
+    """
+    Usage:  record = measure(name, function, [number = 1, repeat = 5, setup = None])
+    Before: setup, if given, is called before every round and its result is passed to function
+    After:  function has been called number times in each of repeat rounds
+            record describes the rounds as in the module documentation
+            Queries are counted with DEBUG on, whatever the settings say
+    """
+    times = []
+    queries = 0
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    #The test client starts a request on every call, which would reset the queries
+    signals.request_started.disconnect(reset_queries)
+    try:
+        for i in range(repeat):
+            argument = None
+            if setup is not None:
+                argument = setup()
+            reset_queries()
+            start = time.time()
+            for j in xrange(number):
+                function(argument)
+            times.append(time.time() - start)
+            queries = len(connection.queries)
+    finally:
+        signals.request_started.connect(reset_queries)
+        settings.DEBUG = debug
+    times.sort()
+    return {'benchmark': name, 'number': number, 'repeat': repeat,
+            'min_ms': round(times[0] * 1000, 3),
+            'median_ms': round(times[len(times) // 2] * 1000, 3),
+            'per_call_us': round(times[0] * 1000000 / number, 3),
+            'queries': float(queries) / number }
+
+KENNITALA_WEIGHTS = (3, 2, 7, 6, 5, 4, 3, 2)
+
+def random_kennitala(rng):
+    """
+    Usage:  kennitala = random_kennitala(rng)
+    After:  kennitala is a valid kennitala of someone born between 1920 and 2010
+    """
+    bdate = date(1920, 1, 1) + timedelta(days = rng.randint(0, 33000))
+    if bdate.year < 2000:
+        century = 9
+    else:
+        century = 0
+    while True:
+        digits = "%02d%02d%02d%02d" % (bdate.day, bdate.month, bdate.year % 100, rng.randint(20, 99))
+        check = 11 - sum([int(digit) * weight for digit, weight in zip(digits, KENNITALA_WEIGHTS)]) % 11
+        if check == 11:
+            check = 0
+        if check != 10:
+            return "%s%d%d" % (digits, check, century)
+
+def make_profiles(population, rng):
+    """
+    Usage:  profiles = make_profiles(population, rng)
+    After:  profiles are population new unsaved profiles of unsaved users with names,
+            a kennitala and a postal code
+    """
+    from django.contrib.auth.models import User
+    from user_profile.settings import controller
+    from user_profile.postalcodes import CHOICES
+
+    ProfileModel = controller.get_profile_model()
+    profiles = []
+    for i in xrange(population):
+        user = User(username = u"notandi%d" % i, first_name = u"Jón", last_name = u"Þórsson")
+        profile = ProfileModel(user = user, kennitala = random_kennitala(rng),
+                                middlenames = u"Páll Sigurður", postalcode = rng.choice(CHOICES)[0])
+        profile.set_birthdate()
+        profiles.append(profile)
+    return profiles
+
+def bench_dates(options, rng):
+    from user_profile.models import calculate_age
+    today = date.today()
+    population = options.population
+    bdates = [profile.birthdate for profile in make_profiles(population, rng)]
+
+    def calculate_ages(argument):
+        for bdate in bdates:
+            calculate_age(bdate, today)
+    yield measure('dates.calculate_age', calculate_ages, repeat = options.repeat), population
+
+    def get_bdates(profiles):
+        for profile in profiles:
+            profile.get_bdate()
+    yield measure('dates.get_bdate', get_bdates, repeat = options.repeat,
+                    setup = lambda: make_profiles(population, rng)), population
+
+    def get_closest_bday_infos(profiles):
+        for profile in profiles:
+            profile.get_closest_bday_info(today)
+    yield measure('dates.get_closest_bday_info', get_closest_bday_infos, repeat = options.repeat,
+                    setup = lambda: make_profiles(population, rng)), population
+
+    try:
+        from user_profile import bulk_dates
+    except ImportError:
+        return
+    yield measure('dates.bulk_calculate_ages', lambda argument: bulk_dates.calculate_ages(bdates, today),
+                    repeat = options.repeat), population
+    yield measure('dates.bulk_closest_bday_infos', lambda argument: bulk_dates.closest_bday_infos(bdates, today),
+                    repeat = options.repeat), population
+
+def bench_names(options, rng):
+    population = options.population
+
+    def get_short_fullnames(profiles):
+        for profile in profiles:
+            profile.get_short_fullname()
+    yield measure('names.get_short_fullname', get_short_fullnames, repeat = options.repeat,
+                    setup = lambda: make_profiles(population, rng)), population
+
+    def get_postalcodes_and_cities(profiles):
+        for profile in profiles:
+            profile.postalcode_and_city
+    yield measure('names.postalcode_and_city', get_postalcodes_and_cities, repeat = options.repeat,
+                    setup = lambda: make_profiles(population, rng)), population
+
+def make_upload(size, format, seed):
+    from PIL import Image
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    #Noise compresses about as badly as a photo, the seed makes every upload different
+    noise = Image.effect_noise(size, 40 + seed)
+    image = Image.merge('RGB', (noise, noise.rotate(180), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    data = StringIO()
+    image.save(data, format)
+    return SimpleUploadedFile("mynd.%s" % format.lower(), data.getvalue())
+
+def bench_images(options, rng):
+    from django.contrib.auth.models import User
+    from user_profile import models, thumbnails
+
+    user = User.objects.create(username = u"myndasmidur")
+    executor = models.THUMBNAIL_EXECUTOR
+    models.THUMBNAIL_EXECUTOR = thumbnails.SynchronousExecutor()
+    try:
+        for size, format in PHOTO_SIZES:
+            uploads = iter([make_upload(size, format, seed) for seed in range(options.repeat)])
+            #Every round saves different contents, so no sizes are reused from an earlier round
+            def save(upload):
+                models.DisplayImage(user = user, display_image = upload).save()
+            name = 'images.display_image_save.%dx%d_%s' % (size[0], size[1], format.lower())
+            yield measure(name, save, repeat = options.repeat, setup = lambda: uploads.next()), 1
+    finally:
+        models.THUMBNAIL_EXECUTOR = executor
+
+def bench_views(options, rng):
+    from django.contrib.auth.models import User
+    from django.test.client import Client
+    from user_profile.bulk_import import import_profiles
+    from user_profile.page_cache import invalidate_profiles
+
+    rows = ["username,first_name,last_name,email,kennitala,postalcode"]
+    for i in range(options.profiles):
+        rows.append("notandi%d,Jón,Þórsson,notandi%d@example.com,%s,101" % (i, i, random_kennitala(rng)))
+    result = import_profiles(StringIO("\n".join(rows) + "\n"))
+    if result.errors:
+        raise ValueError("Could not import the benchmark profiles: %r" % result.errors[:3])
+    User.objects.create_superuser('stjori', 'stjori@example.com', 'stjori')
+
+    client = Client()
+    url = '/notendur/notandi0/'
+    yield measure('views.show_profile.cold', lambda argument: client.get(url), repeat = options.repeat,
+                    setup = lambda: invalidate_profiles([u'notandi0'])), 1
+    client.get(url)
+    yield measure('views.show_profile.cached', lambda argument: client.get(url), repeat = options.repeat), 1
+
+    client.login(username = 'stjori', password = 'stjori')
+    yield measure('views.admin_user_changelist', lambda argument: client.get('/admin/auth/user/'),
+                    repeat = options.repeat), 1
+    yield measure('views.admin_user_changelist.search',
+                    lambda argument: client.get('/admin/auth/user/', {'q': u'jón'.encode("utf8")}),
+                    repeat = options.repeat), 1
+
+BENCHMARKS = {'dates': bench_dates,
+                'names': bench_names,
+                'images': bench_images,
+                'views': bench_views }
+
+def read_baseline(path):
+    baseline = {}
+    for line in open(path):
+        if line.strip():
+            record = json.loads(line)
+            baseline[record['benchmark']] = record
+    return baseline
+
+def run(options):
+    """
+    Usage:  for record in run(options): ...
+    After:  Yields a record for every benchmark of the areas in options.only
+    """
+    rng = random.Random(options.seed)
+    for area in options.only:
+        for record, number in BENCHMARKS[area](options, rng):
+            #The benchmarks loop over the population themselves, report per profile
+            if number > 1:
+                record['number'] = number
+                record['per_call_us'] = round(record['min_ms'] * 1000 / number, 3)
+            yield record
+
+def main():
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option('--population', dest = 'population', type = 'int', default = 10000,
+                        help = 'Number of synthetic profiles for the date and name benchmarks')
+    parser.add_option('--profiles', dest = 'profiles', type = 'int', default = 200,
+                        help = 'Number of profiles in the database for the view benchmarks')
+    parser.add_option('--repeat', dest = 'repeat', type = 'int', default = 5,
+                        help = 'Number of rounds of every benchmark')
+    parser.add_option('--seed', dest = 'seed', type = 'int', default = 0)
+    parser.add_option('--only', dest = 'only', default = ",".join(AREAS),
+                        help = 'Comma separated areas to run, of %s' % ", ".join(AREAS))
+    parser.add_option('--output', dest = 'output', default = None,
+                        help = 'File to write the results to as well')
+    parser.add_option('--compare', dest = 'compare', default = None,
+                        help = 'Output of an earlier run to compare the medians with')
+    options, args = parser.parse_args()
+    options.only = [area.strip() for area in options.only.split(",") if area.strip()]
+    for area in options.only:
+        if area not in BENCHMARKS:
+            parser.error("Unknown area %s" % area)
+    baseline = {}
+    if options.compare is not None:
+        baseline = read_baseline(options.compare)
+
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    media_root = tempfile.mkdtemp()
+    settings.MEDIA_ROOT = media_root
+    settings.DEBUG = True
+    settings.ROOT_URLCONF = 'user_profile.benchmarks.urls'
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity = 0)
+    output = None
+    if options.output is not None:
+        output = open(options.output, "w")
+    try:
+        for record in run(options):
+            if record['benchmark'] in baseline:
+                before = baseline[record['benchmark']]['median_ms']
+                record['baseline_median_ms'] = before
+                record['ratio'] = round(record['median_ms'] / max(before, 0.001), 3)
+            line = json.dumps(record, sort_keys = True)
+            print line
+            sys.stdout.flush()
+            if output is not None:
+                output.write(line + "\n")
+    finally:
+        if output is not None:
+            output.close()
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors = True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Measures how long importing modules of user_profile takes in a fresh interpreter
+
+    DJANGO_SETTINGS_MODULE=settings python import_time.py [--repeat 10] [module ...]
+
+Django itself is imported before the clock starts, so only the cost of the module
+and what it pulls in is measured. One JSON object is printed for every module
+with the fastest and the median time in milliseconds and the optional
+dependencies, such as PIL and emailer, that the import loaded.
+"""
+
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+MODULES = ('user_profile.models', 'user_profile.utils', 'user_profile.thumbnails', 'user_profile.admin')
+
+OPTIONAL = ('PIL.Image', 'emailer.forms')
+
+CHILD = """
+import sys, time, json
+from django.db import models
+start = time.time()
+__import__(%(module)r)
+seconds = time.time() - start
+print json.dumps({'seconds': seconds, 'loaded': [name for name in %(optional)r if name in sys.modules]})
+"""
+
+def time_import(module, python = sys.executable):
+    """
+    Usage:  (seconds, loaded) = time_import(module, [python = sys.executable])
+    After:  seconds is how long importing module took in a new python process and
+            loaded are the names in OPTIONAL that the import loaded
+    """
+    output = subprocess.Popen([python, "-c", CHILD % {'module': module, 'optional': OPTIONAL}],
+                                stdout = subprocess.PIPE, env = os.environ).communicate()[0]
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], result['loaded']
+
+def benchmark(module, repeat):
+    """
+    Usage:  record = benchmark(module, repeat)
+    After:  record describes repeat imports of module, see the module documentation
+    """
+    times = []
+    loaded = []
+    for i in range(repeat):
+        seconds, loaded = time_import(module)
+        times.append(seconds * 1000)
+    times.sort()
+    return {'benchmark': 'import', 'name': module, 'repeat': repeat,
+            'min_ms': round(times[0], 2), 'median_ms': round(times[len(times) // 2], 2),
+            'loaded': loaded }
+
+def main():
+    parser = OptionParser(usage = "%prog [--repeat N] [module ...]")
+    parser.add_option('--repeat', dest = 'repeat', type = 'int', default = 10,
+                        help = 'Number of fresh interpreters to time every import in')
+    options, modules = parser.parse_args()
+    if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        parser.error("DJANGO_SETTINGS_MODULE must be set")
+    for module in modules or MODULES:
+        print json.dumps(benchmark(module, options.repeat))
+
+if __name__ == '__main__':
+    main()
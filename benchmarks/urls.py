@@ -0,0 +1,22 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+The urls the benchmarks request, used as ROOT_URLCONF while they run
+"""
+
+from django.conf.urls.defaults import *
+from django.contrib import admin
+from django.contrib.auth.models import User
+
+from user_profile.settings import controller
+from user_profile.admin import UserWithProfileAdmin
+from user_profile.forms import UserProfileForm
+
+if not isinstance(admin.site._registry.get(User), UserWithProfileAdmin):
+    controller.register(UserWithProfileAdmin, UserProfileForm)
+
+urlpatterns = patterns('',
+    url(r'^$', 'django.views.generic.simple.redirect_to', {'url': '/notendur/'}, name = 'index'),
+    (r'^admin/', include(admin.site.urls)),
+    (r'^notendur/', include('user_profile.urls')),
+)
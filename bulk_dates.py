@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Array versions of calculate_age, get_closest_bday and get_closest_bday_info from
+user_profile.models, for computing ages and birthdays of many profiles at once.
+
+They give the same answers as the functions working on one date at a time,
+including the fix_leap and month borrowing behaviour.
+"""
+
+import numpy
+
+def to_days(dates):
+    """
+    Usage:  days = to_days(dates)
+    Before: dates is a sequence of date objects or a datetime64 array
+    After:  days is a datetime64[D] array of the same dates
+    """
+    return numpy.asarray(dates, dtype = 'datetime64[D]')
+
+def split_dates(days):
+    """
+    Usage:  (years, months, days_of_month) = split_dates(days)
+    Before: days is a datetime64[D] array
+    After:  years, months and days_of_month are integer arrays of the parts of days
+    """
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(int) + 1970
+    month_numbers = months.astype(int) % 12 + 1
+    days_of_month = (days - months).astype(int) + 1
+    return years, month_numbers, days_of_month
+
+def join_dates(years, months, days_of_month):
+    """
+    Usage:  days = join_dates(years, months, days_of_month)
+    After:  days is the datetime64[D] array of the dates with those parts
+    """
+    month_starts = ((years - 1970) * 12 + (months - 1)).astype('datetime64[M]')
+    return month_starts.astype('datetime64[D]') + (days_of_month - 1)
+
+def days_previous_month(years, months):
+    """
+    Usage:  days = days_previous_month(years, months)
+    Before: 1 <= months <= 12
+    After:  days is the number of days in the month before each month
+    """
+    month_starts = ((years - 1970) * 12 + (months - 1)).astype('datetime64[M]')
+    return (month_starts.astype('datetime64[D]') - (month_starts - 1).astype('datetime64[D]')).astype(int)
+
+def fix_leap(years, months, days_of_month):
+    """
+    Usage:  days_of_month = fix_leap(years, months, days_of_month)
+    After:  29 February has been replaced by 28 February
+    """
+    return numpy.where((months == 2) & (days_of_month == 29), 28, days_of_month)
+
+def calculate_ages(dates_of_birth, today):
+    """
+    Usage:  (years, months, days) = calculate_ages(dates_of_birth, today)
+    Before: dates_of_birth is a sequence of dates, today is a date or a sequence of dates
+            of the same length, every date of birth is less than today
+    After:  years, months and days are integer arrays such that
+            (years[i], months[i], days[i]) == calculate_age(dates_of_birth[i], today[i])
+    """
+    birth = to_days(dates_of_birth)
+    today = to_days(today) + numpy.zeros(birth.shape, dtype = int)
+    b_year, b_month, b_day = split_dates(birth)
+    b_day = fix_leap(b_year, b_month, b_day)
+    t_year, t_month, t_day = split_dates(today)
+
+    y = t_year - b_year
+    m = t_month - b_month
+    d = t_day - b_day
+
+    borrow_year = m < 0
+    y = numpy.where(borrow_year, y - 1, y)
+    m = numpy.where(borrow_year, m + 12, m)
+
+    borrow_month = d < 0
+    m = numpy.where(borrow_month, m - 1, m)
+    d = numpy.where(borrow_month,
+                    numpy.maximum(0, days_previous_month(t_year, t_month) - b_day) + t_day,
+                    d)
+
+    borrow_year = m < 0
+    y = numpy.where(borrow_year, y - 1, y)
+    m = numpy.where(borrow_year, m + 12, m)
+    return y, m, d
+
+def closest_bdays(dates_of_birth, today):
+    """
+    Usage:  closest = closest_bdays(dates_of_birth, today)
+    Before: dates_of_birth is a sequence of dates, today is a date
+    After:  closest is a datetime64[D] array where closest[i] is the birthday of
+            dates_of_birth[i] last year, this year or next year closest to today,
+            the later one if two are equally close, as with get_closest_bday
+    """
+    birth = to_days(dates_of_birth)
+    today = to_days(today)
+    b_year, b_month, b_day = split_dates(birth)
+    b_day = fix_leap(b_year, b_month, b_day)
+    t_year, t_month, t_day = split_dates(today)
+
+    candidates = numpy.array([join_dates(t_year + offset + 0 * b_year, b_month, b_day)
+                                for offset in (1, 0, -1)])
+    distances = numpy.abs((candidates - today).astype(int))
+    return candidates[numpy.argmin(distances, axis = 0), numpy.arange(len(birth))]
+
+def closest_bday_infos(dates_of_birth, today):
+    """
+    Usage:  (on_bday, past, months, days) = closest_bday_infos(dates_of_birth, today)
+    Before: dates_of_birth is a sequence of dates, today is a date
+    After:  on_bday[i] is True if today is the birthday of dates_of_birth[i], then
+            months[i] == days[i] == 0
+            else past[i] is True if the closest birthday has passed and
+            (months[i], days[i]) is the time between it and today, as with get_closest_bday_info
+    """
+    today = to_days(today)
+    closest = closest_bdays(dates_of_birth, today)
+    today = today + numpy.zeros(closest.shape, dtype = int)
+
+    on_bday = closest == today
+    future = today < closest
+    earlier = numpy.where(future, today, closest)
+    later = numpy.where(future, closest, today)
+    years, months, days = calculate_ages(earlier, later)
+
+    months = numpy.where(on_bday, 0, months)
+    days = numpy.where(on_bday, 0, days)
+    return on_bday, ~future & ~on_bday, months, days
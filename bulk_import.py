@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Bulk import of users and their profiles
+
+Rows are read one at a time from CSV or JSON lines, validated with
+ProfileImportForm and written in batches with one INSERT statement per table and
+batch, bypassing Model.save and therefore the save_user post_save handler.
+"""
+
+import csv
+from datetime import datetime
+from urlparse import urlparse
+
+from django.db import transaction
+from django.contrib.auth.models import User
+from django.utils import simplejson
+
+from user_profile.settings import controller
+from user_profile.dbutils import bulk_insert
+from user_profile.models import Website, ProfileSearchTerm
+from user_profile.forms import ProfileImportForm
+
+IMPORT_BATCH_SIZE = 500
+
+PROFILE_FIELDS = ('kennitala', 'middlenames', 'gender', 'address', 'postalcode', 'phone', 'gsm')
+
+class ImportResult(object):
+    """
+    Data invariant:
+        created is the number of users created
+        errors is a list of (line, errors) pairs for the rows that were not imported,
+            where errors maps field names to lists of messages
+    """
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+
+
+def read_csv(stream):
+    """
+    Usage:  for line, row in read_csv(stream): ...
+    Before: stream is a UTF-8 encoded CSV file with a header naming the fields
+    After:  Yields every row as a dictionary of unicode strings
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, dict((key, (value or "").decode("utf8")) for key, value in row.iteritems())
+
+def read_json_lines(stream):
+    """
+    Usage:  for line, row in read_json_lines(stream): ...
+    Before: stream contains a JSON object on every line, as written by the export
+    After:  Yields every object, with a list of home pages joined by spaces
+    """
+    for line, text in enumerate(stream):
+        if not text.strip():
+            continue
+        row = simplejson.loads(text)
+        if isinstance(row.get('homepages'), list):
+            row['homepages'] = u" ".join(row['homepages'])
+        yield line + 1, row
+
+READERS = {'csv': read_csv,
+            'json': read_json_lines }
+
+def import_profiles(stream, format = 'csv', batch_size = IMPORT_BATCH_SIZE):
+    """
+    Usage:  result = import_profiles(stream, [format = 'csv', batch_size = IMPORT_BATCH_SIZE])
+    Before: stream is a file in format, a key of READERS
+    After:  A user, a profile and home pages have been created for every valid row
+            whose username was not taken, all in one transaction
+            result is an ImportResult describing what happened
+    """
+    result = ImportResult()
+    import_batches(READERS[format](stream), batch_size, result)
+    return result
+
+def import_batches(rows, batch_size, result):
+    batch = []
+    seen = set()
+    for line, row in rows:
+        form = ProfileImportForm(row)
+        if not form.is_valid():
+            result.errors.append((line, form.errors))
+            continue
+        username = form.cleaned_data['username']
+        if username in seen:
+            result.errors.append((line, {'username': [u"Notandanafnið kemur oftar en einu sinni fyrir"]}))
+            continue
+        seen.add(username)
+        batch.append((line, form.cleaned_data))
+        if len(batch) == batch_size:
+            import_batch(batch, result)
+            batch = []
+    import_batch(batch, result)
+import_batches = transaction.commit_on_success()(import_batches)
+
+def import_batch(batch, result):
+    """
+    Usage:  import_batch(batch, result)
+    Before: batch is a list of (line, cleaned_data) pairs from ProfileImportForm
+    After:  The users, profiles, home pages and search terms of the rows of batch have
+            been inserted using one INSERT per table, rows whose usernames exist already
+            have been added to result.errors
+    """
+    if not batch:
+        return
+    ProfileModel = controller.get_profile_model()
+    taken = set(User.objects.filter(username__in = [data['username'] for line, data in batch])
+                    .values_list('username', flat = True))
+    rows = []
+    for line, data in batch:
+        if data['username'] in taken:
+            result.errors.append((line, {'username': [u"Notandanafnið er þegar til"]}))
+        else:
+            rows.append(data)
+    if not rows:
+        return
+
+    now = datetime.now()
+    users = []
+    for data in rows:
+        user = User(username = data['username'], first_name = data['first_name'],
+                    last_name = data['last_name'], email = data['email'],
+                    date_joined = now, last_login = now)
+        user.set_unusable_password()
+        users.append(user)
+    bulk_insert(User, users)
+    user_ids = dict(User.objects.filter(username__in = [data['username'] for data in rows])
+                        .values_list('username', 'id'))
+
+    profiles = []
+    for user, data in zip(users, rows):
+        user.id = user_ids[data['username']]
+        profile = ProfileModel(user_id = user.id)
+        for field in PROFILE_FIELDS:
+            setattr(profile, field, data[field])
+        profile.set_birthdate()
+        profiles.append(profile)
+    bulk_insert(ProfileModel, profiles)
+
+    insert_homepages(ProfileModel, rows, user_ids)
+    ProfileSearchTerm.objects.index(zip(users, profiles))
+    result.created += len(rows)
+
+def insert_homepages(ProfileModel, rows, user_ids):
+    """
+    Usage:  insert_homepages(ProfileModel, rows, user_ids)
+    After:  The home pages of rows exist and are linked to the profiles of their users
+    """
+    urls = set()
+    for data in rows:
+        urls.update(data['homepages'])
+    if not urls:
+        return
+
+    website_ids = dict(Website.objects.filter(url__in = list(urls)).values_list('url', 'id'))
+    bulk_insert(Website, [Website(url = url, name = urlparse(url)[1][:30])
+                            for url in urls if url not in website_ids])
+    website_ids = dict(Website.objects.filter(url__in = list(urls)).values_list('url', 'id'))
+
+    profile_ids = dict(ProfileModel.objects.filter(user__in = user_ids.values()).values_list('user', 'id'))
+    field = ProfileModel._meta.get_field('homepages')
+    through = field.rel.through
+    source_name = field.m2m_field_name()
+    target_name = field.m2m_reverse_field_name()
+    links = []
+    for data in rows:
+        profile_id = profile_ids[user_ids[data['username']]]
+        for url in set(data['homepages']):
+            links.append(through(**{'%s_id' % source_name: profile_id,
+                                    '%s_id' % target_name: website_ids[url]}))
+    bulk_insert(through, links)
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import threading
+
+from django.db import connection, models, transaction
+
+_hooks = threading.local()
+
+def bulk_insert(model, instances):
+    """
+    Usage:  bulk_insert(model, instances)
+    Before: instances are unsaved instances of model
+    After:  instances have been inserted with a single executemany call, without
+            sending any signals. Their ids are not set.
+            The insert has been committed, or the transaction marked dirty so it is
+            committed with the rest of it, as Model.save does
+    """
+    if not instances:
+        return
+    fields = [field for field in model._meta.local_fields if not isinstance(field, models.AutoField)]
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(model._meta.db_table),
+                                                ", ".join([qn(field.column) for field in fields]),
+                                                ", ".join(["%s"] * len(fields)))
+    rows = []
+    for instance in instances:
+        rows.append([field.get_db_prep_save(field.pre_save(instance, True), connection = connection)
+                        for field in fields])
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+def bulk_update(model, field_names, instances):
+    """
+    Usage:  bulk_update(model, field_names, instances)
+    Before: instances are saved instances of model, field_names are names of fields of model
+    After:  The fields field_names of instances have been written with a single
+            executemany call, without sending any signals
+            The update has been committed as in bulk_insert
+    """
+    if not instances:
+        return
+    fields = [model._meta.get_field(name) for name in field_names]
+    pk = model._meta.pk
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (qn(model._meta.db_table),
+                                                ", ".join(["%s = %%s" % qn(field.column) for field in fields]),
+                                                qn(pk.column))
+    rows = []
+    for instance in instances:
+        rows.append([field.get_db_prep_save(field.pre_save(instance, False), connection = connection)
+                        for field in fields] + [pk.get_db_prep_save(instance.pk, connection = connection)])
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+def on_commit(function):
+    """
+    Usage:  on_commit(function)
+    After:  function has been called if no transaction is being managed, else it has been
+            put aside to be called by CommitHooksMiddleware once the request has committed
+            If CommitHooksMiddleware is not installed function is called at once
+    """
+    functions = getattr(_hooks, 'functions', None)
+    if functions is None or not transaction.is_managed():
+        function()
+    else:
+        functions.append(function)
+
+class CommitHooksMiddleware(object):
+    """
+    Calls the functions given to on_commit during a request after the view has returned
+    Must come before TransactionMiddleware in MIDDLEWARE_CLASSES if that is used,
+    so it gets the response after the transaction has been committed
+    """
+    def process_request(self, request):
+        _hooks.functions = []
+
+    def process_exception(self, request, exception):
+        _hooks.functions = None
+
+    def process_response(self, request, response):
+        functions = getattr(_hooks, 'functions', None)
+        _hooks.functions = None
+        for function in functions or []:
+            function()
+        return response
@@ -0,0 +1,30 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Emails sent through the emailer app
+
+Kept apart from utils so that only the code sending these emails imports emailer.
+"""
+
+from django.contrib.auth.models import User
+
+from emailer.forms import ObjectToSendWrapper
+
+class ResetPasswordWrapper(ObjectToSendWrapper):
+
+    def get_email_subject(self):
+        return u"Nýtt lykilorð - New password"
+
+    def get_email_template(self):
+        return u"user_profile/emails/reset_password.txt"
+
+    def get_email_context(self):
+        return {'user': self.instance, 'new_password': self.new_password }
+
+    def get_email_recipients(self):
+        return [self.instance.email,]
+
+    def process_pre_email(self):
+        self.new_password = User.objects.make_random_password()
+        self.instance.set_password(self.new_password)
+        self.instance.save()
@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Streaming export of the profile directory as CSV, JSON lines or vCards
+
+Profiles are read in chunks of ids and every record is written as soon as it
+has been built, so memory use does not grow with the number of users.
+"""
+
+import csv
+from StringIO import StringIO
+
+from django.utils import simplejson
+
+from user_profile.settings import controller
+from user_profile.models import DISPLAY_IMAGE_SIZE, NoKennitala
+
+EXPORT_CHUNK_SIZE = 500
+
+FIELDS = ('username', 'first_name', 'middlenames', 'last_name', 'fullname', 'kennitala', 'birthdate',
+            'email', 'address', 'postalcode', 'city', 'phone', 'gsm', 'homepages') + \
+            tuple(sorted(DISPLAY_IMAGE_SIZE.keys()))
+
+def iter_profiles(queryset = None, chunk_size = EXPORT_CHUNK_SIZE):
+    """
+    Usage:  for profile in iter_profiles([queryset = None, chunk_size = EXPORT_CHUNK_SIZE]): ...
+    Before: queryset is a QuerySet of profiles, defaults to all profiles
+    After:  Yields every profile in queryset ordered by id, with the user, home pages and
+            a display image loaded, reading chunk_size profiles at a time
+    """
+    if queryset is None:
+        queryset = controller.get_profile_model().objects.for_directory()
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt = last_id).order_by('id')[:chunk_size])
+        if not chunk:
+            return
+        for profile in chunk:
+            yield profile
+        last_id = chunk[-1].id
+
+def profile_record(profile):
+    """
+    Usage:  record = profile_record(profile)
+    After:  record is a dictionary with the keys in FIELDS describing profile
+    """
+    display_image = profile.display_image()
+    try:
+        birthdate = profile.get_bdate().isoformat()
+    except (NoKennitala, ValueError):
+        birthdate = u''
+    record = {'username': profile.user.username,
+                'first_name': profile.user.first_name,
+                'middlenames': profile.middlenames,
+                'last_name': profile.user.last_name,
+                'fullname': profile.get_fullname(),
+                'kennitala': profile.get_kennitala(),
+                'birthdate': birthdate,
+                'email': profile.user.email,
+                'address': profile.address,
+                'postalcode': profile.postalcode,
+                'city': profile.city,
+                'phone': profile.phone,
+                'gsm': profile.gsm,
+                'homepages': [website.url for website in profile.get_homepages()]}
+    for size in DISPLAY_IMAGE_SIZE:
+        record[size] = getattr(display_image, size).url
+    return record
+
+def csv_lines(records):
+    """
+    Usage:  for line in csv_lines(records): ...
+    After:  Yields a UTF-8 encoded CSV header and then one line for every record
+            Home pages are separated by spaces
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    yield buffer.getvalue()
+    for record in records:
+        buffer.seek(0)
+        buffer.truncate()
+        row = []
+        for field in FIELDS:
+            value = record[field]
+            if field == 'homepages':
+                value = u" ".join(value)
+            row.append(value.encode("utf8"))
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+def json_lines(records):
+    """
+    Usage:  for line in json_lines(records): ...
+    After:  Yields every record as a JSON object on a line of its own
+    """
+    for record in records:
+        yield "%s\n" % simplejson.dumps(record)
+
+def escape_vcard(value):
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;").replace("\n", "\\n")
+
+def vcard_lines(records):
+    """
+    Usage:  for lines in vcard_lines(records): ...
+    After:  Yields every record as a UTF-8 encoded vCard 3.0
+    """
+    for record in records:
+        e = dict((field, escape_vcard(record[field])) for field in FIELDS if field != 'homepages')
+        lines = [u"BEGIN:VCARD",
+                    u"VERSION:3.0",
+                    u"N:%s;%s;%s;;" % (e['last_name'], e['first_name'], e['middlenames']),
+                    u"FN:%s" % e['fullname'],
+                    u"NICKNAME:%s" % e['username']]
+        if record['email']:
+            lines.append(u"EMAIL;TYPE=INTERNET:%s" % e['email'])
+        if record['phone']:
+            lines.append(u"TEL;TYPE=HOME:%s" % e['phone'])
+        if record['gsm']:
+            lines.append(u"TEL;TYPE=CELL:%s" % e['gsm'])
+        if record['address']:
+            lines.append(u"ADR;TYPE=HOME:;;%s;%s;;%s;Ísland" % (e['address'], e['city'], e['postalcode']))
+        if record['birthdate']:
+            lines.append(u"BDAY:%s" % e['birthdate'])
+        for url in record['homepages']:
+            lines.append(u"URL:%s" % escape_vcard(url))
+        if 'large' in record:
+            lines.append(u"PHOTO;VALUE=URI:%s" % e['large'])
+        lines.append(u"END:VCARD")
+        yield (u"\r\n".join(lines) + u"\r\n").encode("utf8")
+
+FORMATS = {'csv': (csv_lines, 'text/csv; charset=utf-8'),
+            'json': (json_lines, 'application/json; charset=utf-8'),
+            'vcf': (vcard_lines, 'text/x-vcard; charset=utf-8') }
+
+def export_profiles(format, queryset = None, chunk_size = EXPORT_CHUNK_SIZE):
+    """
+    Usage:  for data in export_profiles(format, [queryset = None, chunk_size = EXPORT_CHUNK_SIZE]): ...
+    Before: format is a key of FORMATS
+    After:  Yields the profiles in queryset, defaulting to all profiles, in format
+    """
+    lines, mimetype = FORMATS[format]
+    return lines(profile_record(profile) for profile in iter_profiles(queryset, chunk_size))
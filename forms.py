@@ -2,18 +2,20 @@
 # -*- coding: utf8 -*-
 
 import os
-from PIL import Image
 
 import django.forms as forms
 from django.contrib import admin
-from django.contrib.localflavor.is_.forms import ISIdNumberField, ISPhoneNumberField, ISPostalCodeSelect
+from django.contrib.localflavor.is_.forms import ISIdNumberField, ISPhoneNumberField
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.contrib.admin.widgets import AdminFileWidget
 from django.utils.safestring import mark_safe
+from django.template.loader import render_to_string
 from django.conf import settings
 
-from user_profile.models import UserProfile
-from user_profile.models import DISPLAY_IMAGE_SIZE
+from user_profile.models import UserProfile, DisplayImage
+from user_profile.templatetags.profile_tags import display_image_picture
+from user_profile import postalcodes, thumbnails
+from user_profile.models import DISPLAY_IMAGE_SIZE, DISPLAY_IMAGE_MAX_BYTES, DISPLAY_IMAGE_MAX_PIXELS
 
 WIDTH, HEIGHT = DISPLAY_IMAGE_SIZE['large']
 
@@ -25,15 +27,61 @@ class AdminImageFieldWidget(admin.widgets.AdminFileWidget):
 
     def render(self, name, value, attrs=None):
         img_html = ''
-        if value:
+        display_image = getattr(value, 'instance', None)
+        if value and isinstance(display_image, DisplayImage):
+            img_html = render_to_string('user_profile/display_image_picture.html',
+                                        display_image_picture(display_image, 'small', unicode(value)))
+        elif value:
             head, filename = os.path.split(str(value))
             path = os.path.join(settings.MEDIA_URL, head, "small", filename)
             img_html = '<img src="%s" alt="%s"/>' % (path, value)
         return mark_safe("%s%s" % (img_html, super(AdminImageFieldWidget, self).render(name, value, attrs)))
 
 
+class ImageHeaderField(forms.FileField):
+    """
+    Accepts uploaded images by reading only their headers, unlike forms.ImageField
+    which decodes the whole image. Files over max_bytes or images with more than
+    max_pixels pixels are rejected before anything is decoded.
+    The header is stored as the image_header attribute of the uploaded file.
+    """
+    default_error_messages = {
+        'invalid_image': _(u"Skráin er ekki mynd eða myndin er skemmd"),
+        'too_many_bytes': _(u"Myndin má ekki vera stærri en %(max)d kB"),
+        'too_many_pixels': _(u"Myndin má ekki vera meira en %(max)d megapixlar"),
+    }
+
+    def __init__(self, max_bytes = DISPLAY_IMAGE_MAX_BYTES, max_pixels = DISPLAY_IMAGE_MAX_PIXELS, *args, **kwargs):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        super(ImageHeaderField, self).__init__(*args, **kwargs)
+
+    def to_python(self, data):
+        file = super(ImageHeaderField, self).to_python(data)
+        if file is None:
+            return None
+        if self.max_bytes is not None and file.size > self.max_bytes:
+            raise forms.ValidationError(self.error_messages['too_many_bytes'] % {'max': self.max_bytes / 1024})
+        if hasattr(file, 'temporary_file_path'):
+            source = file.temporary_file_path()
+        else:
+            source = file
+        max_pixels = self.max_pixels or DISPLAY_IMAGE_MAX_PIXELS
+        try:
+            header = thumbnails.read_image_header(source)
+        except Exception, error:
+            if thumbnails.is_decompression_bomb(error):
+                raise forms.ValidationError(self.error_messages['too_many_pixels'] % {'max': max_pixels / 1000000})
+            #PIL raises all sorts of errors for files it does not recognize
+            raise forms.ValidationError(self.error_messages['invalid_image'])
+        if self.max_pixels is not None and header.get_pixels() > self.max_pixels:
+            raise forms.ValidationError(self.error_messages['too_many_pixels'] % {'max': max_pixels / 1000000})
+        file.image_header = header
+        return file
+
+
 class DisplayImageForm(forms.ModelForm):
-    display_image = forms.ImageField(label = _(u"Mynd af nemanda"), 
+    display_image = ImageHeaderField(label = _(u"Mynd af nemanda"), 
                                         help_text = RATIO_TEXT, widget = AdminImageFieldWidget)
       
     def clean_display_image(self):
@@ -42,8 +90,8 @@ class DisplayImageForm(forms.ModelForm):
         except KeyError:
             pass
         else:
-            image = Image.open(file)
-            if WIDTH * image.size[1] !=  HEIGHT * image.size[0]:
+            header = getattr(file, 'image_header', None)
+            if header is not None and WIDTH * header.height != HEIGHT * header.width:
                 raise forms.ValidationError(RATIO_TEXT)
         return file
                 
@@ -52,11 +100,38 @@ class UserProfileForm(forms.ModelForm):
     kennitala = ISIdNumberField(label = 'Kennitala', required = False)
     postalcode = forms.CharField(label = 'Póstnúmer og borg', 
                                     required = False, 
-                                    widget = ISPostalCodeSelect())
+                                    widget = forms.Select(choices = postalcodes.CHOICES))
     phone = ISPhoneNumberField(label = 'Símanúmer', required = False)
     gsm = ISPhoneNumberField(label = 'Farsímanúmer', required = False)
     
     class Meta:
         model = UserProfile
-        
-        
\ No newline at end of file
+
+
+class ProfileImportForm(forms.Form):
+    """
+    Validates one row of a profile import with the same rules as UserProfileForm
+    Home pages are given as urls separated by whitespace
+    """
+    username = forms.RegexField(r'^[\w.@+-]+$', max_length = 30)
+    first_name = forms.CharField(max_length = 30, required = False)
+    last_name = forms.CharField(max_length = 30, required = False)
+    email = forms.EmailField(required = False)
+    middlenames = forms.CharField(max_length = 30, required = False)
+    gender = forms.ChoiceField(choices = (('', ''),) + UserProfile.GENDER_CHOICES, required = False)
+    address = forms.CharField(max_length = 255, required = False)
+    kennitala = UserProfileForm.base_fields['kennitala']
+    postalcode = UserProfileForm.base_fields['postalcode']
+    phone = UserProfileForm.base_fields['phone']
+    gsm = UserProfileForm.base_fields['gsm']
+    homepages = forms.CharField(required = False)
+
+    def clean_postalcode(self):
+        postalcode = self.cleaned_data['postalcode']
+        if postalcode and postalcodes.get_postalcode(postalcode) is None:
+            raise forms.ValidationError(_(u"Óþekkt póstnúmer"))
+        return postalcode
+
+    def clean_homepages(self):
+        url_field = forms.URLField(max_length = 200)
+        return [url_field.clean(url) for url in self.cleaned_data['homepages'].split()]
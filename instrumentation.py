@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Timing and query counts of the hot paths of user_profile
+
+Set PROFILE_INSTRUMENTATION = True to measure the functions decorated with
+instrumented and the template tags passed to instrument_tag. Every measurement,
+a span, is sent with the span_finished signal and passed to the callables named
+in PROFILE_INSTRUMENTATION_COLLECTORS, e.g.
+
+    PROFILE_INSTRUMENTATION_COLLECTORS = ('user_profile.instrumentation.log_span', )
+
+With InstrumentationMiddleware installed the spans of a request are summed up
+in a Server-Timing header, or the header named by PROFILE_INSTRUMENTATION_HEADER.
+
+When PROFILE_INSTRUMENTATION is off, which it is by default, instrumented returns
+the functions unchanged, so there is no cost at all.
+Queries are only counted when DEBUG is on, otherwise the count is None.
+"""
+
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+PROFILE_INSTRUMENTATION = getattr(settings, "PROFILE_INSTRUMENTATION", False)
+PROFILE_INSTRUMENTATION_COLLECTORS = getattr(settings, "PROFILE_INSTRUMENTATION_COLLECTORS", ())
+PROFILE_INSTRUMENTATION_HEADER = getattr(settings, "PROFILE_INSTRUMENTATION_HEADER", "Server-Timing")
+
+span_finished = Signal(providing_args = ['name', 'seconds', 'queries'])
+
+logger = logging.getLogger('user_profile.instrumentation')
+
+_local = threading.local()
+
+def count_queries():
+    if settings.DEBUG:
+        return len(connection.queries)
+    return None
+
+class Span(object):
+    """
+    Data invariant:
+        name names what is being measured
+        started is the time the span started, queries the number of queries run
+            before it started or None if they are not being counted
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queries = count_queries()
+        self.started = time.time()
+
+    def finish(self):
+        """
+        Usage:  span.finish()
+        After:  The time and number of queries since the span started have been sent
+                with span_finished and added to the summary of the current request
+        """
+        seconds = time.time() - self.started
+        queries = count_queries()
+        if queries is not None and self.queries is not None:
+            queries -= self.queries
+        else:
+            queries = None
+        span_finished.send(sender = Span, name = self.name, seconds = seconds, queries = queries)
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((self.name, seconds, queries))
+
+
+def instrumented(name):
+    """
+    Usage:  function = instrumented(name)(function)
+    After:  Every call of function is measured as a span called name,
+            function is unchanged if PROFILE_INSTRUMENTATION is off
+    """
+    def decorator(function):
+        if not PROFILE_INSTRUMENTATION:
+            return function
+
+        def instrumented_function(*args, **kwargs):
+            span = Span(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                span.finish()
+        #The same name and module let the function be pickled for process pools
+        instrumented_function.__name__ = function.__name__
+        instrumented_function.__module__ = function.__module__
+        instrumented_function.__doc__ = function.__doc__
+        return instrumented_function
+    return decorator
+
+def instrument_tag(library, tag_name, name = None):
+    """
+    Usage:  instrument_tag(library, tag_name, [name = None])
+    Before: tag_name has been registered in the template library library
+    After:  Every rendering of the tag, including its template, is measured as a span
+            called name, 'tags.<tag_name>' by default, if PROFILE_INSTRUMENTATION is on
+    """
+    if not PROFILE_INSTRUMENTATION:
+        return
+    if name is None:
+        name = "tags.%s" % tag_name
+    compile_function = library.tags[tag_name]
+
+    def compile_instrumented(parser, token):
+        node = compile_function(parser, token)
+        node.render = instrumented(name)(node.render)
+        return node
+    library.tags[tag_name] = compile_instrumented
+
+def log_span(name, seconds, queries):
+    """
+    A collector writing every span to the user_profile.instrumentation logger
+    """
+    logger.debug("%s %.2f ms, %s queries", name, seconds * 1000, queries)
+
+def connect_collectors(collectors):
+    """
+    Usage:  connect_collectors(collectors)
+    Before: collectors are dotted paths to callables taking name, seconds and queries
+    After:  The callables are called with every finished span
+    """
+    for path in collectors:
+        module_name, attribute = path.rsplit(".", 1)
+        collector = getattr(import_module(module_name), attribute)
+
+        def receiver(sender, name, seconds, queries, collector = collector, **kwargs):
+            collector(name, seconds, queries)
+        span_finished.connect(receiver, weak = False, dispatch_uid = path)
+
+def summarize(spans):
+    """
+    Usage:  header = summarize(spans)
+    Before: spans is a list of (name, seconds, queries) tuples
+    After:  header sums up the spans of every name, in the Server-Timing format
+    """
+    names = []
+    totals = {}
+    for name, seconds, queries in spans:
+        if name not in totals:
+            names.append(name)
+            totals[name] = [0.0, 0, None]
+        total = totals[name]
+        total[0] += seconds
+        total[1] += 1
+        if queries is not None:
+            total[2] = (total[2] or 0) + queries
+    parts = []
+    for name in names:
+        seconds, count, queries = totals[name]
+        description = "%d calls" % count
+        if queries is not None:
+            description += ", %d queries" % queries
+        parts.append('%s;dur=%.2f;desc="%s"' % (name, seconds * 1000, description))
+    return ", ".join(parts)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Adds a summary of the spans measured while handling a request to the response
+    in the PROFILE_INSTRUMENTATION_HEADER header
+    """
+    def process_request(self, request):
+        if PROFILE_INSTRUMENTATION and PROFILE_INSTRUMENTATION_HEADER:
+            _local.spans = []
+
+    def process_response(self, request, response):
+        spans = getattr(_local, 'spans', None)
+        _local.spans = None
+        if spans:
+            response[PROFILE_INSTRUMENTATION_HEADER] = summarize(spans)
+        return response
+
+if PROFILE_INSTRUMENTATION:
+    connect_collectors(PROFILE_INSTRUMENTATION_COLLECTORS)
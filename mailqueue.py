@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+The worker sending the messages in the QueuedEmail table
+
+Messages are claimed in batches and sent over one SMTP connection. Failed
+messages are tried again later, waiting twice as long after every attempt.
+Run it with the send_queued_email management command. To try it out locally,
+start a debugging SMTP server with
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+
+and set EMAIL_HOST = 'localhost' and EMAIL_PORT = 1025.
+"""
+
+import smtplib
+import socket
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from django.core.mail import EmailMessage, get_connection
+from django.conf import settings
+
+from user_profile.models import QueuedEmail
+
+MAIL_QUEUE_BATCH_SIZE = getattr(settings, "MAIL_QUEUE_BATCH_SIZE", 100)
+MAIL_QUEUE_MAX_ATTEMPTS = getattr(settings, "MAIL_QUEUE_MAX_ATTEMPTS", 5)
+MAIL_QUEUE_CLAIM_TIMEOUT = timedelta(minutes = 10)
+
+def claim_batch(batch_size = MAIL_QUEUE_BATCH_SIZE):
+    """
+    Usage:  emails = claim_batch([batch_size = MAIL_QUEUE_BATCH_SIZE])
+    After:  emails is a list of at most batch_size due messages which no other
+            worker will send for MAIL_QUEUE_CLAIM_TIMEOUT
+    """
+    now = datetime.now()
+    claim = uuid4().hex
+    ids = list(QueuedEmail.objects.due(now).values_list('id', flat = True)[:batch_size])
+    if not ids:
+        return []
+    QueuedEmail.objects.due(now).filter(id__in = ids).update(claim = claim,
+                                                            claimed_until = now + MAIL_QUEUE_CLAIM_TIMEOUT)
+    return list(QueuedEmail.objects.filter(claim = claim, sent = None))
+
+def send_batch(batch_size = MAIL_QUEUE_BATCH_SIZE, max_attempts = MAIL_QUEUE_MAX_ATTEMPTS):
+    """
+    Usage:  (sent, failed) = send_batch([batch_size = MAIL_QUEUE_BATCH_SIZE, max_attempts = MAIL_QUEUE_MAX_ATTEMPTS])
+    After:  A batch of due messages has been sent over a single connection
+            sent is the number of messages that were sent and failed the number that were not.
+            Failed messages are tried again later unless they have been tried max_attempts times.
+    """
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+
+    connection = get_connection()
+    sent_ids = []
+    failed = 0
+    try:
+        for email in emails:
+            message = EmailMessage(subject = email.subject, body = email.message,
+                                    from_email = email.from_email, to = email.get_recipients(),
+                                    connection = connection)
+            try:
+                connection.open()
+                connection.send_messages([message])
+            except (smtplib.SMTPException, socket.error), error:
+                failed += 1
+                record_failure(email, error, max_attempts)
+                if isinstance(error, smtplib.SMTPServerDisconnected):
+                    connection.close()
+            else:
+                sent_ids.append(email.id)
+    finally:
+        connection.close()
+        if sent_ids:
+            QueuedEmail.objects.filter(id__in = sent_ids).update(sent = datetime.now(), claim = '',
+                                                                claimed_until = None)
+    return len(sent_ids), failed
+
+def record_failure(email, error, max_attempts):
+    attempts = email.attempts + 1
+    if attempts >= max_attempts:
+        #Give up, the message stays in the table for the administrators to look at
+        next_attempt = datetime(9999, 12, 31)
+    else:
+        next_attempt = datetime.now() + timedelta(minutes = 2 ** attempts)
+    QueuedEmail.objects.filter(id = email.id).update(attempts = attempts,
+                                                    last_error = unicode(error),
+                                                    next_attempt = next_attempt,
+                                                    claim = '',
+                                                    claimed_until = None)
+
+def send_queued(batch_size = MAIL_QUEUE_BATCH_SIZE, max_attempts = MAIL_QUEUE_MAX_ATTEMPTS):
+    """
+    Usage:  (sent, failed) = send_queued([batch_size = MAIL_QUEUE_BATCH_SIZE, max_attempts = MAIL_QUEUE_MAX_ATTEMPTS])
+    After:  Batches have been sent until no due messages were left
+            sent and failed are the totals over all the batches
+    """
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = send_batch(batch_size, max_attempts)
+        if sent + failed == 0:
+            return total_sent, total_failed
+        total_sent += sent
+        total_failed += failed
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from user_profile.export import FORMATS, EXPORT_CHUNK_SIZE, export_profiles
+
+class Command(BaseCommand):
+    help = "Writes every profile as CSV, JSON lines or vCards"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest = 'format', default = 'csv',
+                    help = 'One of %s' % ", ".join(sorted(FORMATS.keys()))),
+        make_option('--output', dest = 'output', default = None,
+                    help = 'File to write to, defaults to standard output'),
+        make_option('--chunk-size', dest = 'chunk_size', type = 'int', default = EXPORT_CHUNK_SIZE,
+                    help = 'Number of profiles read from the database at a time'),
+    )
+
+    def handle(self, *args, **options):
+        format = options['format']
+        if format not in FORMATS:
+            raise CommandError("Unknown format '%s'" % format)
+
+        if options['output'] is None:
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'wb')
+        try:
+            for data in export_profiles(format, chunk_size = options['chunk_size']):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from user_profile.bulk_import import READERS, IMPORT_BATCH_SIZE, import_profiles
+
+class Command(BaseCommand):
+    help = "Creates users and profiles from a CSV or JSON lines file"
+    args = "<file>"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest = 'format', default = 'csv',
+                    help = 'One of %s' % ", ".join(sorted(READERS.keys()))),
+        make_option('--batch-size', dest = 'batch_size', type = 'int', default = IMPORT_BATCH_SIZE,
+                    help = 'Number of rows inserted at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one file to import")
+        if options['format'] not in READERS:
+            raise CommandError("Unknown format '%s'" % options['format'])
+
+        stream = open(args[0], 'rb')
+        try:
+            result = import_profiles(stream, options['format'], options['batch_size'])
+        finally:
+            stream.close()
+
+        for line, errors in result.errors:
+            for field, messages in errors.items():
+                self.stderr.write((u"Line %d, %s: %s\n" % (line, field, u" ".join(messages))).encode("utf8"))
+        self.stdout.write("%d users created, %d rows skipped\n" % (result.created, len(result.errors)))
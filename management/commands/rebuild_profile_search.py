@@ -0,0 +1,12 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+from django.core.management.base import NoArgsCommand
+
+from user_profile.models import ProfileSearchTerm
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the profile search index for every user"
+
+    def handle_noargs(self, **options):
+        ProfileSearchTerm.objects.rebuild()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from user_profile import thumbnails
+from user_profile.models import DisplayImage, DISPLAY_IMAGE_QUALITY, UTILS, get_thumbnail_targets, get_display_image_formats
+
+class Command(BaseCommand):
+    help = "Rebuilds the sizes and formats of every display image that are missing or older than the original"
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest = 'chunk_size', type = 'int', default = 500,
+                    help = 'Number of display images read from the database at a time'),
+        make_option('--workers', dest = 'workers', type = 'int', default = None,
+                    help = 'Number of worker processes, defaults to the number of CPUs'),
+        make_option('--checkpoint', dest = 'checkpoint', default = None,
+                    help = 'File recording the last finished id, a later run continues from it'),
+        make_option('--force', dest = 'force', action = 'store_true', default = False,
+                    help = 'Rebuild every size even if it is newer than the original'),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+        force = options['force']
+        verbosity = int(options.get('verbosity', 1))
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        last_id = self.read_checkpoint(checkpoint)
+        pool = Pool(options['workers'])
+        started = time.time()
+        images = built = skipped = 0
+        failures = []
+        #Every target of an image is up to date once its job succeeds, in every format
+        saved_formats = ",".join(get_display_image_formats())
+
+        try:
+            while True:
+                chunk = list(DisplayImage.objects.filter(id__gt = last_id)
+                                .order_by('id')
+                                .values_list('id', 'display_image', 'thumbnail_state', 'saved_formats')[:chunk_size])
+                if not chunk:
+                    break
+
+                jobs = []
+                up_to_date = []
+                for image_id, name, state, formats in chunk:
+                    job = self.get_job(image_id, name, force)
+                    if job is None:
+                        skipped += 1
+                        #Images left pending by a worker that died are repaired here as well
+                        if state != thumbnails.READY or formats != saved_formats:
+                            up_to_date.append(image_id)
+                    else:
+                        jobs.append(job)
+
+                ready, failed = [], []
+                for image_id, results in pool.imap_unordered(thumbnails.make_thumbnails_for_image, jobs):
+                    errors = [(size_name, error) for size_name, error in results if error is not None]
+                    built += len(results) - len(errors)
+                    if errors:
+                        failed.append(image_id)
+                        failures.append((image_id, errors))
+                    else:
+                        ready.append(image_id)
+                if ready:
+                    DisplayImage.objects.filter(id__in = ready).update(thumbnail_state = thumbnails.READY,
+                                                                        saved_formats = saved_formats)
+                if up_to_date:
+                    DisplayImage.objects.filter(id__in = up_to_date).update(thumbnail_state = thumbnails.READY,
+                                                                            saved_formats = saved_formats)
+                if failed:
+                    DisplayImage.objects.filter(id__in = failed).update(thumbnail_state = thumbnails.FAILED)
+
+                images += len(chunk)
+                last_id = chunk[-1][0]
+                self.write_checkpoint(checkpoint, last_id)
+                if verbosity > 1:
+                    self.report(images, built, skipped, failures, started)
+        finally:
+            pool.close()
+            pool.join()
+
+        for image_id, errors in failures:
+            for size_name, error in errors:
+                self.stderr.write("DisplayImage %d, %s: %s\n" % (image_id, size_name, error))
+        if verbosity > 0:
+            self.report(images, built, skipped, failures, started)
+
+    def get_job(self, image_id, name, force):
+        """
+        Usage:  job = self.get_job(image_id, name, force)
+        After:  job is an (image_id, source_path, targets, quality) tuple of the sizes of the
+                image that need to be built, or None if there are none
+        """
+        head, filename = os.path.split(name)
+        source_path = UTILS.get_path_to_original(name)
+        targets = get_thumbnail_targets(filename)
+        if not force:
+            try:
+                targets = thumbnails.stale_targets(source_path, targets)
+            except OSError:
+                #The original is missing, let the worker report it
+                pass
+        if not targets:
+            return None
+        return image_id, source_path, targets, DISPLAY_IMAGE_QUALITY
+
+    def report(self, images, built, skipped, failures, started):
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write("%d images (%.1f/s), %d sizes built, %d images up to date, %d failed\n"
+                            % (images, images / elapsed, built, skipped, len(failures)))
+
+    def read_checkpoint(self, checkpoint):
+        if checkpoint is None or not os.path.exists(checkpoint):
+            return 0
+        try:
+            return int(open(checkpoint).read().strip())
+        except ValueError:
+            raise CommandError("The checkpoint file %s does not contain an id" % checkpoint)
+
+    def write_checkpoint(self, checkpoint, last_id):
+        if checkpoint is None:
+            return
+        temporary = "%s.tmp" % checkpoint
+        checkpoint_file = open(temporary, "w")
+        try:
+            checkpoint_file.write("%d\n" % last_id)
+        finally:
+            checkpoint_file.close()
+        os.rename(temporary, checkpoint)
@@ -0,0 +1,30 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from user_profile.mailqueue import MAIL_QUEUE_BATCH_SIZE, MAIL_QUEUE_MAX_ATTEMPTS, send_queued
+
+class Command(NoArgsCommand):
+    help = "Sends the queued emails, once or every --interval seconds"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--interval', dest = 'interval', type = 'float', default = None,
+                    help = 'Keep running and look for new messages this often'),
+        make_option('--batch-size', dest = 'batch_size', type = 'int', default = MAIL_QUEUE_BATCH_SIZE,
+                    help = 'Number of messages sent over one connection'),
+        make_option('--max-attempts', dest = 'max_attempts', type = 'int', default = MAIL_QUEUE_MAX_ATTEMPTS,
+                    help = 'Give up on a message after this many failures'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            sent, failed = send_queued(options['batch_size'], options['max_attempts'])
+            if verbosity > 0 and sent + failed > 0:
+                self.stdout.write("%d sent, %d failed\n" % (sent, failed))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
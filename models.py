@@ -2,34 +2,107 @@
 # -*- coding: utf8 -*-
 
 import os
+from hashlib import sha1
 from random import choice
-from datetime import date
+from datetime import date, datetime, timedelta
 from calendar import monthrange
-from PIL import Image
 
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.contrib.auth.models import User
-from django.contrib.localflavor.is_.is_postalcodes import IS_POSTALCODES
+from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import memoize
 
 from user_profile.settings import controller
-from user_profile.utils import DisplayImageLocationFactory, DisplayImageUtils
+from user_profile.utils import DisplayImageLocation, DisplayImageLocationFactory, DisplayImageUtils
+from user_profile import thumbnails, sprites
+from user_profile.instrumentation import instrumented
+from user_profile.page_cache import invalidate_profiles
+from user_profile.dbutils import bulk_insert, on_commit
+from user_profile import search
+from user_profile.postalcodes import get_postalcode, get_postalcodes
 
 DISPLAY_IMAGES_FOLDER = getattr(settings, "DISPLAY_IMAGES_FOLDER", "")
 DISPLAY_IMAGE_SIZE = getattr(settings, "DISPLAY_IMAGE_SIZE", {'small': (50, 56) ,
                                                               'medium': (75, 84),
                                                               'large': (150,168) })
 DISPLAY_IMAGE_DEFAULT = getattr(settings, "DISPLAY_IMAGE_DEFAULT", "engin-mynd.jpg")
+DISPLAY_IMAGE_EXECUTOR = getattr(settings, "DISPLAY_IMAGE_EXECUTOR", "thread")
+DISPLAY_IMAGE_WORKERS = getattr(settings, "DISPLAY_IMAGE_WORKERS", 2)
+DISPLAY_IMAGE_ON_DEMAND = getattr(settings, "DISPLAY_IMAGE_ON_DEMAND", False)
+DISPLAY_IMAGE_CACHE_BYTES = getattr(settings, "DISPLAY_IMAGE_CACHE_BYTES", None)
+DISPLAY_IMAGE_MAX_BYTES = getattr(settings, "DISPLAY_IMAGE_MAX_BYTES", 10 * 1024 * 1024)
+DISPLAY_IMAGE_MAX_PIXELS = getattr(settings, "DISPLAY_IMAGE_MAX_PIXELS", 25 * 1000 * 1000)
+
+DISPLAY_IMAGE_FORMATS = getattr(settings, "DISPLAY_IMAGE_FORMATS", ('webp', 'jpeg'))
+DISPLAY_IMAGE_QUALITY = getattr(settings, "DISPLAY_IMAGE_QUALITY", thumbnails.DEFAULT_QUALITY)
+DISPLAY_IMAGE_SPRITE_SIZE = getattr(settings, "DISPLAY_IMAGE_SPRITE_SIZE", 'small')
+DISPLAY_IMAGE_SPRITE_COLUMNS = getattr(settings, "DISPLAY_IMAGE_SPRITE_COLUMNS", 20)
+SPRITES_DIRECTORY = 'sprites'
+
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif'}
 
 UTILS = DisplayImageUtils(media_root = settings.MEDIA_ROOT,
                             media_url = settings.MEDIA_URL,
                             display_images_folder = DISPLAY_IMAGES_FOLDER)
 
+THUMBNAIL_EXECUTOR = thumbnails.create_executor(DISPLAY_IMAGE_EXECUTOR, DISPLAY_IMAGE_WORKERS)
+VARIANT_CACHE = thumbnails.VariantCache(UTILS, DISPLAY_IMAGE_SIZE, DISPLAY_IMAGE_CACHE_BYTES, DISPLAY_IMAGE_QUALITY)
+
+def get_display_image_formats():
+    """
+    Usage:  format_names = get_display_image_formats()
+    After:  format_names are the formats in DISPLAY_IMAGE_FORMATS that PIL can save
+            PIL is loaded the first time this is called, not when models is imported
+    """
+    return thumbnails.supported_formats(DISPLAY_IMAGE_FORMATS)
+get_display_image_formats = memoize(get_display_image_formats, {}, 0)
 
 class NoKennitala(Exception):
     pass
 
+def memoized(*dependencies, **options):
+    """
+    Usage:  method = memoized(dependency, ... [, daily = False])(method)
+    Before: every dependency is the name of an attribute of the instance, possibly
+            dotted as in 'user.first_name'
+    After:  method caches its result on the instance. The cached result is returned
+            as long as the arguments and the values of the dependencies have not changed,
+            and if daily is True, as long as date.today() has not changed
+    """
+    daily = options.get('daily', False)
+
+    def decorator(method):
+        name = method.__name__
+
+        def memoized_method(self, *args, **kwargs):
+            key = [args, tuple(sorted(kwargs.items()))]
+            for dependency in dependencies:
+                value = self
+                for attribute in dependency.split("."):
+                    value = getattr(value, attribute)
+                key.append(value)
+            if daily:
+                key.append(date.today())
+            key = tuple(key)
+
+            memo = self.__dict__.setdefault('_memo', {})
+            if name in memo and memo[name][0] == key:
+                return memo[name][1]
+            value = method(self, *args, **kwargs)
+            memo[name] = (key, value)
+            return value
+
+        memoized_method.__name__ = name
+        memoized_method.__doc__ = method.__doc__
+        return memoized_method
+    return decorator
+
+NAME_FIELDS = ('middlenames', 'user.first_name', 'user.last_name', 'user.username')
+BDATE_FIELDS = ('kennitala', 'birthdate')
+
 class Website(models.Model):
     url = models.URLField(_(u'Slóð'), default ='http://', unique = True)
     name = models.CharField(_(u'Nafn'), max_length=30)
@@ -41,6 +114,57 @@ class Website(models.Model):
         verbose_name = _(u"Heimasíða")
         verbose_name_plural = _(u"Heimasíður")
 
+class DisplayImageManager(models.Manager):
+
+    def default(self):
+        """
+        Usage:  display_image = DisplayImage.objects.default()
+        After:  display_image is an unsaved DisplayImage pointing to DISPLAY_IMAGE_DEFAULT
+        """
+        return DisplayImage(user = User(), display_image = DISPLAY_IMAGE_DEFAULT)
+
+    def choose(self, user_id, random = True):
+        """
+        Usage:  display_image = DisplayImage.objects.choose(user_id, [random = True])
+        After:  display_image is one of the display images of the user with id user_id,
+                picked at random if random is True else the newest one, or the default
+                image if the user has none.
+                Costs a single query.
+        """
+        if random:
+            ordering = '?'
+        else:
+            ordering = '-id'
+        try:
+            return self.filter(user = user_id).order_by(ordering)[0]
+        except IndexError:
+            return self.default()
+
+    def choose_for_users(self, user_ids, random = True):
+        """
+        Usage:  display_images = DisplayImage.objects.choose_for_users(user_ids, [random = True])
+        After:  display_images is a dictionary mapping every id in user_ids to a display image
+                chosen as by choose(user_id, random)
+                Costs a single query however many user_ids there are.
+        """
+        user_ids = list(user_ids)
+        images_by_user = {}
+        if user_ids:
+            for display_image in self.filter(user__in = user_ids).order_by('-id'):
+                images_by_user.setdefault(display_image.user_id, []).append(display_image)
+
+        display_images = {}
+        for user_id in user_ids:
+            images = images_by_user.get(user_id)
+            if not images:
+                display_images[user_id] = self.default()
+            elif random:
+                display_images[user_id] = choice(images)
+            else:
+                display_images[user_id] = images[0]
+        return display_images
+
+
 class DisplayImage(models.Model):
     """
 
@@ -51,9 +175,38 @@ class DisplayImage(models.Model):
         small, medium and large are dictionaries containing the keys 'url' and 'path'
             and each pointing to a appropriate version of display_image
 
+        thumbnail_state is 'pending' while the sizes are being built, 'ready' when
+            they exist and 'failed' if building them did not succeed
+            Until the sizes are ready small, medium and large point to the original
+            image or to the default image
+
+        If DISPLAY_IMAGE_ON_DEMAND is set no sizes are built on save, and the url of a size
+            that does not exist yet points to the show_display_image view which builds it
+
+        width and height are the dimensions of the original image, None if unknown
+
+        Every size is also saved in the formats in DISPLAY_IMAGE_FORMATS PIL can save, the formats
+            attribute of small, medium and large maps the names of the formats that have been
+            saved to their urls
+        saved_formats lists the formats every size has been saved in, separated by commas,
+            recorded when the sizes are built or regenerated so reading them needs no disk access
+
+        Uploads are stored under the hash of their contents, so display images with
+        the same contents share the original and its sizes. The files are removed
+        when the last display image using them is deleted.
+
     """
     user = models.ForeignKey(User, related_name="display_images")
-    display_image = models.ImageField(upload_to=DISPLAY_IMAGES_FOLDER)
+    display_image = models.ImageField(upload_to=DISPLAY_IMAGES_FOLDER, db_index = True)
+    thumbnail_state = models.CharField(_(u"Staða smámynda"), max_length = 7,
+                                        choices = thumbnails.STATE_CHOICES,
+                                        default = thumbnails.READY,
+                                        editable = False)
+    width = models.PositiveIntegerField(null = True, editable = False)
+    height = models.PositiveIntegerField(null = True, editable = False)
+    saved_formats = models.CharField(max_length = 100, blank = True, default = '', editable = False)
+
+    objects = DisplayImageManager()
 
     def __unicode__(self):
         return u"Mynd %s af %s" % (self.display_image.name, self.user.username)
@@ -63,47 +216,366 @@ class DisplayImage(models.Model):
         verbose_name_plural = _(u"Myndir af nemendum")
 
     def save(self):
+        """
+        Usage:  display_image.save()
+        After:  The original image has been saved and the sizes in DISPLAY_IMAGE_SIZE
+                have been handed to THUMBNAIL_EXECUTOR to be built in the background once
+                the transaction has been committed, see dbutils.on_commit,
+                unless DISPLAY_IMAGE_ON_DEMAND is set
+                width and height have been taken from the header DisplayImageForm read
+                from a new upload, or from the header of the saved original
+                Sizes that exist already for an original with the same contents are reused
+        """
+        self.set_dimensions()
+        self.store_original()
+        if DISPLAY_IMAGE_ON_DEMAND:
+            self.thumbnail_state = thumbnails.READY
+            super(DisplayImage, self).save()
+            return
+
+        self.thumbnail_state = thumbnails.PENDING
         super(DisplayImage, self).save()
-        image_file = self.display_image
-        head, filename = os.path.split(image_file.name)
-
-        image = Image.open(image_file)
-        for size in DISPLAY_IMAGE_SIZE.keys():
-            self._save_image(filename, image.copy(), size)
-
-    def _save_image(self, filename, image, size):
-        image.thumbnail(DISPLAY_IMAGE_SIZE[size])
-
-        directory = os.path.join(settings.MEDIA_ROOT, UTILS.get_directory(size))
+        head, filename = os.path.split(self.display_image.name)
 
-        if not os.path.exists(directory):
-            os.mkdir(directory, 0777)
-            os.chmod(directory, 0777) #0777 means that everyone can read, write and execute
+        targets = thumbnails.stale_targets(self.display_image.path, get_thumbnail_targets(filename))
+        if not targets:
+            self.thumbnail_state = thumbnails.READY
+            self.saved_formats = get_saved_formats(filename)
+            set_thumbnail_state(self.id, thumbnails.READY, self.saved_formats)
+            return
+
+        def finished(image_id, state):
+            self.thumbnail_state = state
+            self.saved_formats = get_saved_formats(filename)
+            set_thumbnail_state(image_id, state, self.saved_formats)
+
+        def schedule():
+            thumbnails.schedule_thumbnails(THUMBNAIL_EXECUTOR, self.id, self.display_image.path,
+                                            targets, finished, DISPLAY_IMAGE_QUALITY)
+        #The workers write the state on their own connections, which must not happen before
+        #the pending state has been committed
+        on_commit(schedule)
+    save = instrumented('display_image.save')(save)
+
+    def set_dimensions(self):
+        """
+        Usage:  display_image.set_dimensions()
+        After:  width and height are the dimensions of the image, read from its header
+                The header DisplayImageForm read from a new upload is used if there is one
+        """
+        if not self.display_image:
+            return
+        if self.display_image._committed:
+            if self.width is not None:
+                return
+            source = self.display_image.path
+        else:
+            source = self.display_image.file
+            header = getattr(source, 'image_header', None)
+            if header is not None:
+                self.width, self.height = header.width, header.height
+                return
+        try:
+            header = thumbnails.read_image_header(source)
+        except IOError:
+            self.width = self.height = None
+        else:
+            self.width, self.height = header.width, header.height
 
-        filepath = UTILS.get_path_to_image(size, filename)
-        image.save(filepath)
-        return image
+    def store_original(self):
+        """
+        Usage:  display_image.store_original()
+        After:  A new upload has been stored under a name made from the hash of its contents,
+                or points to the stored original with the same contents if there is one
+        """
+        if not self.display_image or self.display_image._committed:
+            return
+        upload = self.display_image.file
+        name = self.display_image.field.generate_filename(self, get_content_name(upload, self.display_image.name))
+        if self.display_image.storage.exists(name):
+            self.display_image.name = name
+            self.display_image._committed = True
+        else:
+            self.display_image.save(name, upload, save = False)
 
     def delete(self):
-        head, filename = os.path.split(self.display_image.name)
-        for size in DISPLAY_IMAGE_SIZE.keys():
+        """
+        Usage:  display_image.delete()
+        After:  display_image has been deleted, along with its original and sizes unless
+                another display image uses them
+        """
+        name = self.display_image.name
+        super(DisplayImage, self).delete()
+        if name == DISPLAY_IMAGE_DEFAULT or DisplayImage.objects.filter(display_image = name).exists():
+            return
+        head, filename = os.path.split(name)
+        paths = [path for size_name, size, path in get_thumbnail_targets(filename)]
+        paths.append(UTILS.get_path_to_original(name))
+        for path in paths:
             try:
-                os.remove(UTILS.get_path_to_image(size, filename))
+                os.remove(path)
             except OSError:
                 #TODO: Notify
                 pass
-        super(DisplayImage, self).delete()
 
     def __getattr__(self, name):
         if name in DISPLAY_IMAGE_SIZE.keys():
-            head, filename = os.path.split(self.display_image.name)
+            if self.thumbnail_state == thumbnails.PENDING:
+                return DisplayImageLocation(url = UTILS.get_url_to_original(self.display_image.name),
+                                            path = UTILS.get_path_to_original(self.display_image.name))
+            elif self.thumbnail_state == thumbnails.FAILED:
+                head, filename = os.path.split(DISPLAY_IMAGE_DEFAULT)
+            else:
+                head, filename = os.path.split(self.display_image.name)
             factory = DisplayImageLocationFactory(filename = filename,
                                                     size = name,
                                                     utils = UTILS)
-            return factory.get_display_image_location()
+            location = factory.get_display_image_location()
+            if DISPLAY_IMAGE_ON_DEMAND:
+                if not os.path.exists(location.path):
+                    location.url = reverse('display_image', kwargs = {'size': name, 'filename': filename})
+                return location
+
+            #Images saved before a format was added have no file in it until
+            #regenerate_display_images has been run
+            if self.thumbnail_state == thumbnails.FAILED or self.display_image.name == DISPLAY_IMAGE_DEFAULT:
+                saved_formats = get_default_image_formats()
+            else:
+                saved_formats = self.saved_formats.split(",")
+            for format_name in get_display_image_formats():
+                if format_name in saved_formats:
+                    variant_filename = thumbnails.get_variant_filename(filename, format_name)
+                    location.formats[format_name] = UTILS.get_url_to_image(name, variant_filename)
+            return location
         else:
             return super(DisplayImage, self).__getattr__(name)
 
+    def get_sources(self, size_name):
+        """
+        Usage:  (srcset, sources) = display_image.get_sources(size_name)
+        After:  srcset lists the urls of size_name and every larger size with their pixel
+                densities relative to size_name, for the srcset attribute of an <img />
+                sources is a list of (mimetype, srcset) pairs for the <source /> elements
+                of a <picture>, one for every format in DISPLAY_IMAGE_FORMATS
+        """
+        width = DISPLAY_IMAGE_SIZE[size_name][0]
+        densities = []
+        for name, size in sorted(DISPLAY_IMAGE_SIZE.items(), key = lambda item: item[1][0]):
+            if size[0] >= width:
+                densities.append((getattr(self, name), "%gx" % round(float(size[0]) / width, 2)))
+
+        srcset = u", ".join([u"%s %s" % (location.url, density) for location, density in densities])
+        sources = []
+        for format_name in get_display_image_formats():
+            if not all([format_name in location.formats for location, density in densities]):
+                continue
+            format_srcset = u", ".join([u"%s %s" % (location.formats[format_name], density)
+                                        for location, density in densities])
+            if format_srcset != srcset:
+                sources.append((thumbnails.VARIANT_FORMATS[format_name][2], format_srcset))
+        return srcset, sources
+
+
+class ProfileSearchTermManager(models.Manager):
+
+    def index(self, users_and_profiles):
+        """
+        Usage:  ProfileSearchTerm.objects.index(users_and_profiles)
+        Before: users_and_profiles is a list of (user, profile) pairs of saved users,
+                profile is None if the user has no profile
+        After:  The search terms of the users have been replaced by new ones built from
+                their current names, kennitala, phone numbers and city
+        """
+        if not users_and_profiles:
+            return
+        self.filter(user__in = [user.id for user, profile in users_and_profiles]).delete()
+        terms = []
+        for user, profile in users_and_profiles:
+            if profile is None:
+                city = u''
+            else:
+                city = profile.city
+            for term, public in search.profile_terms(user, profile, city):
+                terms.append(ProfileSearchTerm(user_id = user.id, term = term, public = public))
+        bulk_insert(ProfileSearchTerm, terms)
+
+    def search(self, query, public_only = False):
+        """
+        Usage:  user_ids = ProfileSearchTerm.objects.search(query, [public_only = False])
+        After:  user_ids is a queryset of the distinct ids of the users that have, for every word
+                of query, a term starting with that word, only counting public terms if
+                public_only is True. It is evaluated as a single query with a subquery per word,
+                and can be used as a subquery itself, e.g. in filter(id__in = user_ids)
+        """
+        terms = None
+        for word in search.query_words(query):
+            word_terms = self.filter(term__startswith = word)
+            if public_only:
+                word_terms = word_terms.filter(public = True)
+            if terms is not None:
+                word_terms = word_terms.filter(user__in = terms.values('user'))
+            terms = word_terms
+        if terms is None:
+            #Not none(), which matches every term when it is used as a subquery
+            terms = self.filter(term__in = [])
+        return terms.values_list('user', flat = True).distinct()
+
+    def rebuild(self, chunk_size = 500):
+        """
+        Usage:  ProfileSearchTerm.objects.rebuild([chunk_size = 500])
+        After:  The search terms of every user have been rebuilt
+        """
+        ProfileModel = controller.get_profile_model()
+        last_id = 0
+        while True:
+            users = list(User.objects.filter(id__gt = last_id).order_by('id')[:chunk_size])
+            if not users:
+                return
+            profiles = {}
+            for profile in ProfileModel.objects.filter(user__in = [user.id for user in users]):
+                profiles[profile.user_id] = profile
+            self.index([(user, profiles.get(user.id)) for user in users])
+            last_id = users[-1].id
+
+
+class ProfileSearchTerm(models.Model):
+    """
+    One row of the profile search index
+
+    Data invariant:
+        term is a word folded with search.normalize_word from the names, username, email,
+            kennitala, phone numbers, postal code or city of user
+        public is True if anyone may find user by term, False if only staff may
+    """
+    user = models.ForeignKey(User, related_name = "search_terms")
+    term = models.CharField(max_length = search.MAX_TERM_LENGTH, db_index = True)
+    public = models.BooleanField(default = True)
+
+    objects = ProfileSearchTermManager()
+
+    def __unicode__(self):
+        return self.term
+
+
+def prefetch_directory(profiles, random = True):
+    """
+    Usage:  prefetch_directory(profiles, [random = True])
+    Before: profiles is a list of profiles of the same model
+    After:  The home pages of every profile and one display image per user, chosen as by
+            display_image(random), have been loaded in two queries and are used by
+            get_homepages(), has_homepages() and display_image()
+    """
+    if not profiles:
+        return
+    field = profiles[0]._meta.get_field('homepages')
+    through = field.rel.through
+    source_name = field.m2m_field_name()
+    target_name = field.m2m_reverse_field_name()
+
+    homepages = {}
+    links = through.objects.filter(**{'%s__in' % source_name: [profile.id for profile in profiles]})
+    for link in links.select_related(target_name):
+        homepages.setdefault(getattr(link, '%s_id' % source_name), []).append(getattr(link, target_name))
+
+    display_images = DisplayImage.objects.choose_for_users([profile.user_id for profile in profiles], random)
+    for profile in profiles:
+        profile._homepages_cache = homepages.get(profile.id, [])
+        profile._display_image_cache = {random: display_images[profile.user_id]}
+
+
+class DirectoryQuerySet(models.query.QuerySet):
+    """
+    A QuerySet of profiles that loads the users, home pages and a display image
+    of every profile in a fixed number of queries per chunk_size profiles
+    """
+    chunk_size = 1000
+
+    def iterator(self):
+        chunk = []
+        for profile in super(DirectoryQuerySet, self).iterator():
+            chunk.append(profile)
+            if len(chunk) == self.chunk_size:
+                prefetch_directory(chunk)
+                for prefetched in chunk:
+                    yield prefetched
+                chunk = []
+        prefetch_directory(chunk)
+        for prefetched in chunk:
+            yield prefetched
+
+
+class UserProfileManager(models.Manager):
+
+    def in_city(self, city):
+        """
+        Usage:  profiles = ProfileModel.objects.in_city(city)
+        After:  profiles is a QuerySet of the profiles with a postal code in city,
+                e.g. every code from 101 to 155 for u'Reykjavík'
+        """
+        return self.filter(postalcode__in = get_postalcodes(city))
+
+    def birthdays_between(self, start, end):
+        """
+        Usage:  profiles = ProfileModel.objects.birthdays_between(start, end)
+        Before: start <= end are dates
+        After:  profiles is a QuerySet of the profiles whose birthday falls on a day from
+                start to end, both included, ordered by how soon after start it is.
+                Works across new year and, like fix_leap, counts 29 February as 28 February.
+                Uses the indexed birthday column, so it is a single query.
+        """
+        start_key = birthday_key(start)
+        end_key = birthday_key(end)
+        if (end - start).days >= 365:
+            queryset = self.exclude(birthday = None)
+        elif start_key <= end_key:
+            queryset = self.filter(birthday__gte = start_key, birthday__lte = end_key)
+        else:
+            queryset = self.filter(models.Q(birthday__gte = start_key) | models.Q(birthday__lte = end_key))
+
+        column = "%s.%s" % (connection.ops.quote_name(self.model._meta.db_table),
+                            connection.ops.quote_name('birthday'))
+        order = "CASE WHEN %s >= %%s THEN %s ELSE %s + 1300 END" % (column, column, column)
+        return queryset.extra(select = {'birthday_order': order},
+                                select_params = (start_key, )).order_by('birthday_order')
+
+    def upcoming_birthdays(self, days = 7, today = None):
+        """
+        Usage:  profiles = ProfileModel.objects.upcoming_birthdays([days = 7, today = None])
+        After:  profiles are the profiles with a birthday from today to days days from today
+        """
+        if today is None:
+            today = date.today()
+        return self.birthdays_between(today, today + timedelta(days = days))
+
+    def recent_birthdays(self, days = 7, today = None):
+        """
+        Usage:  profiles = ProfileModel.objects.recent_birthdays([days = 7, today = None])
+        After:  profiles are the profiles with a birthday from days days ago to today
+        """
+        if today is None:
+            today = date.today()
+        return self.birthdays_between(today - timedelta(days = days), today)
+
+    def refresh_birthdates(self):
+        """
+        Usage:  ProfileModel.objects.refresh_birthdates()
+        After:  birthdate and birthday of every profile have been computed from its kennitala,
+                for rows saved before these columns existed
+        """
+        for profile in self.all().iterator():
+            profile.set_birthdate()
+            self.filter(id = profile.id).update(birthdate = profile.birthdate,
+                                                birthday = profile.birthday)
+
+    def for_directory(self):
+        """
+        Usage:  profiles = ProfileModel.objects.for_directory()
+        After:  profiles is a QuerySet of all profiles which, when evaluated, loads the users,
+                home pages and one display image per user for every chunk of 1000 profiles
+                in three queries
+        """
+        return DirectoryQuerySet(self.model, using = self._db).select_related('user')
+
 
 class UserProfile(models.Model):
     """
@@ -123,6 +595,9 @@ class UserProfile(models.Model):
 
         homepages eru þær heimasíður sem tengjast notandanum
 
+        birthdate er fæðingardagur notandans reiknaður út frá kennitölu við vistun, annars None
+        birthday er afmælisdagurinn á forminu mánuður * 100 + dagur, 29. febrúar telst 28. febrúar
+
     """
     MALE = 'M'
     FEMALE = 'F'
@@ -135,17 +610,31 @@ class UserProfile(models.Model):
 
     gender = models.CharField('Kyn', choices = GENDER_CHOICES, max_length = 1, blank = True)
     address = models.CharField('Heimilisfang', max_length=255, blank=True)
-    postalcode = models.CharField('Póstnúmer',max_length=3, blank=True)
+    postalcode = models.CharField('Póstnúmer',max_length=3, blank=True, db_index=True)
 
     phone = models.CharField('Sími',max_length=7, blank=True)
     gsm = models.CharField('GSM', max_length=7, blank=True)
 
     homepages = models.ManyToManyField(Website, verbose_name='Heimasíður', blank=True)
 
+    birthdate = models.DateField('Fæðingardagur', null = True, blank = True,
+                                    editable = False, db_index = True)
+    birthday = models.PositiveSmallIntegerField('Afmælisdagur', null = True, blank = True,
+                                                editable = False, db_index = True)
+
+    objects = UserProfileManager()
+
     class Meta:
         abstract = True
         ordering = ['user__first_name', 'middlenames', 'user__last_name' ]
 
+    def __init__(self, *args, **kwargs):
+        super(UserProfile, self).__init__(*args, **kwargs)
+        #The kennitala birthdate was computed from, the stored one is stale if it has changed since
+        self._birthdate_kennitala = self.kennitala
+        #The values the search terms were built from
+        self._indexed_values = search.get_indexed_values(self, search.PROFILE_FIELDS)
+
     def __unicode__(self):
         return self.get_short_fullname()
 
@@ -157,13 +646,24 @@ class UserProfile(models.Model):
         """
         Usage:  display_image = user.get_profile.display_image([random = True])
         Before: random is a boolean
-        After:  display_image is a DisplayImage object
+        After:  display_image is a DisplayImage object, one of the user's images chosen at
+                random if random is True else the newest one
+                If the profile came from for_directory() the image chosen then is returned,
+                as long as it was chosen the same way
         """
-        display_image_ids = self.user.display_images.values_list("id", flat = True)
-        if display_image_ids:
-            return self.user.display_images.get(id = choice(display_image_ids))
-        else:
-            return DisplayImage(user = User(), display_image = DISPLAY_IMAGE_DEFAULT)
+        try:
+            return self._display_image_cache[random]
+        except (AttributeError, KeyError):
+            return DisplayImage.objects.choose(self.user_id, random)
+
+    def display_images_for(cls, profiles, random = True):
+        """
+        Usage:  display_images = ProfileModel.display_images_for(profiles, [random = True])
+        After:  display_images is a dictionary mapping the ids of the users of profiles to one
+                display image each, chosen as by display_image(random), in a single query
+        """
+        return DisplayImage.objects.choose_for_users([profile.user_id for profile in profiles], random)
+    display_images_for = classmethod(display_images_for)
 
     def has_kennitala(self):
         """
@@ -183,7 +683,21 @@ class UserProfile(models.Model):
         Usage:  has_homepages = user.get_profile().has_homepages()
         After:  has_homepages is True if and only if the user has some home pages
         """
-        return self.homepages.all().count() > 0
+        try:
+            return len(self._homepages_cache) > 0
+        except AttributeError:
+            return self.homepages.all().count() > 0
+
+    def get_homepages(self):
+        """
+        Usage:  homepages = user.get_profile().get_homepages()
+        After:  homepages are the home pages of the user, loaded earlier if the
+                profile came from for_directory()
+        """
+        try:
+            return self._homepages_cache
+        except AttributeError:
+            return self.homepages.all()
 
     def get_welcome_note(self):
         """
@@ -220,6 +734,7 @@ class UserProfile(models.Model):
                 return u"%s %s" % (self.user.first_name, self.user.last_name)
         else:
             return self.user.username
+    get_short_fullname = memoized(*NAME_FIELDS)(get_short_fullname)
     short_fullname = property(get_short_fullname)
 
 
@@ -235,6 +750,7 @@ class UserProfile(models.Model):
                 return u"%s %s" % (self.user.first_name, self.user.last_name)
         else:
             return self.user.username
+    get_fullname = memoized(*NAME_FIELDS)(get_fullname)
     fullname = property(get_fullname)
 
     def get_postalcode_and_city(self):
@@ -242,11 +758,11 @@ class UserProfile(models.Model):
         Notkun:     postalcodeAndCity = profile.postalcode_and_city
         Eftir:      postalcodeAndCity er strengur á forminu 'póstnúmer Borg'
         """
-        postalcodes = dict(IS_POSTALCODES)
-        try:
-            return postalcodes[self.postalcode]
-        except KeyError:
+        postalcode = get_postalcode(self.postalcode)
+        if postalcode is None:
             return ''
+        return postalcode.label
+    get_postalcode_and_city = memoized('postalcode')(get_postalcode_and_city)
     postalcode_and_city = property(get_postalcode_and_city)
 
     def get_city(self):
@@ -254,7 +770,10 @@ class UserProfile(models.Model):
         Usage:  city = profile.city
         After:  city is the home city of the user
         """
-        return " ".join(self.postalcode_and_city.split(" ")[1:])
+        postalcode = get_postalcode(self.postalcode)
+        if postalcode is None:
+            return ''
+        return postalcode.city
     city = property(get_city)
 
 
@@ -267,23 +786,41 @@ class UserProfile(models.Model):
             return True
         else:
             return self.gender == UserProfile.MALE
+    is_male = memoized('gender')(is_male)
+
+    def save(self, *args, **kwargs):
+        self.set_birthdate()
+        super(UserProfile, self).save(*args, **kwargs)
+
+    def set_birthdate(self):
+        """
+        Usage:  profile.set_birthdate()
+        After:  birthdate and birthday have been computed from kennitala, or are None
+                if the profile has no valid kennitala
+        """
+        self._birthdate_kennitala = self.kennitala
+        try:
+            self.birthdate = parse_bdate(self.kennitala)
+        except (NoKennitala, ValueError):
+            self.birthdate = None
+            self.birthday = None
+        else:
+            self.birthday = birthday_key(self.birthdate)
 
     def get_bdate(self):
         """
         Usage:  bdate = user.get_profile.get_bdate()
         After:  bdate is a date object representing the user's birthday
                 if the profile has the information
-                else bdate is None
+                else NoKennitala has been raised
+                The stored birthdate is only used if it was computed from the current kennitala
         """
-        if self.kennitala != "":
-            kennitala = self.kennitala.replace("-", "")
-            if int(kennitala[-1]) is 9:
-                byear = '19' + kennitala[4:6]
-            else:
-                byear = '20' + kennitala[4:6]
-            return date(int(byear), int(kennitala[2:4]), int(kennitala[0:2]))
-        else:
+        if self.kennitala == "":
             raise NoKennitala()
+        if self.birthdate is not None and self.kennitala == self._birthdate_kennitala:
+            return self.birthdate
+        return parse_bdate(self.kennitala)
+    get_bdate = memoized(*BDATE_FIELDS)(get_bdate)
 
     def get_age_in_years(self, today = None):
         """
@@ -309,6 +846,7 @@ class UserProfile(models.Model):
             return (None, None, None)
         else:
             return calculate_age(bdate, today)
+    get_age = memoized(daily = True, *BDATE_FIELDS)(get_age)
 
     def get_age_suffix(self):
         """
@@ -344,6 +882,7 @@ class UserProfile(models.Model):
         tdeltas[abs(today - bday_next_year)]= bday_next_year
 
         return tdeltas[min(tdeltas.keys())]
+    get_closest_bday = memoized(daily = True, *BDATE_FIELDS)(get_closest_bday)
 
     def get_closest_bday_info(self, today = None):
         """
@@ -377,6 +916,30 @@ class UserProfile(models.Model):
             return (None, 0, 0, '')
 
 
+def parse_bdate(kennitala):
+    """
+    Usage:  bdate = parse_bdate(kennitala)
+    After:  bdate is the date of birth encoded in kennitala, with or without the dash
+            Raises NoKennitala if kennitala is empty and ValueError if it is malformed
+    """
+    if kennitala == "":
+        raise NoKennitala()
+    kennitala = kennitala.replace("-", "")
+    if int(kennitala[-1]) == 9:
+        byear = '19' + kennitala[4:6]
+    else:
+        byear = '20' + kennitala[4:6]
+    return date(int(byear), int(kennitala[2:4]), int(kennitala[0:2]))
+
+def birthday_key(day):
+    """
+    Usage:  key = birthday_key(day)
+    After:  key is month * 100 + day of fix_leap(day), which orders dates by
+            their place in the year
+    """
+    day = fix_leap(day)
+    return day.month * 100 + day.day
+
 def fix_leap(date_of_birth):
     """
     Usage:  bday_fixed = fix_leap(bday)
@@ -427,33 +990,541 @@ def calculate_age(date_of_birth, today):
             d = max(0, days - date_of_birth.day) + today.day
     return y, m, d
 
+def hash_contents(file):
+    """
+    Usage:  digest = hash_contents(file)
+    Before: file is a django File
+    After:  digest is the hex SHA-1 of the contents of file, read a chunk at a time
+    """
+    digest = sha1()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def get_content_name(file, name):
+    """
+    Usage:  content_name = get_content_name(file, name)
+    Before: file is a django File with the contents of an image uploaded as name
+    After:  content_name is the hash of the contents with the extension of the image format
+    """
+    header = getattr(file, 'image_header', None)
+    if header is not None and header.format in IMAGE_EXTENSIONS:
+        extension = IMAGE_EXTENSIONS[header.format]
+    else:
+        extension = os.path.splitext(name)[1].lower()
+    return hash_contents(file) + extension
+
+def get_thumbnail_targets(filename):
+    """
+    Usage:  targets = get_thumbnail_targets(filename)
+    After:  targets is a list of (size_name, size, target_path) tuples of every size of
+            the image filename in its own format and in the formats in DISPLAY_IMAGE_FORMATS
+    """
+    targets = []
+    for size_name, size in DISPLAY_IMAGE_SIZE.iteritems():
+        paths = [UTILS.get_path_to_image(size_name, filename)]
+        for format_name in get_display_image_formats():
+            path = UTILS.get_path_to_image(size_name, thumbnails.get_variant_filename(filename, format_name))
+            if path not in paths:
+                paths.append(path)
+        targets.extend([(size_name, size, path) for path in paths])
+    return targets
+
+def get_saved_formats(filename):
+    """
+    Usage:  saved_formats = get_saved_formats(filename)
+    After:  saved_formats lists the formats in DISPLAY_IMAGE_FORMATS PIL can save that every
+            size of the image filename has been saved in, separated by commas
+    """
+    saved = []
+    for format_name in get_display_image_formats():
+        variant_filename = thumbnails.get_variant_filename(filename, format_name)
+        if all([os.path.exists(UTILS.get_path_to_image(size_name, variant_filename))
+                    for size_name in DISPLAY_IMAGE_SIZE]):
+            saved.append(format_name)
+    return ",".join(saved)
+
+def get_default_image_formats():
+    """
+    Usage:  format_names = get_default_image_formats()
+    After:  format_names are the formats every size of DISPLAY_IMAGE_DEFAULT has been saved in,
+            checked on disk the first time this is called in a process
+    """
+    head, filename = os.path.split(DISPLAY_IMAGE_DEFAULT)
+    return get_saved_formats(filename).split(",")
+get_default_image_formats = memoize(get_default_image_formats, {}, 0)
+
+def get_original_path(filename):
+    """
+    Usage:  path = get_original_path(filename)
+    After:  path is the path to the original display image named filename,
+            which is DISPLAY_IMAGE_DEFAULT if filename is the name of the default image
+    """
+    head, default_filename = os.path.split(DISPLAY_IMAGE_DEFAULT)
+    path = UTILS.get_path_to_original(os.path.join(DISPLAY_IMAGES_FOLDER, filename))
+    if filename == default_filename and not os.path.exists(path):
+        return DISPLAY_IMAGE_DEFAULT
+    return path
+
+class QueuedEmailManager(models.Manager):
+
+    def enqueue(self, subject, message, recipients, from_email = None):
+        """
+        Usage:  QueuedEmail.objects.enqueue(subject, message, recipients, [from_email = None])
+        Before: recipients is a list of email addresses
+        After:  The message has been stored to be sent by the mail queue worker,
+                from DEFAULT_FROM_EMAIL unless from_email is given
+        """
+        self.enqueue_many([(subject, message, recipients, from_email)])
+
+    def enqueue_many(self, messages):
+        """
+        Usage:  QueuedEmail.objects.enqueue_many(messages)
+        Before: messages is a list of (subject, message, recipients, from_email) tuples
+        After:  All of the messages have been stored with a single INSERT
+        """
+        now = datetime.now()
+        bulk_insert(QueuedEmail, [QueuedEmail(subject = subject,
+                                                message = message,
+                                                recipients = u",".join(recipients),
+                                                from_email = from_email or settings.DEFAULT_FROM_EMAIL,
+                                                created = now,
+                                                next_attempt = now)
+                                    for subject, message, recipients, from_email in messages])
+
+    def due(self, now = None):
+        """
+        Usage:  emails = QueuedEmail.objects.due([now = None])
+        After:  emails are the unsent messages that should be tried now and that no
+                worker is sending at the moment
+        """
+        if now is None:
+            now = datetime.now()
+        return self.filter(sent = None, next_attempt__lte = now).filter(
+                    models.Q(claimed_until = None) | models.Q(claimed_until__lt = now))
+
+
+class QueuedEmail(models.Model):
+    """
+    An email waiting to be sent by the mail queue worker
+
+    Data invariant:
+        recipients are the email addresses of the recipients separated by commas
+        sent is the time the message was sent, None until then
+        attempts is the number of failed attempts to send it, last_error describes the last one
+        next_attempt is the earliest time it may be tried again
+        claim and claimed_until identify the worker sending the message and
+            until when other workers must leave it alone
+    """
+    subject = models.CharField(max_length = 255)
+    message = models.TextField()
+    from_email = models.CharField(max_length = 255)
+    recipients = models.TextField()
+
+    created = models.DateTimeField()
+    sent = models.DateTimeField(null = True, blank = True, db_index = True)
+    attempts = models.PositiveIntegerField(default = 0)
+    last_error = models.TextField(blank = True)
+    next_attempt = models.DateTimeField(db_index = True)
+    claim = models.CharField(max_length = 32, blank = True, db_index = True)
+    claimed_until = models.DateTimeField(null = True, blank = True)
+
+    objects = QueuedEmailManager()
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u"%s - %s" % (self.subject, self.recipients)
+
+    def get_recipients(self):
+        return [recipient for recipient in self.recipients.split(u",") if recipient]
+
+def get_tile_source(display_image, size_name):
+    """
+    Usage:  path = get_tile_source(display_image, size_name)
+    After:  path is the path to the size size_name of display_image if it has been built,
+            else to its original, or to the default image if building its sizes failed
+    """
+    if display_image.thumbnail_state == thumbnails.FAILED:
+        head, filename = os.path.split(DISPLAY_IMAGE_DEFAULT)
+    else:
+        head, filename = os.path.split(display_image.display_image.name)
+    if display_image.thumbnail_state != thumbnails.PENDING:
+        path = UTILS.get_path_to_image(size_name, filename)
+        if os.path.exists(path):
+            return path
+    if display_image.id is None or display_image.thumbnail_state == thumbnails.FAILED:
+        return get_original_path(filename)
+    return UTILS.get_path_to_original(display_image.display_image.name)
+
+class SpriteSheetManager(models.Manager):
+
+    def get_for_page(self, page, users):
+        """
+        Usage:  sheet = SpriteSheet.objects.get_for_page(page, users)
+        Before: page names a page listing users, e.g. u"simaskra/2",
+                users is a list or a queryset of users
+        After:  sheet is the sprite sheet of page, which holds the tiles of users
+                Only the tiles of users who were not in the sheet have been drawn, and the tiles
+                of users who are no longer on the page blanked, the others are as they were
+        """
+        user_ids = []
+        seen = set()
+        for user in users:
+            if user.id not in seen:
+                seen.add(user.id)
+                user_ids.append(user.id)
+        sheet, created = self.get_or_create(page = page, defaults = {'count': 0, 'created': datetime.now()})
+        old_count = sheet.count
+        added, freed = sheet.set_users(user_ids)
+        if not os.path.exists(sheet.get_path()):
+            sheet.draw()
+        elif added or freed or sheet.count != old_count:
+            sheet.draw(added, freed)
+        return sheet
+
+
+class SpriteSheet(models.Model):
+    """
+    The display images of the users listed on a page in a single image, so the page
+    loads one image instead of one for every user
+
+    Data invariant:
+        page names the page, so a page keeps its sheet when the users on it change
+        count is at least one more than the index of every SpriteTile of the sheet
+        version is increased every time the image is drawn, so its url changes with it
+
+        The tile of a user is the size DISPLAY_IMAGE_SPRITE_SIZE of the newest display
+        image of the user. Sheets are DISPLAY_IMAGE_SPRITE_COLUMNS tiles wide.
+        The tiles of a user are redrawn in the background by THUMBNAIL_EXECUTOR when
+        a display image of the user is deleted or its sizes are ready.
+
+    Usage:
+        sheet = SpriteSheet.objects.get_for_page(page, users)
+        {% sprite_avatar sheet user [alt] [css_class] %}
+    """
+    page = models.CharField(max_length = 255, unique = True)
+    count = models.PositiveIntegerField()
+    version = models.PositiveIntegerField(default = 0)
+    created = models.DateTimeField()
+
+    objects = SpriteSheetManager()
+
+    def __unicode__(self):
+        return u"%s (%d)" % (self.page, self.count)
+
+    def get_filename(self):
+        return "%s.jpg" % sha1(self.page.encode("utf8")).hexdigest()
+
+    def get_path(self):
+        return UTILS.get_path_to_image(SPRITES_DIRECTORY, self.get_filename())
+
+    def get_url(self):
+        return "%s?v=%d" % (UTILS.get_url_to_image(SPRITES_DIRECTORY, self.get_filename()), self.version)
+
+    def get_tile_size(self):
+        return DISPLAY_IMAGE_SIZE[DISPLAY_IMAGE_SPRITE_SIZE]
+
+    def get_offsets(self):
+        """
+        Usage:  offsets = sheet.get_offsets()
+        After:  offsets maps the id of every user in the sheet to the (x, y) position
+                of the tile of the user. Costs a single query the first time.
+        """
+        if not hasattr(self, '_offsets'):
+            self._offsets = {}
+            for user_id, index in self.tiles.values_list('user', 'index'):
+                self._offsets[user_id] = sprites.get_offset(index, self.get_tile_size(),
+                                                                DISPLAY_IMAGE_SPRITE_COLUMNS)
+        return self._offsets
+
+    def set_users(self, user_ids):
+        """
+        Usage:  (added, freed) = sheet.set_users(user_ids)
+        After:  The sheet has a tile for every user in user_ids and no others. Users who were
+                in the sheet keep their tiles, the others get the lowest indexes not in use.
+                added are the ids of the users who got a tile, freed are the indexes
+                of the tiles that were removed and not given to another user
+                If another request changed the tiles at the same time added and freed are empty,
+                that request draws the tiles
+        """
+        tiles = dict(self.tiles.values_list('user', 'index'))
+        wanted = set(user_ids)
+        removed = [user_id for user_id in tiles if user_id not in wanted]
+        used = set([index for user_id, index in tiles.items() if user_id in wanted])
+        added = [user_id for user_id in user_ids if user_id not in tiles]
+        if not added and not removed:
+            return [], []
+
+        new_tiles = []
+        index = 0
+        for user_id in added:
+            while index in used:
+                index += 1
+            new_tiles.append(SpriteTile(sheet = self, user_id = user_id, index = index))
+            used.add(index)
+        freed = [tiles[user_id] for user_id in removed if tiles[user_id] not in used]
+
+        sid = transaction.savepoint()
+        try:
+            if removed:
+                SpriteTile.objects.filter(sheet = self, user__in = removed).delete()
+            bulk_insert(SpriteTile, new_tiles)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            added, freed = [], []
+        else:
+            transaction.savepoint_commit(sid)
+        if hasattr(self, '_offsets'):
+            del self._offsets
+        self.count = (self.tiles.aggregate(models.Max('index'))['index__max'] or 0) + 1
+        SpriteSheet.objects.filter(id = self.id).update(count = self.count)
+        return added, freed
+
+    def get_draw_args(self, user_ids = None, blank = ()):
+        """
+        Usage:  args = sheet.get_draw_args([user_ids = None, blank = ()])
+        After:  sprites.draw_tiles(*args) draws the tiles of the users with ids in user_ids,
+                or of every user if user_ids is None, with their current display images,
+                and blanks the tiles with indexes in blank, or every unused tile if user_ids is None
+        """
+        tiles = self.tiles.all()
+        if user_ids is not None:
+            tiles = tiles.filter(user__in = list(user_ids))
+        tiles = list(tiles)
+        display_images = DisplayImage.objects.choose_for_users([tile.user_id for tile in tiles], random = False)
+        sources = [(tile.index, get_tile_source(display_images[tile.user_id], DISPLAY_IMAGE_SPRITE_SIZE))
+                    for tile in tiles]
+        count = max([self.count] + [tile.index + 1 for tile in tiles])
+        if user_ids is None:
+            used = set([tile.index for tile in tiles])
+            blank = [index for index in range(count) if index not in used]
+        sources.extend([(index, None) for index in blank])
+        return (self.get_path(), sources, count, self.get_tile_size(),
+                DISPLAY_IMAGE_SPRITE_COLUMNS, DISPLAY_IMAGE_QUALITY)
+
+    def draw(self, user_ids = None, blank = ()):
+        """
+        Usage:  results = sheet.draw([user_ids = None, blank = ()])
+        After:  The tiles described by sheet.get_draw_args(user_ids, blank) have been drawn
+                and the other tiles are unchanged. version has been increased.
+                results is as described in sprites.draw_tiles
+        """
+        results = sprites.draw_tiles(*self.get_draw_args(user_ids, blank))
+        SpriteSheet.objects.filter(id = self.id).update(version = models.F('version') + 1)
+        self.version += 1
+        return results
+
+    def schedule_draw(self, user_ids):
+        """
+        Usage:  sheet.schedule_draw(user_ids)
+        After:  The tiles of the users with ids in user_ids have been handed to THUMBNAIL_EXECUTOR
+                to be drawn in the background, version is increased when they have been
+        """
+        sheet_id = self.id
+        def drawn(results):
+            SpriteSheet.objects.filter(id = sheet_id).update(version = models.F('version') + 1)
+        THUMBNAIL_EXECUTOR.submit(sprites.draw_tiles, self.get_draw_args(user_ids), drawn)
+
+    def delete(self):
+        """
+        Usage:  sheet.delete()
+        After:  sheet has been deleted along with its image
+        """
+        path = self.get_path()
+        directory, filename = os.path.split(path)
+        super(SpriteSheet, self).delete()
+        for path in (path, sprites.get_master_path(path), os.path.join(directory, ".%s.lock" % filename)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class SpriteTile(models.Model):
+    """
+    Data invariant:
+        The tile of user is tile number index in sheet
+    """
+    sheet = models.ForeignKey(SpriteSheet, related_name = "tiles")
+    user = models.ForeignKey(User, related_name = "sprite_tiles")
+    index = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (('sheet', 'index'), ('sheet', 'user'))
+
+
+def set_thumbnail_state(image_id, state, saved_formats = None):
+    """
+    Usage:  set_thumbnail_state(image_id, state, [saved_formats = None])
+    After:  The thumbnail_state of the DisplayImage with id image_id is state, and its
+            saved_formats is saved_formats unless that is None, and the tiles of its user
+            in the sprite sheets are redrawn once the transaction has been committed
+    """
+    values = {'thumbnail_state': state}
+    if saved_formats is not None:
+        values['saved_formats'] = saved_formats
+    DisplayImage.objects.filter(id = image_id).update(**values)
+    users = list(DisplayImage.objects.filter(id = image_id).values_list('user', 'user__username'))
+    invalidate_profiles([username for user_id, username in users])
+    for user_id, username in users:
+        on_commit(lambda user_id = user_id: schedule_sprite_redraw(user_id))
+
 def save_user(sender, instance, created, raw, **kwargs):
     if created:
         profile = controller.get_profile_model().objects.create(user = instance)
 
 def resize_default_image(sender, created_models, verbosity, interactive, **kwargs):
     head, filename = os.path.split(DISPLAY_IMAGE_DEFAULT)
-    try:
-        default_image = Image.open(DISPLAY_IMAGE_DEFAULT)
-    except IOError:
-        #TODO: Notify
-        pass
-    else:
-        for size_name, size in DISPLAY_IMAGE_SIZE.iteritems():
-            directory = os.path.join(settings.MEDIA_ROOT, UTILS.get_directory(size_name))
-            if not os.path.exists(directory):
-                os.mkdir(directory, 0777)
-                os.chmod(directory, 0777) #0777 means that everyone can read, write and execute?
 
-            path = UTILS.get_path_to_image(size_name, filename )
+    missing = [target for target in get_thumbnail_targets(filename) if not os.path.exists(target[2])]
+    if not missing:
+        return
+    #TODO: Notify if some of the sizes could not be saved
+    thumbnails.make_thumbnails(DISPLAY_IMAGE_DEFAULT, missing, DISPLAY_IMAGE_QUALITY)
+resize_default_image = instrumented('resize_default_image')(resize_default_image)
+
+
+def schedule_sprite_redraw(user_id):
+    """
+    Usage:  schedule_sprite_redraw(user_id)
+    After:  The tiles of the user with id user_id in every sprite sheet have been handed
+            to THUMBNAIL_EXECUTOR to be redrawn with the current display image of the user
+    """
+    for sheet in SpriteSheet.objects.filter(tiles__user = user_id).distinct():
+        sheet.schedule_draw([user_id])
+
+def redraw_sprite_tiles(sender, instance, **kwargs):
+    """
+    Redraws the tiles of the user of a display image that was deleted, or saved with
+    its sizes ready, in the background once the transaction has been committed
+    While the sizes are being built the tiles are left alone, set_thumbnail_state
+    redraws them when the job building the sizes finishes
+    """
+    if kwargs.get('signal') is models.signals.post_save and instance.thumbnail_state == thumbnails.PENDING:
+        return
+    user_id = instance.user_id
+    on_commit(lambda: schedule_sprite_redraw(user_id))
+
+#Fields of User that no page shows, saving only them leaves the pages as they were
+UNSHOWN_USER_FIELDS = ('last_login', )
 
-            if not os.path.exists(path):
-                image = default_image.copy()
-                image.thumbnail(size)
-                image.save(path)
+def get_user_values(user):
+    """
+    Usage:  values = get_user_values(user)
+    After:  values maps the attribute names of the fields of User, except UNSHOWN_USER_FIELDS,
+            to their values on user, deferred fields are left out
+    """
+    return dict((field.attname, user.__dict__.get(field.attname)) for field in User._meta.fields
+                    if field.name not in UNSHOWN_USER_FIELDS and field.attname in user.__dict__)
 
+def remember_user_values(sender, instance, **kwargs):
+    """
+    Remembers the values a user was loaded or last saved with, so the signal handlers
+    can tell what a save changes without querying
+    """
+    instance._saved_values = get_user_values(instance)
 
+def invalidate_user_page(sender, instance, **kwargs):
+    """
+    Makes the cached profile page of a user stale when the user changes,
+    under the old username as well if it is being changed
+    Saves that only change UNSHOWN_USER_FIELDS, like the last_login update on every
+    login, leave the page alone
+    """
+    saved_values = getattr(instance, '_saved_values', None)
+    signal = kwargs.get('signal')
+    if signal is not models.signals.post_delete and instance.id is not None and saved_values is not None:
+        if saved_values.get('id') == instance.id and get_user_values(instance) == saved_values:
+            return
+    usernames = [instance.username]
+    if signal is models.signals.pre_save and instance.id is not None:
+        if saved_values is not None and saved_values.get('id') == instance.id:
+            usernames.append(saved_values.get('username'))
+        else:
+            usernames.extend(User.objects.filter(id = instance.id).values_list('username', flat = True))
+    invalidate_profiles(usernames)
+
+def invalidate_profile_page(sender, instance, **kwargs):
+    if isinstance(instance, UserProfile):
+        invalidate_profiles(User.objects.filter(id = instance.user_id).values_list('username', flat = True))
+
+def invalidate_display_image_page(sender, instance, **kwargs):
+    invalidate_profiles(User.objects.filter(id = instance.user_id).values_list('username', flat = True))
+
+def invalidate_website_pages(sender, instance, **kwargs):
+    profiles = controller.get_profile_model().objects.filter(homepages = instance)
+    invalidate_profiles(profiles.values_list('user__username', flat = True))
+
+def index_profile(sender, instance, created, **kwargs):
+    """
+    Rebuilds the search terms of a profile when it is created or a field they
+    are built from has changed
+    """
+    if not isinstance(instance, UserProfile):
+        return
+    indexed_values = search.get_indexed_values(instance, search.PROFILE_FIELDS)
+    if not created and indexed_values == instance._indexed_values:
+        return
+    ProfileSearchTerm.objects.index([(instance.user, instance)])
+    instance._indexed_values = indexed_values
+
+def index_user(sender, instance, created, **kwargs):
+    """
+    Rebuilds the search terms of a user when a field they are built from has changed,
+    not on other saves like the last_login update on every login
+    """
+    if created:
+        #save_user creates the profile, which indexes the user
+        return
+    saved_values = getattr(instance, '_saved_values', None)
+    if saved_values is not None and saved_values.get('id') == instance.id:
+        if search.get_indexed_values(instance, search.USER_FIELDS) == \
+                tuple([saved_values.get(name) for name in search.USER_FIELDS]):
+            return
+    try:
+        profile = controller.get_profile_model().objects.get(user = instance)
+    except ObjectDoesNotExist:
+        profile = None
+    ProfileSearchTerm.objects.index([(instance, profile)])
+
+def invalidate_homepages_pages(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Makes the cached profile pages stale when home pages are added to or removed from profiles
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if isinstance(instance, UserProfile):
+        invalidate_profiles([instance.user.username])
+    elif isinstance(instance, Website):
+        profiles = controller.get_profile_model().objects.all()
+        if pk_set:
+            profiles = profiles.filter(id__in = pk_set)
+        else:
+            profiles = profiles.filter(homepages = instance)
+        invalidate_profiles(profiles.values_list('user__username', flat = True))
 
 
 models.signals.post_save.connect(save_user, sender=User)
 models.signals.post_syncdb.connect(resize_default_image)
+models.signals.post_save.connect(redraw_sprite_tiles, sender=DisplayImage)
+models.signals.post_delete.connect(redraw_sprite_tiles, sender=DisplayImage)
+
+models.signals.pre_save.connect(invalidate_user_page, sender=User)
+models.signals.post_save.connect(invalidate_user_page, sender=User)
+models.signals.post_delete.connect(invalidate_user_page, sender=User)
+models.signals.post_save.connect(invalidate_profile_page)
+models.signals.post_delete.connect(invalidate_profile_page)
+models.signals.post_save.connect(invalidate_display_image_page, sender=DisplayImage)
+models.signals.post_delete.connect(invalidate_display_image_page, sender=DisplayImage)
+models.signals.post_save.connect(invalidate_website_pages, sender=Website)
+models.signals.pre_delete.connect(invalidate_website_pages, sender=Website)
+models.signals.m2m_changed.connect(invalidate_homepages_pages)
+
+models.signals.post_save.connect(index_profile)
+models.signals.post_save.connect(index_user, sender=User)
+
+#Connected last, so the handlers above compare against the values from before the save
+models.signals.post_init.connect(remember_user_values, sender=User)
+models.signals.post_save.connect(remember_user_values, sender=User)
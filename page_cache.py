@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Bookkeeping for the cached profile pages
+
+Every profile has a version, the time it last changed in microseconds, stored in the cache.
+The cached fragments of a profile page and its ETag include the version, so
+removing the version with invalidate_profiles makes them all stale at once.
+The summary of a profile shown in the user area is stored the same way.
+
+The versions only work if every process serving the pages uses the same cache,
+e.g. memcached. With a cache of its own in every process, like the default
+locmem:// backend, a change made in one process leaves the pages of the others stale
+until PROFILE_CACHE_TIMEOUT runs out.
+"""
+
+import time
+from hashlib import md5
+
+from django.core.cache import cache
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import get_script_prefix, get_urlconf
+from django.utils.encoding import smart_str
+
+from user_profile.settings import controller
+
+PROFILE_CACHE_TIMEOUT = getattr(settings, "PROFILE_CACHE_TIMEOUT", 60 * 60 * 24)
+
+def get_version_key(username):
+    return "user_profile.version.%s" % md5(username.encode("utf8")).hexdigest()
+
+def get_profile_version(username):
+    """
+    Usage:  version = get_profile_version(username)
+    After:  version is the time in microseconds the profile of the user username last changed,
+            or None if there is no such profile.
+            Only queries the database if the version is not in the cache.
+    """
+    key = get_version_key(username)
+    version = cache.get(key)
+    if version is None:
+        if not controller.get_profile_model().objects.filter(user__username = username).exists():
+            return None
+        #Microseconds, so a profile changed again within the same second gets a new version
+        version = int(time.time() * 1000000)
+        cache.add(key, version, PROFILE_CACHE_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+def invalidate_profiles(usernames):
+    """
+    Usage:  invalidate_profiles(usernames)
+    After:  The cached pages of the profiles of the users in usernames are stale
+    """
+    cache.delete_many([get_version_key(username) for username in usernames])
+
+def get_summary_key(username, version):
+    #The summary holds the url of the profile, which depends on the script prefix and urlconf
+    where = "%s:%s" % (get_script_prefix(), get_urlconf())
+    return "user_profile.summary.%s.%s.%s" % (md5(username.encode("utf8")).hexdigest(), version,
+                                                md5(smart_str(where)).hexdigest())
+
+def get_profile_summary(user):
+    """
+    Usage:  summary = get_profile_summary(user)
+    Before: user is a logged in user
+    After:  summary is a dictionary with the keys 'logged_in_note', 'show_admin' and 'url'
+            describing user for the user area, read from the cache if the profile of
+            user has not changed since it was stored there
+    """
+    version = get_profile_version(user.username)
+    if version is not None:
+        key = get_summary_key(user.username, version)
+        summary = cache.get(key)
+        if summary is not None:
+            return summary
+
+    try:
+        profile = user.get_profile()
+    except ObjectDoesNotExist:
+        logged_in_note = u""
+        show_admin = user.is_staff
+    else:
+        logged_in_note = profile.get_logged_in_note()
+        in_government = getattr(profile, 'in_government', False)
+        if callable(in_government):
+            in_government = in_government()
+        show_admin = user.is_staff or in_government
+    summary = {'logged_in_note': logged_in_note,
+                'show_admin': bool(show_admin),
+                'url': user.get_absolute_url() }
+    if version is not None:
+        cache.set(key, summary, PROFILE_CACHE_TIMEOUT)
+    return summary
+
+def get_profile_etag(request, username, version, language, today):
+    """
+    Usage:  etag = get_profile_etag(request, username, version, language, today)
+    After:  etag identifies the profile page of username at version as seen by the
+            browsing user in language on the date today
+    """
+    viewer = "%s:%s" % (request.user.id, request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""))
+    return md5(u":".join([username, unicode(version), language, today.isoformat(), viewer]).encode("utf8")).hexdigest()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Resetting the passwords of many users at once
+
+The new passwords are written with one UPDATE statement and their emails are
+added to the mail queue with one INSERT.
+"""
+
+import time
+
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from user_profile.dbutils import bulk_update
+from user_profile.instrumentation import instrumented
+from user_profile.models import QueuedEmail
+from user_profile.utils import password_reset_message
+
+class PasswordResetResult(object):
+    """
+    Data invariant:
+        results is a list of (user, recipients) pairs, where recipients are the
+            email addresses the new password of user was queued for, empty if
+            there was nobody to send it to
+        seconds is the time the reset took
+    """
+    def __init__(self, results, seconds):
+        self.results = results
+        self.seconds = seconds
+
+    def get_sent_count(self):
+        return len([user for user, recipients in self.results if recipients])
+
+
+def hash_password(password):
+    """
+    Usage:  hashed = hash_password(password)
+    After:  hashed is password hashed the way User.set_password does it
+    """
+    user = User()
+    user.set_password(password)
+    return user.password
+
+def reset_passwords(users):
+    """
+    Usage:  result = reset_passwords(users)
+    Before: users is a list of users
+    After:  Every user in users has a new random password which has been queued to
+            be sent to him, or to the administrators if he has no email
+            result is a PasswordResetResult describing what happened
+    """
+    start = time.time()
+    users = list(users)
+    passwords = [User.objects.make_random_password() for user in users]
+    for user, password in zip(users, passwords):
+        user.password = hash_password(password)
+
+    messages = []
+    results = []
+    for user, password in zip(users, passwords):
+        subject, message, recipients = password_reset_message(user, password)
+        if recipients:
+            messages.append((subject, message, recipients, None))
+        results.append((user, recipients))
+    save_passwords(users, messages)
+    return PasswordResetResult(results, time.time() - start)
+reset_passwords = instrumented('reset_passwords')(reset_passwords)
+
+def save_passwords(users, messages):
+    bulk_update(User, ['password'], users)
+    QueuedEmail.objects.enqueue_many(messages)
+save_passwords = transaction.commit_on_success()(save_passwords)
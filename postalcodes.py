@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Lookup tables for Icelandic postal codes, built once when the module is imported
+
+    get_postalcode('101')           -> PostalCode('101', u'Reykjavík')
+    get_postalcodes(u'Reykjavík')   -> ('101', '103', ...)
+"""
+
+from django.contrib.localflavor.is_.is_postalcodes import IS_POSTALCODES
+
+class PostalCode(object):
+    """
+    Data invariant:
+        code is the postal code, e.g. '101'
+        city is the name of the city, e.g. u'Reykjavík'
+        label is the code and the city, e.g. u'101 Reykjavík'
+    """
+    __slots__ = ('code', 'city', 'label')
+
+    def __init__(self, code, city, label):
+        self.code = code
+        self.city = city
+        self.label = label
+
+    def __repr__(self):
+        return "PostalCode(%r, %r)" % (self.code, self.city)
+
+CHOICES = tuple(IS_POSTALCODES)
+
+def build_tables(choices):
+    """
+    Usage:  (by_code, by_city) = build_tables(choices)
+    Before: choices is a sequence of (code, u'code City') pairs
+    After:  by_code maps codes to PostalCode objects, by_city maps cities to tuples of codes
+    """
+    by_code = {}
+    by_city = {}
+    for code, label in choices:
+        postalcode = PostalCode(code, label.split(u" ", 1)[1], label)
+        by_code[code] = postalcode
+        by_city.setdefault(postalcode.city, []).append(code)
+    return by_code, dict((city, tuple(codes)) for city, codes in by_city.iteritems())
+
+BY_CODE, BY_CITY = build_tables(CHOICES)
+CITIES = tuple(sorted(BY_CITY.keys()))
+
+def get_postalcode(code):
+    """
+    Usage:  postalcode = get_postalcode(code)
+    After:  postalcode is the PostalCode with the code code, or None if there is none
+    """
+    return BY_CODE.get(code)
+
+def get_postalcodes(city):
+    """
+    Usage:  codes = get_postalcodes(city)
+    After:  codes is a tuple of the postal codes of city, empty if city is unknown
+    """
+    return BY_CITY.get(city, ())
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Normalization of the terms in the profile search index
+
+Terms and queries are folded the same way, lower case ASCII where the Icelandic
+letters are spelled out, so 'Þórður' is found by 'thordur' as well as 'þórð'.
+"""
+
+import unicodedata
+
+MAX_TERM_LENGTH = 64
+
+FOLDED_LETTERS = {u'þ': u'th', u'ð': u'd', u'æ': u'ae', u'ö': u'o', u'ø': u'o', u'ß': u'ss'}
+
+def fold(text):
+    """
+    Usage:  folded = fold(text)
+    After:  folded is text in lower case with þ, ð and æ spelled out and every
+            accent removed
+    """
+    text = text.lower()
+    for letter, replacement in FOLDED_LETTERS.iteritems():
+        text = text.replace(letter, replacement)
+    decomposed = unicodedata.normalize('NFKD', text)
+    return u"".join([c for c in decomposed if not unicodedata.combining(c)])
+
+def normalize_word(word):
+    """
+    Usage:  term = normalize_word(word)
+    After:  term is the folded word, without dashes and spaces if it is a number
+            such as a kennitala or a phone number
+    """
+    digits = word.replace(u"-", u"").replace(u" ", u"")
+    if digits.isdigit():
+        return digits
+    return fold(word)[:MAX_TERM_LENGTH]
+
+def query_words(query):
+    """
+    Usage:  words = query_words(query)
+    After:  words are the distinct normalized words of query
+    """
+    words = []
+    for word in query.split():
+        word = normalize_word(word)
+        if word and word not in words:
+            words.append(word)
+    return words
+
+#The fields profile_terms reads, the terms only change when one of them does
+USER_FIELDS = ('username', 'first_name', 'last_name', 'email')
+PROFILE_FIELDS = ('middlenames', 'postalcode', 'kennitala', 'phone', 'gsm')
+
+def get_indexed_values(instance, field_names):
+    """
+    Usage:  values = get_indexed_values(instance, field_names)
+    After:  values is a tuple of the values of the fields field_names of instance,
+            None for deferred fields
+    """
+    return tuple([instance.__dict__.get(name) for name in field_names])
+
+def profile_terms(user, profile, city):
+    """
+    Usage:  terms = profile_terms(user, profile, city)
+    Before: profile is the profile of user or None, city is the city of the profile
+    After:  terms is a list of distinct (term, public) pairs to index for user, where
+            public is False for the terms that only staff may search by
+    """
+    public = [user.username, user.first_name, user.last_name]
+    private = [user.email, user.email.split(u"@")[0]]
+    if profile is not None:
+        public.extend([profile.middlenames, profile.postalcode, city])
+        private.extend([profile.kennitala, profile.phone, profile.gsm])
+
+    terms = {}
+    for texts, is_public in ((private, False), (public, True)):
+        for text in texts:
+            if not text:
+                continue
+            if text.replace(u"-", u"").replace(u" ", u"").isdigit():
+                words = [text]
+            else:
+                words = text.split()
+            for word in words:
+                term = normalize_word(word)
+                if term:
+                    terms[term] = is_public or terms.get(term, False)
+    return terms.items()
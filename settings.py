@@ -4,6 +4,14 @@ from django.db.models.loading import get_model
 from django.contrib.auth.models import User
 
 class ProfileController(object):
+    """
+    Data invariant:
+        profile_model is the model named by profile_module, resolved the first time
+            get_profile_model is called with that AUTH_PROFILE_MODULE
+    """
+    def __init__(self):
+        self.profile_module = None
+        self.profile_model = None
         
     def register(self, user_admin,form):
         from user_profile.admin import UserProfileInline
@@ -12,7 +20,12 @@ class ProfileController(object):
         admin.site.register(User, user_admin) 
 
     def get_profile_model(self):
-        appname, modelname = settings.AUTH_PROFILE_MODULE.split(".")
-        return get_model(appname, modelname)
+        profile_module = settings.AUTH_PROFILE_MODULE
+        if self.profile_model is None or self.profile_module != profile_module:
+            appname, modelname = profile_module.split(".")
+            #get_model returns None until the app is loaded, so None is not cached
+            self.profile_model = get_model(appname, modelname)
+            self.profile_module = profile_module
+        return self.profile_model
 
 controller = ProfileController() 
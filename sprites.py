@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""
+Packing display images of one size into sprite sheets
+
+A sheet is a grid of tiles, columns tiles wide, where tile number index is at
+get_offset(index, tile_size, columns). Sheets are redrawn one tile at a time, so
+changing the image of one user does not rebuild the images of the others.
+The tiles are kept in a lossless master beside the sheet, which is only encoded
+for publishing, so tiles that are not redrawn do not lose quality.
+
+PIL is imported by the functions that need it, like in thumbnails.
+"""
+
+import os
+import fcntl
+
+from user_profile import thumbnails
+
+BACKGROUND = (255, 255, 255)
+
+def get_offset(index, tile_size, columns):
+    """
+    Usage:  (x, y) = get_offset(index, tile_size, columns)
+    After:  (x, y) is the top left corner of tile number index in a sheet
+            of tiles of size tile_size, columns tiles wide
+    """
+    width, height = tile_size
+    return (index % columns) * width, (index // columns) * height
+
+def get_sheet_size(count, tile_size, columns):
+    """
+    Usage:  (width, height) = get_sheet_size(count, tile_size, columns)
+    After:  (width, height) is the size of a sheet holding count tiles
+    """
+    width, height = tile_size
+    rows = max((count + columns - 1) // columns, 1)
+    return min(max(count, 1), columns) * width, rows * height
+
+def load_tile(source_path, tile_size):
+    """
+    Usage:  tile = load_tile(source_path, tile_size)
+    After:  tile is an RGB image of size tile_size with the image at source_path,
+            scaled down to fit if it is larger, in its center on a white background
+            Raises IOError if the image can not be read
+    """
+    from PIL import Image
+    image = thumbnails.resize_to_sizes(source_path, {'tile': tile_size})[0][1]
+    tile = Image.new('RGB', tile_size, BACKGROUND)
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    offset = ((tile_size[0] - image.size[0]) // 2, (tile_size[1] - image.size[1]) // 2)
+    tile.paste(image, offset, mask = image.split()[3])
+    return tile
+
+def get_master_path(sheet_path):
+    """
+    Usage:  master_path = get_master_path(sheet_path)
+    After:  master_path is the path to the lossless copy of the sheet at sheet_path
+            the tiles are drawn into, so redrawing a tile does not compress the others again
+    """
+    return "%s.master.png" % os.path.splitext(sheet_path)[0]
+
+def open_sheet(path):
+    from PIL import Image
+    try:
+        sheet = Image.open(path)
+        sheet.load()
+    except (IOError, OSError):
+        return None
+    if sheet.mode != 'RGB':
+        sheet = sheet.convert('RGB')
+    return sheet
+
+def draw_tiles(sheet_path, tiles, count, tile_size, columns, quality = None):
+    """
+    Usage:  results = draw_tiles(sheet_path, tiles, count, tile_size, columns, [quality = None])
+    Before: tiles is a list of (index, source_path) pairs, source_path may be None
+    After:  The sheet at sheet_path holds at least count tiles and the image at source_path has been
+            drawn into tile number index for every pair in tiles, or a blank tile if source_path
+            is None. The other tiles are as they were, or blank if the sheet did not hold them.
+            The tiles are drawn into the lossless copy at get_master_path(sheet_path) and the
+            sheet is saved from it in one step, so it is never read half written
+            Concurrent calls for the same sheet, in this process or others, draw one at a time
+            results is a list of (index, error) pairs, one for each tile, where error is None
+            if drawing that tile succeeded, else a string describing what went wrong
+
+    This function is run by the executors, like thumbnails.make_thumbnails, and must therefore
+    not touch the database and must not raise.
+    """
+    from PIL import Image
+    directory, filename = os.path.split(sheet_path)
+    try:
+        thumbnails.ensure_directory(directory)
+        lock_file = open(os.path.join(directory, ".%s.lock" % filename), "w")
+    except Exception, error:
+        return [(index, unicode(error)) for index, source_path in tiles]
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        master_path = get_master_path(sheet_path)
+        old_sheet = open_sheet(master_path)
+        if old_sheet is None:
+            old_sheet = open_sheet(sheet_path)
+        size = get_sheet_size(count, tile_size, columns)
+        if old_sheet is not None:
+            #Sheets never shrink, so a job drawing with an older count leaves the tiles
+            #a concurrent job added in place
+            size = max(size[0], old_sheet.size[0]), max(size[1], old_sheet.size[1])
+        if old_sheet is not None and old_sheet.size == size:
+            sheet = old_sheet
+        else:
+            #The offset of a tile only depends on its index, so the tiles of a smaller
+            #sheet are where they were
+            sheet = Image.new('RGB', size, BACKGROUND)
+            if old_sheet is not None:
+                sheet.paste(old_sheet, (0, 0))
+
+        results = []
+        for index, source_path in tiles:
+            try:
+                if source_path is None:
+                    tile = Image.new('RGB', tile_size, BACKGROUND)
+                else:
+                    tile = load_tile(source_path, tile_size)
+            except Exception, error:
+                results.append((index, unicode(error)))
+            else:
+                sheet.paste(tile, get_offset(index, tile_size, columns))
+                results.append((index, None))
+
+        try:
+            for path, image_quality in ((master_path, None), (sheet_path, quality)):
+                root, extension = os.path.splitext(path)
+                temporary_path = "%s.%s%s" % (root, os.getpid(), extension)
+                thumbnails.save_variant(sheet, temporary_path, image_quality)
+                os.rename(temporary_path, path)
+        except Exception, error:
+            return [(index, unicode(error)) for index, source_path in tiles]
+        return results
+    finally:
+        lock_file.close()
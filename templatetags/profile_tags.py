@@ -1,12 +1,54 @@
 #! /usr/bin/env python
 # -*- coding: utf8 -*-
 
+from hashlib import md5
+
 from django import template
 from django.contrib.auth.forms import AuthenticationForm
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_script_prefix, get_urlconf
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.encoding import smart_str
+from django.utils.translation import get_language
+from django.conf import settings
+
+from user_profile.page_cache import get_profile_summary
+from user_profile.instrumentation import instrument_tag
 
 register = template.Library()
 
+LOGIN_FORM_CACHE_TIMEOUT = getattr(settings, "LOGIN_FORM_CACHE_TIMEOUT", 60 * 60 * 24)
+
+_urls = {}
+
+def cached_reverse(name):
+    """
+    Usage:  url = cached_reverse(name)
+    After:  url = reverse(name), reversed once for every script prefix and urlconf
+    """
+    key = (get_script_prefix(), get_urlconf(), name)
+    try:
+        return _urls[key]
+    except KeyError:
+        url = _urls[key] = reverse(name)
+        return url
+
+def get_login_fields(next):
+    """
+    Usage:  html = get_login_fields(next)
+    After:  html is the markup of an empty login form redirecting to next, in the
+            current language, rendered once and then read from the cache
+    """
+    key = "user_profile.login_form.%s.%s" % (get_language(), md5(smart_str(next)).hexdigest())
+    html = cache.get(key)
+    if html is None:
+        form = AuthenticationForm(auto_id = "login-form-%s")
+        form.fields['username'].widget.attrs['tabindex'] = 1
+        form.fields['password'].widget.attrs['tabindex'] = 2
+        html = render_to_string('user_profile/forms/login_fields.html', {'form': form, 'next': next})
+        cache.set(key, html, LOGIN_FORM_CACHE_TIMEOUT)
+    return html
+
 def login_or_logout_form(context, next):
     """
     Usage:  {% login_or_logout_form next %}
@@ -16,33 +58,73 @@ def login_or_logout_form(context, next):
     """
     user = context['user']
     request = context['request']
-    login_url = reverse('login')
+    login_url = cached_reverse('login')
 
     if request.path == login_url:
         return {'on_login_page': True }
 
     if next == login_url:
-        next = reverse('index')
+        next = cached_reverse('index')
 
     if not user.is_authenticated():
-        form = AuthenticationForm(auto_id = "login-form-%s")
-        form.fields['username'].widget.attrs['tabindex'] = 1
-        form.fields['password'].widget.attrs['tabindex'] = 2
-        form.id = "login-form"
-        return {'login' : True, 'form' : form , 'next': next}
+        return {'login' : True,
+                'login_url': login_url,
+                'login_fields': get_login_fields(next) }
     else:
-        return {'login': False }
+        return {'login': False, 'logout_url': cached_reverse('logout') }
 register.inclusion_tag('user_profile/login_logout.html', takes_context = True)(login_or_logout_form)
+instrument_tag(register, 'login_or_logout_form')
 
 def user_area(context):
     """
     Usage: {% user_area %}
-    After:  Displays the user area if the user is logged in
+    After:  Displays the user area if the user is logged in, from the cached summary
+            of his profile
     """
     user = context['user']
-    return {'user': user }
+    if not user.is_authenticated():
+        return {'user': user }
+    return {'user': user,
+            'summary': get_profile_summary(user),
+            'change_password_url': cached_reverse('change_password') }
 register.inclusion_tag('user_profile/user_area.html', takes_context = True)(user_area)
+instrument_tag(register, 'user_area')
 
+def display_image_picture(display_image, size_name, alt = u"", css_class = u""):
+    """
+    Usage:  {% display_image_picture display_image size_name [alt] [css_class] %}
+    After:  A <picture> has been displayed with a <source /> for every format in
+            DISPLAY_IMAGE_FORMATS and an <img /> of the size size_name of display_image,
+            the larger sizes are offered to screens with higher pixel densities
+    """
+    srcset, sources = display_image.get_sources(size_name)
+    return {'url': getattr(display_image, size_name).url,
+            'srcset': srcset,
+            'sources': sources,
+            'alt': alt,
+            'css_class': css_class }
+register.inclusion_tag('user_profile/display_image_picture.html')(display_image_picture)
+instrument_tag(register, 'display_image_picture')
 
-
-
+def sprite_avatar(sheet, user, alt = u"", css_class = u""):
+    """
+    Usage:  {% sprite_avatar sheet user [alt] [css_class] %}
+    Before: sheet is a SpriteSheet, e.g. from SpriteSheet.objects.get_for_page
+    After:  The tile of user in sheet has been displayed as the background of a <span>, with
+            its position in the data-sprite-x and data-sprite-y attributes, or nothing
+            if user is not in sheet
+    """
+    position = sheet.get_offsets().get(user.id)
+    if position is None:
+        return {'position': None}
+    width, height = sheet.get_tile_size()
+    return {'position': position,
+            'x': position[0],
+            'y': position[1],
+            'width': width,
+            'height': height,
+            'url': sheet.get_url(),
+            'alt': alt,
+            'css_class': css_class }
+register.inclusion_tag('user_profile/sprite_avatar.html')(sprite_avatar)
+instrument_tag(register, 'sprite_avatar')
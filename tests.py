@@ -1,26 +1,121 @@
 #! /usr/bin/env python
 # -*- coding: utf8 -*-
 
+import os
+import hashlib
+import shutil
+import tempfile
 import unittest
-from datetime import date
+import threading
+from datetime import date, datetime
+from StringIO import StringIO
 
+from PIL import Image
+
+from django.test import TransactionTestCase
 from django.test.client import Client
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import PasswordChangeForm
 from django.core.urlresolvers import reverse
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.forms import ValidationError
+from django.conf import settings
+from django.db import connection, transaction
 
-from mock import Mock 
+from mock import Mock, patch
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from user_profile.models import calculate_age, DisplayImage
+from user_profile.models import calculate_age, parse_bdate, birthday_key, memoized, DisplayImage, DisplayImageManager, QueuedEmail, Website
+from user_profile.models import get_content_name, prefetch_directory
 from user_profile.utils import DisplayImageUtils, DisplayImageLocation, DisplayImageLocationFactory
+from user_profile.dbutils import bulk_insert
+from user_profile import thumbnails, export, search, postalcodes, mailqueue, passwords, instrumentation, sprites
+from user_profile.settings import controller
+
+def count_queries(function, *args, **kwargs):
+    """
+    Usage:  count = count_queries(function, *args, **kwargs)
+    After:  function(*args, **kwargs) has been called and count is the number
+            of queries it ran
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        function(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+        connection.queries = []
 
 class TestCalculateAge(unittest.TestCase):
     def test_get_age(self):
         today = date(2008,10,3)
         self.assertEqual(calculate_age(date(1987,10,22), today), (20, 11, 11))
         self.assertEqual(calculate_age(date(1988,2,29), today), (20, 7, 5))
+
+
+class TestCalculateAges(unittest.TestCase):
+    def setUp(self):
+        if numpy is None:
+            self.skipTest("numpy is not installed")
+        from user_profile import bulk_dates
+        self.bulk_dates = bulk_dates
+
+    def test_same_as_calculate_age(self):
+        births = [date(1987,10,22), date(1988,2,29), date(1990,1,31), date(1999,12,31)]
+        for today in [date(2008,10,3), date(2008,3,1), date(2009,1,1)]:
+            years, months, days = self.bulk_dates.calculate_ages(births, today)
+            self.assertEqual(zip(years.tolist(), months.tolist(), days.tolist()),
+                                [calculate_age(birth, today) for birth in births])
+
+    def test_closest_bday_infos(self):
+        on_bday, past, months, days = self.bulk_dates.closest_bday_infos(
+                                            [date(1987,10,22), date(1987,10,3), date(1987,9,1)],
+                                            date(2008,10,3))
+        self.assertEqual(on_bday.tolist(), [False, True, False])
+        self.assertEqual(past.tolist(), [False, False, True])
+        self.assertEqual(months.tolist(), [0, 0, 1])
+        self.assertEqual(days.tolist(), [19, 0, 2])
+
+
+class TestBirthdate(unittest.TestCase):
+    def test_parse_bdate(self):
+        self.assertEqual(parse_bdate('221087-2919'), date(1987, 10, 22))
+        self.assertEqual(parse_bdate('0101052910'), date(2005, 1, 1))
+
+    def test_birthday_key(self):
+        self.assertEqual(birthday_key(date(1987, 10, 22)), 1022)
+        self.assertEqual(birthday_key(date(1988, 2, 29)), 228)
         
 
+class TestMemoized(unittest.TestCase):
+    def setUp(self):
+        class Person(object):
+            def __init__(self):
+                self.user = Mock(first_name = u'Jón')
+                self.calls = 0
+
+            def greeting(self, punctuation):
+                self.calls += 1
+                return u"Halló %s%s" % (self.user.first_name, punctuation)
+            greeting = memoized('user.first_name')(greeting)
+        self.person = Person()
+
+    def test_cached_until_dependency_changes(self):
+        self.assertEqual(self.person.greeting(u"!"), u"Halló Jón!")
+        self.assertEqual(self.person.greeting(u"!"), u"Halló Jón!")
+        self.assertEqual(self.person.calls, 1)
+        self.person.user.first_name = u'Gunna'
+        self.assertEqual(self.person.greeting(u"!"), u"Halló Gunna!")
+        self.assertEqual(self.person.greeting(u"."), u"Halló Gunna.")
+        self.assertEqual(self.person.calls, 3)
+
+
 class TestDisplayImageUtils(unittest.TestCase):
     def setUp(self):
         self.utils = DisplayImageUtils(media_root = '/var/www/stigull/skrar/',
@@ -86,4 +181,991 @@ class DisplayImageTestCase(unittest.TestCase):
                                                         path = '/var/www/stigull/skrar/myndir/simaskra/small/jthb2.jpg')
         self.assertEqual(location.url, expected_location.url)
         self.assertEqual(location.path, expected_location.path)
-        
\ No newline at end of file
+
+    def test_get_display_image_small_pending(self):
+        display_image = DisplayImage(user = User(username = 'jthb2'),
+                    display_image = "myndir/simaskra/jthb2.jpg",
+                    thumbnail_state = thumbnails.PENDING)
+        location = display_image.small
+        self.assertEqual(location.url, '/skrar/myndir/simaskra/jthb2.jpg')
+        self.assertEqual(location.path, '/var/www/stigull/skrar/myndir/simaskra/jthb2.jpg')
+
+
+class DisplayImageFormatsTestCase(unittest.TestCase):
+    def setUp(self):
+        from user_profile import models
+        self.directory = tempfile.mkdtemp()
+        self.patcher = patch.object(models, 'UTILS', DisplayImageUtils(media_root = self.directory,
+                                                                        media_url = '/skrar/',
+                                                                        display_images_folder = 'myndir'))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def test_only_saved_formats(self):
+        from user_profile.models import get_display_image_formats, get_saved_formats
+        display_image = DisplayImage(user = User(username = 'jthb2'), display_image = "myndir/jthb2.png")
+        self.assertEqual(display_image.small.formats, {})
+        self.assertEqual(get_saved_formats('jthb2.png'), '')
+        for size_name in ('small', 'medium', 'large'):
+            os.makedirs(os.path.join(self.directory, 'myndir', size_name))
+            for format_name in get_display_image_formats():
+                filename = thumbnails.get_variant_filename('jthb2.png', format_name)
+                open(os.path.join(self.directory, 'myndir', size_name, filename), 'w').close()
+        display_image.saved_formats = get_saved_formats('jthb2.png')
+        self.assertEqual(display_image.saved_formats, ",".join(get_display_image_formats()))
+
+        expected = {}
+        for format_name in get_display_image_formats():
+            filename = thumbnails.get_variant_filename('jthb2.png', format_name)
+            expected[format_name] = '/skrar/myndir/small/%s' % filename
+        patcher = patch('os.path.exists', Mock(side_effect = AssertionError("stat")))
+        patcher.start()
+        try:
+            self.assertEqual(display_image.small.formats, expected)
+        finally:
+            patcher.stop()
+
+    def test_formats_recorded(self):
+        from user_profile.models import set_thumbnail_state
+        User.objects.filter(username = 'snid').delete()
+        user = User.objects.create_user('snid', '', 'lykilord')
+        try:
+            bulk_insert(DisplayImage, [DisplayImage(user = user, display_image = "myndir/snid.png",
+                                                    thumbnail_state = thumbnails.PENDING)])
+            display_image = DisplayImage.objects.get(user = user)
+            set_thumbnail_state(display_image.id, thumbnails.READY, 'webp')
+            self.assertEqual(DisplayImage.objects.get(id = display_image.id).saved_formats, 'webp')
+            set_thumbnail_state(display_image.id, thumbnails.READY)
+            self.assertEqual(DisplayImage.objects.get(id = display_image.id).saved_formats, 'webp')
+        finally:
+            user.delete()
+
+
+class RegenerateDisplayImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        from user_profile import models
+        from user_profile.management.commands import regenerate_display_images
+        self.directory = tempfile.mkdtemp()
+        utils = DisplayImageUtils(media_root = self.directory, media_url = '/skrar/', display_images_folder = 'myndir')
+        self.patchers = [patch.object(models, 'UTILS', utils), patch.object(regenerate_display_images, 'UTILS', utils)]
+        for patcher in self.patchers:
+            patcher.start()
+        User.objects.filter(username = 'endurgera').delete()
+        self.user = User.objects.create_user('endurgera', '', 'lykilord')
+
+    def tearDown(self):
+        self.user.delete()
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def test_pending_up_to_date_made_ready(self):
+        from django.core.management import call_command
+        from user_profile.models import get_thumbnail_targets, get_display_image_formats
+        os.makedirs(os.path.join(self.directory, 'myndir'))
+        Image.new('RGB', (150, 168)).save(os.path.join(self.directory, 'myndir', 'endurgera.png'))
+        for size_name, size, path in get_thumbnail_targets('endurgera.png'):
+            thumbnails.ensure_directory(os.path.dirname(path))
+            Image.new('RGB', size).save(path)
+        bulk_insert(DisplayImage, [DisplayImage(user = self.user, display_image = 'myndir/endurgera.png',
+                                                thumbnail_state = thumbnails.PENDING)])
+        call_command('regenerate_display_images', workers = 1, verbosity = 0, stderr = StringIO())
+        display_image = DisplayImage.objects.get(user = self.user)
+        self.assertEqual(display_image.thumbnail_state, thumbnails.READY)
+        self.assertEqual(display_image.saved_formats, ",".join(get_display_image_formats()))
+
+
+class ThumbnailJobTestCase(unittest.TestCase):
+
+    def test_ready_when_all_sizes_succeed(self):
+        on_finish = Mock()
+        job = thumbnails.ThumbnailJob(7, on_finish)
+        job.done([('small', None), ('large', None)])
+        on_finish.assert_called_with(7, thumbnails.READY)
+
+    def test_failed_when_a_size_fails(self):
+        on_finish = Mock()
+        executor = thumbnails.SynchronousExecutor()
+        thumbnails.schedule_thumbnails(executor, 7, '/does/not/exist.jpg',
+                                        [('small', (50, 56), '/tmp/small/exist.jpg')], on_finish)
+        on_finish.assert_called_with(7, thumbnails.FAILED)
+
+    def test_failed_when_pil_raises(self):
+        on_finish = Mock()
+        patcher = patch.object(thumbnails, 'resize_to_sizes', Mock(side_effect = ValueError("bad image")))
+        patcher.start()
+        try:
+            thumbnails.schedule_thumbnails(thumbnails.SynchronousExecutor(), 7, '/tmp/jthb2.jpg',
+                                            [('small', (50, 56), '/tmp/small/jthb2.jpg')], on_finish)
+        finally:
+            patcher.stop()
+        on_finish.assert_called_with(7, thumbnails.FAILED)
+
+    def test_later_jobs_finish_after_callback_raises(self):
+        from django.db import DatabaseError
+        finished = threading.Event()
+        def on_finish(image_id, state):
+            if image_id == 7:
+                raise DatabaseError("database is locked")
+            finished.set()
+        executor = thumbnails.ThreadExecutor(1)
+        patcher = patch.object(thumbnails, 'logger')
+        logger = patcher.start()
+        try:
+            for image_id in (7, 8):
+                thumbnails.schedule_thumbnails(executor, image_id, '/tmp/jthb2.jpg', [], on_finish)
+            finished.wait(10)
+        finally:
+            patcher.stop()
+            executor.get_pool().terminate()
+        self.assertTrue(finished.is_set())
+        self.assertTrue(logger.exception.called)
+
+
+class OnCommitTestCase(unittest.TestCase):
+    def test_called_after_managed_request(self):
+        from django.db import transaction
+        from user_profile.dbutils import on_commit, CommitHooksMiddleware
+        function = Mock()
+        middleware = CommitHooksMiddleware()
+        middleware.process_request(None)
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            on_commit(function)
+            self.assertFalse(function.called)
+        finally:
+            transaction.leave_transaction_management()
+        middleware.process_response(None, {})
+        self.assertEqual(function.call_count, 1)
+
+    def test_called_at_once_outside_transactions(self):
+        from user_profile.dbutils import on_commit
+        function = Mock()
+        on_commit(function)
+        self.assertEqual(function.call_count, 1)
+
+
+class ResizeToSizesTestCase(unittest.TestCase):
+
+    def test_largest_first_and_fits(self):
+        source = StringIO()
+        Image.new('RGB', (1500, 1680)).save(source, 'JPEG')
+        source.seek(0)
+        images = thumbnails.resize_to_sizes(source, {'small': (50, 56),
+                                                    'medium': (75, 84),
+                                                    'large': (150, 168)})
+        self.assertEqual([(size_name, image.size) for size_name, image in images],
+                            [('large', (150, 168)), ('medium', (75, 84)), ('small', (50, 56))])
+
+    def test_sizes_of_source(self):
+        for size in [(1500, 1680), (1200, 1344), (640, 480), (100, 112)]:
+            source = StringIO()
+            Image.new('RGB', size).save(source, 'JPEG')
+            expected = []
+            for box in [(150, 168), (75, 84), (50, 56)]:
+                image = Image.new('RGB', size)
+                image.thumbnail(box)
+                expected.append(image.size)
+            source.seek(0)
+            images = thumbnails.resize_to_sizes(source, {'small': (50, 56),
+                                                        'medium': (75, 84),
+                                                        'large': (150, 168)})
+            self.assertEqual([image.size for size_name, image in images], expected)
+
+
+class MakeThumbnailsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.directory, 'jthb2.png')
+        Image.new('RGBA', (150, 168), (255, 0, 0, 128)).save(self.source_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_one_size_in_several_formats(self):
+        formats = thumbnails.supported_formats(['webp', 'jpeg'])
+        targets = [('small', (50, 56), os.path.join(self.directory, 'small', 'jthb2.png'))]
+        for format_name in formats:
+            filename = thumbnails.get_variant_filename('jthb2.png', format_name)
+            targets.append(('small', (50, 56), os.path.join(self.directory, 'small', filename)))
+        results = thumbnails.make_thumbnails(self.source_path, targets)
+        self.assertEqual(results, [('small', None)] * len(targets))
+        for size_name, size, path in targets:
+            self.assertEqual(Image.open(path).size, (50, 56))
+        if 'jpeg' in formats:
+            jpeg = Image.open(os.path.join(self.directory, 'small', 'jthb2.jpg'))
+            self.assertEqual((jpeg.format, jpeg.mode), ('JPEG', 'RGB'))
+
+
+class VariantCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.media_root, 'jthb2.jpg')
+        Image.new('RGB', (1500, 1680)).save(self.source_path)
+        self.utils = DisplayImageUtils(media_root = self.media_root,
+                                    media_url = '/skrar',
+                                    display_images_folder = '')
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_builds_missing_size(self):
+        cache = thumbnails.VariantCache(self.utils, {'small': (50, 56)})
+        path = cache.get('small', 'jthb2.jpg', self.source_path)
+        self.assertEqual(path, self.utils.get_path_to_image('small', 'jthb2.jpg'))
+        self.assertEqual(Image.open(path).size, (50, 56))
+
+    def test_locks_bounded(self):
+        cache = thumbnails.VariantCache(self.utils, {'small': (50, 56)})
+        for name in ['first.jpg', 'other.jpg']:
+            shutil.copy(self.source_path, os.path.join(self.media_root, name))
+            cache.get('small', name, os.path.join(self.media_root, name))
+        self.assertEqual(len(cache.locks), thumbnails.LOCK_STRIPES)
+        directory = os.path.dirname(self.utils.get_path_to_image('small', 'jthb2.jpg'))
+        self.assertEqual(sorted([name for name in os.listdir(directory) if name.startswith('.')]), ['.lock'])
+
+    def test_evicts_least_recently_used(self):
+        cache = thumbnails.VariantCache(self.utils, {'small': (50, 56)}, max_bytes = 1)
+        first = cache.get('small', 'jthb2.jpg', self.source_path)
+        shutil.copy(self.source_path, os.path.join(self.media_root, 'other.jpg'))
+        second = cache.get('small', 'other.jpg', os.path.join(self.media_root, 'other.jpg'))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+
+class ChooseForUsersTestCase(unittest.TestCase):
+
+    def test_newest_image_or_default(self):
+        images = [DisplayImage(id = 3, user_id = 1, display_image = "myndir/simaskra/nyjust.jpg"),
+                    DisplayImage(id = 2, user_id = 1, display_image = "myndir/simaskra/eldri.jpg")]
+        queryset = Mock()
+        queryset.order_by.return_value = images
+        filter = Mock(return_value = queryset)
+        patcher = patch.object(DisplayImageManager, 'filter', filter)
+        patcher.start()
+        try:
+            display_images = DisplayImage.objects.choose_for_users([1, 2], random = False)
+        finally:
+            patcher.stop()
+        filter.assert_called_once_with(user__in = [1, 2])
+        self.assertEqual(display_images[1].id, 3)
+        self.assertEqual(display_images[2].id, None)
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.record = dict((field, u'') for field in export.FIELDS)
+        self.record.update({'username': u'jthb2', 'first_name': u'Jón', 'last_name': u'Þórsson',
+                            'fullname': u'Jón Þórsson', 'gsm': u'8991234',
+                            'homepages': [u'http://stigull.hi.is/']})
+
+    def test_csv_lines(self):
+        lines = list(export.csv_lines([self.record]))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('username,first_name'))
+        self.assertTrue(lines[1].startswith('jthb2,J\xc3\xb3n,'))
+
+    def test_vcard_lines(self):
+        vcard = list(export.vcard_lines([self.record]))[0].decode("utf8")
+        self.assertTrue(u"N:Þórsson;Jón;;;\r\n" in vcard)
+        self.assertTrue(u"TEL;TYPE=CELL:8991234\r\n" in vcard)
+        self.assertTrue(u"URL:http://stigull.hi.is/\r\n" in vcard)
+        self.assertFalse(u"TEL;TYPE=HOME" in vcard)
+
+
+class ProfileImportFormTestCase(unittest.TestCase):
+
+    def test_uses_profile_field_rules(self):
+        from user_profile.forms import ProfileImportForm
+        form = ProfileImportForm({'username': u'jthb2', 'kennitala': u'2210872919',
+                                    'gsm': u'899-1234', 'postalcode': u'101',
+                                    'homepages': u'http://stigull.hi.is/ http://hi.is/'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['kennitala'], u'221087-2919')
+        self.assertEqual(form.cleaned_data['homepages'], [u'http://stigull.hi.is/', u'http://hi.is/'])
+
+        form = ProfileImportForm({'username': u'jthb2', 'kennitala': u'2210872819', 'postalcode': u'999'})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('kennitala' in form.errors)
+        self.assertTrue('postalcode' in form.errors)
+
+
+class ImportProfilesTestCase(TransactionTestCase):
+    def setUp(self):
+        super(ImportProfilesTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'notendur.csv')
+        stream = open(self.path, 'wb')
+        stream.write("username,first_name,last_name,kennitala,homepages\n"
+                    "innflutt,J\xc3\xb3n,J\xc3\xb3nsson,2210872919,http://innflutt.example.com/\n")
+        stream.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        User.objects.filter(username = 'innflutt').delete()
+
+    def test_rows_committed(self):
+        from django.core.management import call_command
+        from django.db import transaction
+        stdout = StringIO()
+        patcher = patch('sys.stdout', stdout)
+        patcher.start()
+        try:
+            call_command('import_profiles', self.path)
+        finally:
+            patcher.stop()
+        #What was not committed is lost when the connection is rolled back or closed
+        transaction.rollback_unless_managed()
+        user = User.objects.get(username = 'innflutt')
+        self.assertEqual(user.first_name, u'Jón')
+        profile = user.get_profile()
+        self.assertEqual(profile.birthdate, date(1987, 10, 22))
+        self.assertEqual([website.url for website in profile.homepages.all()], [u'http://innflutt.example.com/'])
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def test_fold(self):
+        self.assertEqual(search.fold(u'Þórður Æsa Öndólfsdóttir'), u'thordur aesa ondolfsdottir')
+
+    def test_query_words(self):
+        self.assertEqual(search.query_words(u'221087-2919 Þórð þórð'), [u'2210872919', u'thord'])
+
+    def test_profile_terms(self):
+        user = User(username = u'jthb2', first_name = u'Jón', last_name = u'Þórsson', email = u'jthb2@hi.is')
+        profile = Mock(middlenames = u'', postalcode = u'101', kennitala = u'221087-2919',
+                        phone = u'', gsm = u'8991234')
+        terms = dict(search.profile_terms(user, profile, u'Reykjavík'))
+        self.assertEqual(terms[u'jon'], True)
+        self.assertEqual(terms[u'thorsson'], True)
+        self.assertEqual(terms[u'reykjavik'], True)
+        self.assertEqual(terms[u'2210872919'], False)
+        self.assertEqual(terms[u'8991234'], False)
+
+
+class PostalCodesTestCase(unittest.TestCase):
+
+    def test_get_postalcode(self):
+        postalcode = postalcodes.get_postalcode('101')
+        self.assertEqual(postalcode.city, u'Reykjavík')
+        self.assertEqual(postalcode.label, u'101 Reykjavík')
+        self.assertEqual(postalcodes.get_postalcode('999'), None)
+
+    def test_get_postalcodes(self):
+        self.assertEqual(postalcodes.get_postalcodes(u'Höfn í Hornafirði'), ('780', '781'))
+        self.assertTrue('101' in postalcodes.get_postalcodes(u'Reykjavík'))
+        self.assertEqual(postalcodes.get_postalcodes(u'Atlantis'), ())
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        QueuedEmail.objects.all().delete()
+        mail.outbox = []
+
+    def test_send_queued(self):
+        QueuedEmail.objects.enqueue_many([(u"Nýtt lykilorð", u"abc", [u"jon@example.com"], None),
+                                            (u"Nýtt lykilorð", u"def", [u"a@example.com", u"b@example.com"], None)])
+        self.assertEqual(mailqueue.send_queued(batch_size = 1), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].to, [u"a@example.com", u"b@example.com"])
+        self.assertEqual(QueuedEmail.objects.due().count(), 0)
+        self.assertEqual(mailqueue.send_queued(), (0, 0))
+
+    def test_reset_password_committed(self):
+        from django.db import transaction
+        from user_profile.utils import reset_password
+        User.objects.filter(username = 'gleyminn').delete()
+        user = User.objects.create_user('gleyminn', 'gleyminn@example.com', 'gamalt')
+        patcher = patch('user_profile.utils.render_to_string', Mock(return_value = u"Nýtt lykilorð"))
+        patcher.start()
+        try:
+            reset_password(user)
+        finally:
+            patcher.stop()
+        transaction.rollback_unless_managed()
+        try:
+            self.assertEqual([email.get_recipients() for email in QueuedEmail.objects.all()],
+                                [[u'gleyminn@example.com']])
+            self.assertFalse(User.objects.get(id = user.id).check_password('gamalt'))
+        finally:
+            user.delete()
+
+
+class ResetPasswordsTestCase(unittest.TestCase):
+    def setUp(self):
+        User.objects.filter(username__in = ['reset1', 'reset2']).delete()
+        QueuedEmail.objects.all().delete()
+        self.users = [User.objects.create_user('reset1', 'reset1@example.com', 'gamalt'),
+                        User.objects.create_user('reset2', '', 'gamalt')]
+
+    def tearDown(self):
+        for user in self.users:
+            user.delete()
+
+    def test_hash_password(self):
+        user = User(password = passwords.hash_password(u'nýtt'))
+        self.assertTrue(user.check_password(u'nýtt'))
+
+    def test_reset_passwords(self):
+        patcher = patch('user_profile.utils.render_to_string', Mock(return_value = u"Nýtt lykilorð"))
+        patcher.start()
+        try:
+            result = passwords.reset_passwords(User.objects.filter(username__in = ['reset1', 'reset2']))
+        finally:
+            patcher.stop()
+        transaction.rollback_unless_managed()
+        self.assertEqual(len(result.results), 2)
+        for user in self.users:
+            self.assertFalse(User.objects.get(id = user.id).check_password('gamalt'))
+        recipients = dict((user.username, recipients) for user, recipients in result.results)
+        self.assertEqual(recipients['reset1'], ['reset1@example.com'])
+        self.assertEqual(QueuedEmail.objects.count(), result.get_sent_count())
+
+
+    def test_action_confirmed_first(self):
+        from user_profile import admin
+        patchers = [patch.object(admin, 'render_to_response'), patch.object(admin, 'reset_passwords')]
+        render_to_response, reset_passwords = [patcher.start() for patcher in patchers]
+        try:
+            queryset = User.objects.filter(username__in = ['reset1', 'reset2'])
+            admin.reset_selected_passwords(Mock(model = User), Mock(POST = {}), queryset)
+            self.assertFalse(reset_passwords.called)
+            self.assertEqual(render_to_response.call_args[0][0], 'user_profile/admin/reset_passwords_confirmation.html')
+            admin.reset_selected_passwords(Mock(model = User), Mock(POST = {'post': 'yes'}), queryset)
+            reset_passwords.assert_called_with(queryset)
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+
+
+class ImageHeaderFieldTestCase(unittest.TestCase):
+    def setUp(self):
+        from user_profile.forms import ImageHeaderField
+        self.field_class = ImageHeaderField
+
+    def get_upload(self, size):
+        data = StringIO()
+        Image.new('RGB', size).save(data, 'PNG')
+        return SimpleUploadedFile('mynd.png', data.getvalue(), 'image/png')
+
+    def test_header(self):
+        field = self.field_class(max_pixels = 100 * 100)
+        file = field.clean(self.get_upload((100, 50)))
+        self.assertEqual((file.image_header.format, file.image_header.width, file.image_header.height),
+                            ('PNG', 100, 50))
+        self.assertEqual(file.tell(), 0)
+
+    def test_limits(self):
+        self.assertRaises(ValidationError, self.field_class(max_pixels = 100 * 100).clean,
+                            self.get_upload((101, 100)))
+        self.assertRaises(ValidationError, self.field_class(max_bytes = 10).clean,
+                            self.get_upload((10, 10)))
+        self.assertRaises(ValidationError, self.field_class().clean,
+                            SimpleUploadedFile('mynd.png', 'ekki mynd', 'image/png'))
+
+    def test_decompression_bomb(self):
+        from PIL import Image
+        patcher = patch.object(thumbnails, 'read_image_header',
+                                Mock(side_effect = Image.DecompressionBombError("of margir pixlar")))
+        patcher.start()
+        try:
+            field = self.field_class(max_pixels = 2 * 1000 * 1000)
+            try:
+                field.clean(self.get_upload((10, 10)))
+            except ValidationError, error:
+                self.assertEqual(error.messages, [field.error_messages['too_many_pixels'] % {'max': 2}])
+            else:
+                self.fail("The image was accepted")
+        finally:
+            patcher.stop()
+
+
+class ContentNameTestCase(unittest.TestCase):
+    def test_same_contents_same_name(self):
+        first = SimpleUploadedFile('mynd.JPG', 'sama efni')
+        second = SimpleUploadedFile('onnur.JPG', 'sama efni')
+        self.assertEqual(get_content_name(first, first.name), get_content_name(second, second.name))
+        self.assertEqual(get_content_name(first, first.name), '%s.jpg' % hashlib.sha1('sama efni').hexdigest())
+        self.assertEqual(first.read(), 'sama efni')
+
+    def test_extension_from_header(self):
+        upload = SimpleUploadedFile('mynd.jpg', 'efni')
+        upload.image_header = thumbnails.ImageHeader('PNG', 10, 10)
+        self.assertTrue(get_content_name(upload, upload.name).endswith('.png'))
+
+
+class LoginFieldsTestCase(unittest.TestCase):
+    def test_rendered_once(self):
+        from user_profile.templatetags import profile_tags
+        next = u'/notendur/jthb2/?a=%s' % os.getpid()
+        html = profile_tags.get_login_fields(next)
+        self.assertTrue(u'name="next" value="%s"' % next in html)
+        patcher = patch.object(profile_tags, 'render_to_string')
+        render_to_string = patcher.start()
+        try:
+            self.assertEqual(profile_tags.get_login_fields(next), html)
+        finally:
+            patcher.stop()
+        self.assertFalse(render_to_string.called)
+
+    def test_login_form(self):
+        from django.contrib.auth.models import AnonymousUser
+        from user_profile.templatetags.profile_tags import login_or_logout_form
+        context = {'user': AnonymousUser(), 'request': Mock(path = '/')}
+        result = login_or_logout_form(context, '/notendur/')
+        self.assertEqual(result['login_url'], reverse('login'))
+        self.assertTrue(u'name="next" value="/notendur/"' in result['login_fields'])
+        result = login_or_logout_form({'user': AnonymousUser(), 'request': Mock(path = reverse('login'))},
+                                        reverse('login'))
+        self.assertEqual(result, {'on_login_page': True})
+
+    def test_reverse_per_script_prefix(self):
+        from django.core.urlresolvers import set_script_prefix
+        from user_profile.templatetags.profile_tags import cached_reverse
+        try:
+            set_script_prefix('/stigull/')
+            self.assertEqual(cached_reverse('login'), '/stigull' + reverse('login', prefix = '/'))
+            set_script_prefix('/')
+            self.assertEqual(cached_reverse('login'), reverse('login'))
+        finally:
+            set_script_prefix('/')
+
+
+class UserAreaTestCase(unittest.TestCase):
+    def setUp(self):
+        User.objects.filter(username = 'eigandi').delete()
+        self.user = User.objects.create_user('eigandi', '', 'lykilord')
+        self.user.first_name = u'Anna'
+        self.user.last_name = u'Jónsdóttir'
+        self.user.save()
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_summary_cached(self):
+        from django.contrib.auth.models import AnonymousUser
+        from user_profile.templatetags.profile_tags import user_area
+        result = user_area({'user': self.user})
+        self.assertEqual(result['summary']['url'], self.user.get_absolute_url())
+        self.assertTrue(u'Anna Jónsdóttir' in result['summary']['logged_in_note'])
+        self.assertEqual(result['change_password_url'], reverse('change_password'))
+        user = User.objects.get(id = self.user.id)
+        self.assertEqual(count_queries(user_area, {'user': user}), 0)
+        self.assertFalse('summary' in user_area({'user': AnonymousUser()}))
+
+
+class ResetPasswordWrapperTestCase(unittest.TestCase):
+    def setUp(self):
+        import sys
+        import types
+        class ResetPasswordWrapper(object):
+            def __init__(self, user):
+                self.user = user
+            def get_subject(self):
+                return u'Nýtt lykilorð'
+        self.wrapper_class = ResetPasswordWrapper
+        emails = types.ModuleType('user_profile.emails')
+        emails.ResetPasswordWrapper = ResetPasswordWrapper
+        self.patcher = patch.dict(sys.modules, {'user_profile.emails': emails})
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_alias_in_utils(self):
+        from user_profile import utils
+        wrapper = utils.ResetPasswordWrapper('user')
+        self.assertTrue(type(wrapper) is self.wrapper_class)
+        self.assertEqual(wrapper.user, 'user')
+        self.assertTrue(isinstance(wrapper, utils.ResetPasswordWrapper))
+        self.assertFalse(isinstance('user', utils.ResetPasswordWrapper))
+
+    def test_subclass_in_utils(self):
+        from user_profile import utils
+        class Wrapper(utils.ResetPasswordWrapper):
+            def get_subject(self):
+                return u'Annað efni'
+        wrapper = Wrapper('user')
+        self.assertTrue(issubclass(Wrapper, self.wrapper_class))
+        self.assertTrue(issubclass(Wrapper, utils.ResetPasswordWrapper))
+        self.assertTrue(isinstance(wrapper, utils.ResetPasswordWrapper))
+        self.assertEqual((wrapper.user, wrapper.get_subject()), ('user', u'Annað efni'))
+
+
+class ProfileControllerTestCase(unittest.TestCase):
+    def test_model_resolved_once(self):
+        from user_profile.settings import ProfileController
+        controller = ProfileController()
+        get_model = Mock(return_value = DisplayImage)
+        patcher = patch('user_profile.settings.get_model', get_model)
+        patcher.start()
+        try:
+            self.assertEqual(controller.get_profile_model(), DisplayImage)
+            self.assertEqual(controller.get_profile_model(), DisplayImage)
+        finally:
+            patcher.stop()
+        self.assertEqual(get_model.call_count, 1)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def test_disabled_leaves_function(self):
+        patcher = patch.object(instrumentation, 'PROFILE_INSTRUMENTATION', False)
+        patcher.start()
+        try:
+            self.assertTrue(instrumentation.instrumented('thumbnails')(thumbnails.area) is thumbnails.area)
+        finally:
+            patcher.stop()
+
+    def test_spans_sent_and_summarized(self):
+        patcher = patch.object(instrumentation, 'PROFILE_INSTRUMENTATION', True)
+        patcher.start()
+        received = []
+        def receiver(sender, name, seconds, queries, **kwargs):
+            received.append(name)
+        instrumentation.span_finished.connect(receiver)
+        try:
+            area = instrumentation.instrumented('area')(thumbnails.area)
+            middleware = instrumentation.InstrumentationMiddleware()
+            middleware.process_request(None)
+            self.assertEqual(area((2, 3)), 6)
+            area((1, 1))
+            response = middleware.process_response(None, {})
+        finally:
+            instrumentation.span_finished.disconnect(receiver)
+            patcher.stop()
+        self.assertEqual(received, ['area', 'area'])
+        self.assertEqual(area.__name__, 'area')
+        self.assertTrue(response['Server-Timing'].startswith('area;dur='))
+        self.assertTrue('2 calls' in response['Server-Timing'])
+
+
+class SpritesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sheet_path = os.path.join(self.directory, 'sprites', 'sheet.jpg')
+        self.sources = []
+        for color in ['red', 'green', 'blue']:
+            path = os.path.join(self.directory, '%s.png' % color)
+            Image.new('RGB', (150, 168), color).save(path)
+            self.sources.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def color_at(self, index):
+        x, y = sprites.get_offset(index, (50, 56), 2)
+        return Image.open(self.sheet_path).convert('RGB').getpixel((x + 25, y + 28))
+
+    def test_offsets(self):
+        self.assertEqual(sprites.get_offset(3, (50, 56), 2), (50, 56))
+        self.assertEqual(sprites.get_sheet_size(3, (50, 56), 2), (100, 112))
+        self.assertEqual(sprites.get_sheet_size(1, (50, 56), 20), (50, 56))
+
+    def test_redraw_one_tile(self):
+        results = sprites.draw_tiles(self.sheet_path, list(enumerate(self.sources)), 3, (50, 56), 2)
+        self.assertEqual(results, [(0, None), (1, None), (2, None)])
+        self.assertEqual(Image.open(self.sheet_path).size, (100, 112))
+        results = sprites.draw_tiles(self.sheet_path, [(1, self.sources[2]), (2, 'engin-mynd.png')], 3, (50, 56), 2)
+        self.assertEqual(results[0], (1, None))
+        self.assertNotEqual(results[1][1], None)
+        red, green, blue = self.color_at(0), self.color_at(1), self.color_at(2)
+        self.assertTrue(red[0] > 200 and red[2] < 50)
+        self.assertTrue(green[2] > 200 and green[0] < 50)
+        self.assertTrue(blue[2] > 200 and blue[0] < 50)
+
+    def test_master_is_lossless(self):
+        noise = os.path.join(self.directory, 'noise.png')
+        Image.effect_noise((150, 168), 60).convert('RGB').save(noise)
+        sprites.draw_tiles(self.sheet_path, [(0, noise), (1, self.sources[0])], 2, (50, 56), 2)
+        master_path = sprites.get_master_path(self.sheet_path)
+        tile = Image.open(master_path).crop((0, 0, 50, 56)).tobytes()
+        for i in range(3):
+            sprites.draw_tiles(self.sheet_path, [(1, self.sources[i])], 2, (50, 56), 2)
+        self.assertEqual(Image.open(master_path).crop((0, 0, 50, 56)).tobytes(), tile)
+
+    def test_grow_and_blank(self):
+        sprites.draw_tiles(self.sheet_path, list(enumerate(self.sources)), 3, (50, 56), 2)
+        sprites.draw_tiles(self.sheet_path, [(3, self.sources[1])], 4, (50, 56), 2)
+        self.assertTrue(self.color_at(0)[0] > 200 and self.color_at(3)[1] > 100)
+        sprites.draw_tiles(self.sheet_path, [(0, None)], 1, (50, 56), 2)
+        self.assertEqual(Image.open(self.sheet_path).size, (100, 112))
+        self.assertTrue(min(self.color_at(0)) > 200)
+        self.assertTrue(self.color_at(2)[2] > 200)
+
+
+class SpriteSheetTestCase(unittest.TestCase):
+    def setUp(self):
+        from user_profile import models
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'myndir'))
+        self.patcher = patch.object(models, 'UTILS', DisplayImageUtils(media_root = self.directory,
+                                                                        media_url = '/skrar/',
+                                                                        display_images_folder = 'myndir'))
+        self.patcher.start()
+        User.objects.filter(username__startswith = 'sprite').delete()
+        self.users = [User.objects.create_user('sprite%d' % i, '', 'lykilord') for i in range(3)]
+
+    def tearDown(self):
+        from user_profile.models import SpriteSheet
+        SpriteSheet.objects.all().delete()
+        for user in self.users:
+            user.delete()
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def test_get_for_page(self):
+        from user_profile.models import SpriteSheet
+        sheet = SpriteSheet.objects.get_for_page(u'simaskra/1', self.users[:2])
+        self.assertTrue(os.path.exists(sheet.get_path()))
+        self.assertEqual(sheet.version, 1)
+        self.assertEqual(sheet.get_offsets(), {self.users[0].id: (0, 0), self.users[1].id: (50, 0)})
+        self.assertTrue(sheet.get_url().startswith('/skrar/myndir/sprites/'))
+        same = SpriteSheet.objects.get_for_page(u'simaskra/1', reversed(self.users[:2]))
+        self.assertEqual((same.id, same.version), (sheet.id, 1))
+
+    def test_users_change(self):
+        from user_profile.models import SpriteSheet
+        sheet = SpriteSheet.objects.get_for_page(u'simaskra/1', self.users[:2])
+        self.assertEqual(sheet.set_users([self.users[1].id, self.users[2].id]), ([self.users[2].id], []))
+        self.assertEqual(sheet.get_offsets(), {self.users[2].id: (0, 0), self.users[1].id: (50, 0)})
+        self.assertEqual(sheet.set_users([self.users[1].id]), ([], [0]))
+        sheet = SpriteSheet.objects.get_for_page(u'simaskra/1', self.users[:1])
+        self.assertEqual(SpriteSheet.objects.count(), 1)
+        self.assertEqual(sheet.version, 2)
+        self.assertEqual(sheet.get_offsets(), {self.users[0].id: (0, 0)})
+
+    def test_concurrent_change(self):
+        from django.db import IntegrityError
+        from user_profile import models
+        sheet = models.SpriteSheet.objects.get_for_page(u'simaskra/1', self.users[:1])
+        patcher = patch.object(models, 'bulk_insert', Mock(side_effect = IntegrityError))
+        patcher.start()
+        try:
+            self.assertEqual(sheet.set_users([user.id for user in self.users]), ([], []))
+        finally:
+            patcher.stop()
+        self.assertEqual(sheet.get_offsets(), {self.users[0].id: (0, 0)})
+
+    def test_redrawn_when_ready(self):
+        from django.db.models import signals
+        from user_profile import models
+        sheet = models.SpriteSheet.objects.get_for_page(u'simaskra/1', self.users[:2])
+        display_image = DisplayImage(user = self.users[1], display_image = "myndir/mynd.png",
+                                        thumbnail_state = thumbnails.PENDING)
+        bulk_insert(DisplayImage, [display_image])
+        display_image = DisplayImage.objects.get(user = self.users[1])
+        patcher = patch.object(models, 'THUMBNAIL_EXECUTOR')
+        executor = patcher.start()
+        try:
+            models.redraw_sprite_tiles(DisplayImage, display_image, signal = signals.post_save)
+            self.assertFalse(executor.submit.called)
+            models.set_thumbnail_state(display_image.id, thumbnails.READY)
+            self.assertEqual(executor.submit.call_count, 1)
+            function, args, callback = executor.submit.call_args[0]
+            self.assertEqual(function, sprites.draw_tiles)
+            self.assertEqual(args[1], [(1, os.path.join(self.directory, 'myndir', 'mynd.png'))])
+            callback([(1, None)])
+            self.assertEqual(models.SpriteSheet.objects.get(id = sheet.id).version, 2)
+        finally:
+            patcher.stop()
+        display_image.delete()
+
+
+class DirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        User.objects.filter(username__startswith = 'skra').delete()
+        self.users = [User.objects.create_user('skra%d' % i, '', 'lykilord') for i in range(3)]
+        self.ProfileModel = controller.get_profile_model()
+
+    def tearDown(self):
+        for user in self.users:
+            user.delete()
+
+    def test_display_image_honors_random(self):
+        profiles = list(self.ProfileModel.objects.filter(user__in = self.users))
+        prefetch_directory(profiles, random = False)
+        self.assertEqual(count_queries(profiles[0].display_image, random = False), 0)
+        self.assertEqual(count_queries(profiles[0].display_image, random = True), 1)
+
+    def test_for_directory_queries(self):
+        website = Website.objects.create(url = 'http://skra.example.com/', name = 'skra')
+        self.users[0].get_profile().homepages.add(website)
+        profiles = self.ProfileModel.objects.for_directory().filter(user__in = self.users)
+        def read_directory():
+            for profile in profiles:
+                profile.user.username
+                profile.display_image()
+                profile.has_homepages()
+                list(profile.get_homepages())
+        try:
+            self.assertEqual(count_queries(read_directory), 3)
+        finally:
+            website.delete()
+
+    def test_changelist_profiles_queries(self):
+        from user_profile.admin import UserWithProfileAdmin, attach_profiles
+        self.users[2].get_profile().delete()
+        users = list(User.objects.filter(id__in = [user.id for user in self.users]))
+        self.assertEqual(count_queries(attach_profiles, users), 1)
+        columns = [column for column in UserWithProfileAdmin.list_display if callable(column)]
+        def read_columns():
+            for user in users:
+                for column in columns:
+                    column(user)
+        self.assertEqual(count_queries(read_columns), 0)
+
+
+class BirthdaysTestCase(unittest.TestCase):
+    def setUp(self):
+        User.objects.filter(username__startswith = 'afmaeli').delete()
+        self.ProfileModel = controller.get_profile_model()
+        self.users = {}
+        for name, kennitala in [('gamlar', '3112902919'), ('nyar', '0201902919'),
+                                ('hlaup', '2902922919'), ('mars', '0103902919'), ('sumar', '1506902919')]:
+            user = User.objects.create_user('afmaeli%s' % name, '', 'lykilord')
+            profile = user.get_profile()
+            profile.kennitala = kennitala
+            profile.save()
+            self.users[name] = user
+
+    def tearDown(self):
+        for user in self.users.values():
+            user.delete()
+
+    def between(self, start, end):
+        profiles = self.ProfileModel.objects.birthdays_between(start, end).filter(user__in = self.users.values())
+        return [profile.user.username[len('afmaeli'):] for profile in profiles]
+
+    def test_across_new_year(self):
+        self.assertEqual(self.between(date(2010, 12, 28), date(2011, 1, 3)), ['gamlar', 'nyar'])
+
+    def test_leap_day(self):
+        self.assertEqual(self.between(date(2011, 2, 28), date(2011, 2, 28)), ['hlaup'])
+        self.assertEqual(self.between(date(2012, 2, 29), date(2012, 3, 1)), ['hlaup', 'mars'])
+        self.assertEqual(self.between(date(2011, 3, 1), date(2011, 3, 5)), ['mars'])
+
+    def test_changed_kennitala(self):
+        profile = self.users['sumar'].get_profile()
+        self.assertEqual(profile.get_bdate(), date(1990, 6, 15))
+        profile.kennitala = '1506002919'
+        self.assertEqual(profile.get_bdate(), date(1900, 6, 15))
+        self.assertEqual(profile.get_age(date(2010, 6, 15))[0], 110)
+
+
+class ProfilePageTestCase(unittest.TestCase):
+    def setUp(self):
+        User.objects.filter(username = 'sidan').delete()
+        self.user = User.objects.create_user('sidan', '', 'lykilord')
+        self.url = reverse('user', kwargs = {'username': 'sidan'})
+
+    def tearDown(self):
+        self.user.delete()
+
+    def get_etag(self):
+        response = Client().get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_not_modified(self):
+        etag = self.get_etag()
+        response = Client().get(self.url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_user_invalidates(self):
+        etag = self.get_etag()
+        self.user.first_name = u'Jón'
+        self.user.save()
+        self.assertNotEqual(self.get_etag(), etag)
+
+    def test_changed_profile_invalidates(self):
+        etag = self.get_etag()
+        profile = self.user.get_profile()
+        profile.phone = '5551234'
+        profile.save()
+        self.assertNotEqual(self.get_etag(), etag)
+
+    def test_login_leaves_page(self):
+        from user_profile.page_cache import get_profile_version
+        etag = self.get_etag()
+        version = get_profile_version('sidan')
+        user = User.objects.get(id = self.user.id)
+        user.last_login = datetime.now()
+        user.save()
+        self.assertEqual(get_profile_version('sidan'), version)
+        self.assertEqual(self.get_etag(), etag)
+
+    def test_blocks_not_cached(self):
+        from django.template import Template, Context
+        from user_profile.page_cache import get_profile_version
+        template = Template(u'{% extends "user_profile/profile_base.html" %}'
+                            u'{% block profile_after_name %}[{{ viewer }}]{% endblock %}'
+                            u'{% block profile_after_address %}<{{ viewer }}>{% endblock %}')
+        context = {'profile': self.user.get_profile(), 'extends_from': 'base.html', 'username': 'sidan',
+                    'profile_version': get_profile_version('sidan'), 'profile_language': 'is',
+                    'profile_date': date.today(), 'profile_cache_timeout': 60 }
+        for viewer in (u'anna', u'bjorn'):
+            context['viewer'] = viewer
+            html = template.render(Context(context))
+            self.assertTrue(u'[%s]' % viewer in html and u'<%s>' % viewer in html)
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        from django.db import transaction
+        User.objects.filter(username = 'leitandi').delete()
+        self.user = User.objects.create_user('leitandi', 'leitandi@example.com', 'lykilord')
+        transaction.rollback_unless_managed()
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_terms_committed(self):
+        from user_profile.models import ProfileSearchTerm
+        self.assertEqual(list(ProfileSearchTerm.objects.search(u'leitandi')), [self.user.id])
+
+    def test_admin_search(self):
+        from django.contrib.admin.sites import AdminSite
+        from user_profile.admin import UserWithProfileAdmin, ProfileChangeList
+        from user_profile.models import ProfileSearchTerm
+        profile = self.user.get_profile()
+        profile.postalcode = '600'
+        profile.save()
+        model_admin = UserWithProfileAdmin(User, AdminSite())
+        def found(query):
+            request = Mock(GET = {'q': query}, user = self.user)
+            changelist = ProfileChangeList(request, User, model_admin.list_display, model_admin.list_display_links,
+                                            model_admin.list_filter, model_admin.date_hierarchy,
+                                            model_admin.search_fields, model_admin.list_select_related,
+                                            model_admin.list_per_page, model_admin.list_editable, model_admin)
+            return self.user in changelist.query_set
+        self.assertTrue(found(u'akureyri'))
+        ProfileSearchTerm.objects.filter(user = self.user).delete()
+        self.assertTrue(found(u'eitand'))
+        self.assertTrue(found(u'@example.com'))
+        self.assertFalse(found(u'akureyri'))
+        self.assertEqual(list(ProfileSearchTerm.objects.search(u'-')), [])
+        self.assertFalse(found(u'-'))
+
+    def test_reindexed_only_on_change(self):
+        from user_profile.models import ProfileSearchTerm
+        index = Mock()
+        patcher = patch.object(ProfileSearchTerm.objects, 'index', index)
+        patcher.start()
+        try:
+            user = User.objects.get(id = self.user.id)
+            user.last_login = datetime.now()
+            user.save()
+            profile = user.get_profile()
+            profile.save()
+            self.assertFalse(index.called)
+            user.first_name = u'Guðrún'
+            user.save()
+            profile.phone = '5551234'
+            profile.save()
+        finally:
+            patcher.stop()
+        self.assertEqual(index.call_count, 2)
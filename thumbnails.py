@@ -0,0 +1,516 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""
+Building the sizes of display images
+
+PIL is imported by the functions that need it, so importing this module, and
+user_profile.models with it, does not load PIL and its plugins.
+"""
+
+import os
+import zlib
+import fcntl
+import logging
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+
+from user_profile.instrumentation import instrumented
+
+PENDING = 'pending'
+READY = 'ready'
+FAILED = 'failed'
+
+STATE_CHOICES = ( ( PENDING, u'Í vinnslu'),
+                    ( READY, u'Tilbúin'),
+                    ( FAILED, u'Mistókst'))
+
+#Formats the sizes can be saved in besides the format of the original, name: (PIL format, extension, mimetype)
+VARIANT_FORMATS = {'webp': ('WEBP', '.webp', 'image/webp'),
+                    'jpeg': ('JPEG', '.jpg', 'image/jpeg') }
+
+DEFAULT_QUALITY = {'webp': 80, 'jpeg': 85}
+
+logger = logging.getLogger('user_profile.thumbnails')
+
+#Number of locks VariantCache shares between all the sizes it builds
+LOCK_STRIPES = 64
+
+class ImageHeader(object):
+    """
+    Data invariant:
+        format is the PIL name of the image format, e.g. 'JPEG'
+        width and height are the dimensions of the image in pixels
+    """
+    def __init__(self, format, width, height):
+        self.format = format
+        self.width = width
+        self.height = height
+
+    def get_pixels(self):
+        return self.width * self.height
+
+
+def read_image_header(file):
+    """
+    Usage:  header = read_image_header(file)
+    Before: file is a path or a seekable file object
+    After:  header is the ImageHeader of the image in file, read without decoding the
+            pixels, and file has been rewound if it is a file object
+            Raises IOError if file is not an image PIL recognizes
+    """
+    from PIL import Image
+    try:
+        image = Image.open(file)
+        return ImageHeader(image.format, image.size[0], image.size[1])
+    finally:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+def is_decompression_bomb(error):
+    """
+    Usage:  bomb = is_decompression_bomb(error)
+    After:  bomb is True if error is the DecompressionBombError Pillow raises when opening images
+            with so many pixels that decoding them could use up the memory
+            Older versions of PIL do not have it and only warn
+    """
+    from PIL import Image
+    bomb_error = getattr(Image, 'DecompressionBombError', None)
+    return bomb_error is not None and isinstance(error, bomb_error)
+
+def supported_formats(names):
+    """
+    Usage:  names = supported_formats(names)
+    Before: names are keys of VARIANT_FORMATS
+    After:  names are the ones among them that PIL can save
+    """
+    from PIL import Image
+    Image.init()
+    return [name for name in names if VARIANT_FORMATS[name][0] in Image.SAVE]
+
+def get_variant_filename(filename, name):
+    """
+    Usage:  variant_filename = get_variant_filename(filename, name)
+    After:  variant_filename is filename with the extension of the format name
+    """
+    return os.path.splitext(filename)[0] + VARIANT_FORMATS[name][1]
+
+def save_variant(image, path, quality = None):
+    """
+    Usage:  save_variant(image, path, [quality = None])
+    Before: quality maps format names to the quality to save them with, defaults to DEFAULT_QUALITY
+    After:  image has been saved to path in the format its extension names,
+            JPEGs as optimized progressive JPEGs on a white background
+    """
+    if quality is None:
+        quality = DEFAULT_QUALITY
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jpg', '.jpeg'):
+        if image.mode != 'RGB':
+            from PIL import Image
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask = image.split()[3])
+            image = background
+        image.save(path, 'JPEG', quality = quality.get('jpeg', DEFAULT_QUALITY['jpeg']),
+                    optimize = True, progressive = True)
+    elif extension == '.webp':
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image.save(path, 'WEBP', quality = quality.get('webp', DEFAULT_QUALITY['webp']), method = 6)
+    elif extension == '.png':
+        image.save(path, 'PNG', optimize = True)
+    else:
+        image.save(path)
+
+def ensure_directory(directory):
+    """
+    Usage:  ensure_directory(directory)
+    After:  directory exists and everyone can read, write and execute in it
+    """
+    if not os.path.exists(directory):
+        os.mkdir(directory, 0777)
+        os.chmod(directory, 0777) #0777 means that everyone can read, write and execute
+
+def area(size):
+    width, height = size
+    return width * height
+
+def fit_size(size, box):
+    """
+    Usage:  fitted = fit_size(size, box)
+    After:  fitted is the largest size with the ratio of size that fits within box and
+            is not larger than size, rounded as Image.thumbnail rounds it
+    """
+    width, height = size
+    if width > box[0]:
+        height = int(max(height * box[0] / float(width), 1))
+        width = int(box[0])
+    if height > box[1]:
+        width = int(max(width * box[1] / float(height), 1))
+        height = int(box[1])
+    return width, height
+
+def resize_to_sizes(source, sizes):
+    """
+    Usage:  images = resize_to_sizes(source, sizes)
+    Before: source is a filename or a file object containing an image
+            sizes is a dictionary mapping size names to (width, height) tuples
+    After:  images is a list of (size_name, image) pairs, largest size first, where
+            each image is a version of source that fits within that size
+
+    The source is decoded only once. JPEG images are decoded in draft mode, i.e. straight
+    at the smallest scale that is still larger than the largest size, and every size is
+    then resampled from the one before it instead of from the full resolution image.
+    The sizes are computed from the dimensions of the source, not of the drafted or
+    resampled images, so they are the same as if every size was made from the source.
+    """
+    from PIL import Image
+    image = Image.open(source)
+    ordered = sorted(sizes.items(), key = lambda item: area(item[1]), reverse = True)
+    if not ordered:
+        return []
+    fitted = [(size_name, fit_size(image.size, size)) for size_name, size in ordered]
+
+    if image.format == 'JPEG':
+        image.draft(image.mode, fitted[0][1])
+    image.load()
+
+    images = []
+    for size_name, size in fitted:
+        if image.size != size:
+            image = image.resize(size, Image.ANTIALIAS)
+        images.append((size_name, image))
+    return images
+
+def make_thumbnails(source_path, targets, quality = None):
+    """
+    Usage:  results = make_thumbnails(source_path, targets, [quality = None])
+    Before: source_path is the path to an image
+            targets is a list of (size_name, size, target_path) tuples, a size may be
+            the size of several targets saved in different formats
+    After:  For every target a version of the image at source_path that fits within size
+            has been saved to target_path by save_variant with quality
+            results is a list of (size_name, error) pairs, one for each target, where error
+            is None if saving that target succeeded, else a string describing what went wrong
+
+    This function is run by the executors, possibly in another process, and must therefore
+    not touch the database and must not raise. The pools call no callback for a job that
+    raises, so the image would stay pending forever.
+    """
+    paths = {}
+    sizes = {}
+    for size_name, size, target_path in targets:
+        sizes[size_name] = size
+        paths.setdefault(size_name, []).append(target_path)
+
+    try:
+        images = resize_to_sizes(source_path, sizes)
+    except Exception, error:
+        return [(size_name, unicode(error)) for size_name, size, target_path in targets]
+
+    results = []
+    for size_name, image in images:
+        for path in paths[size_name]:
+            try:
+                ensure_directory(os.path.dirname(path))
+                save_variant(image, path, quality)
+            except Exception, error:
+                results.append((size_name, unicode(error)))
+            else:
+                results.append((size_name, None))
+    return results
+make_thumbnails = instrumented('display_image.thumbnails')(make_thumbnails)
+
+def make_thumbnails_for_image(job):
+    """
+    Usage:  (image_id, results) = make_thumbnails_for_image((image_id, source_path, targets, quality))
+    After:  results = make_thumbnails(source_path, targets, quality)
+            Takes a single argument so it can be used with Pool.imap_unordered
+    """
+    image_id, source_path, targets, quality = job
+    return image_id, make_thumbnails(source_path, targets, quality)
+
+def stale_targets(source_path, targets):
+    """
+    Usage:  stale = stale_targets(source_path, targets)
+    Before: targets is a list of (size_name, size, target_path) tuples
+    After:  stale are the targets that do not exist or are older than source_path
+    """
+    source_mtime = os.path.getmtime(source_path)
+    stale = []
+    for target in targets:
+        size_name, size, target_path = target
+        try:
+            if os.path.getmtime(target_path) >= source_mtime:
+                continue
+        except OSError:
+            pass
+        stale.append(target)
+    return stale
+
+
+class SynchronousExecutor(object):
+    """
+    Runs every job immediately in the calling thread. Used by the tests.
+    """
+    def submit(self, function, args, callback):
+        callback(function(*args))
+
+
+def guard_callback(callback):
+    """
+    Usage:  guarded = guard_callback(callback)
+    After:  guarded(result) calls callback(result) and logs what it raises instead of raising it,
+            then closes the database connection of the calling thread
+
+    The pools run every callback in a single result handler thread, which dies if a callback
+    raises, and no callbacks are run after that. Its connection would otherwise live as long
+    as the process, and be useless after the database drops it.
+    """
+    def guarded(result):
+        try:
+            try:
+                callback(result)
+            except Exception:
+                logger.exception("A callback of a background job failed")
+        finally:
+            connection.close()
+    return guarded
+
+
+class ThreadExecutor(object):
+    """
+    Runs jobs in a pool of worker threads. The pool is created on first use.
+    Callbacks are run by guard_callback, so one that fails does not stop the others.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        self.lock.acquire()
+        try:
+            if self.pool is None:
+                self.pool = self.create_pool()
+            return self.pool
+        finally:
+            self.lock.release()
+
+    def create_pool(self):
+        return ThreadPool(self.workers)
+
+    def submit(self, function, args, callback):
+        self.get_pool().apply_async(function, args, callback = guard_callback(callback))
+
+
+class ProcessExecutor(ThreadExecutor):
+    """
+    Runs jobs in a pool of worker processes. Callbacks are run in the parent process.
+    """
+    def create_pool(self):
+        return Pool(self.workers)
+
+
+EXECUTORS = {'sync': SynchronousExecutor,
+                'thread': ThreadExecutor,
+                'process': ProcessExecutor }
+
+def create_executor(name, workers):
+    """
+    Usage:  executor = create_executor(name, workers)
+    Before: name is one of 'sync', 'thread' or 'process'
+    After:  executor is a new executor of that kind with workers workers
+    """
+    try:
+        executor_class = EXECUTORS[name]
+    except KeyError:
+        raise ValueError("Unknown thumbnail executor '%s'" % name)
+    if executor_class is SynchronousExecutor:
+        return executor_class()
+    return executor_class(workers)
+
+
+class ThumbnailJob(object):
+    """
+    Keeps track of the sizes of one image that are being built
+
+    Data invariant:
+        image_id is the id of the DisplayImage being processed
+        errors maps the names of sizes that failed to a description of the failure
+        on_finish is called with (image_id, state) once the sizes have been built
+    """
+    def __init__(self, image_id, on_finish):
+        self.image_id = image_id
+        self.errors = {}
+        self.on_finish = on_finish
+
+    def done(self, results):
+        for size_name, error in results:
+            if error is not None:
+                self.errors[size_name] = error
+
+        if self.errors:
+            self.on_finish(self.image_id, FAILED)
+        else:
+            self.on_finish(self.image_id, READY)
+
+
+def schedule_thumbnails(executor, image_id, source_path, targets, on_finish, quality = None):
+    """
+    Usage:  job = schedule_thumbnails(executor, image_id, source_path, targets, on_finish, [quality = None])
+    Before: targets is a list of (size_name, size, target_path) tuples
+    After:  A job building every target from a single decode of source_path has been
+            handed to executor
+            on_finish(image_id, state) will be called when it has finished
+    """
+    job = ThumbnailJob(image_id, on_finish)
+    executor.submit(make_thumbnails, (source_path, targets, quality), job.done)
+    return job
+
+
+class VariantCache(object):
+    """
+    Builds sizes of display images the first time they are requested
+
+    Data invariant:
+        utils is the DisplayImageUtils deciding where the sizes are stored
+        sizes maps size names to (width, height) tuples
+        max_bytes is the most the stored sizes may take up in total, or None for no limit
+        quality is passed on to save_variant
+        entries maps the paths of stored sizes to their size in bytes, least recently used first
+            It is None until the size directories have been scanned
+        locks are LOCK_STRIPES locks, a size is built holding the one get_stripe picks for its path
+            and the byte with the same index in the .lock file of its directory, so the locks
+            do not grow with the number of sizes
+        lock_files maps directories to their open .lock file
+    """
+    def __init__(self, utils, sizes, max_bytes = None, quality = None):
+        self.utils = utils
+        self.sizes = sizes
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.entries = None
+        self.total_bytes = 0
+        self.locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+        self.lock_files = {}
+        self.lock = threading.Lock()
+
+    def get_stripe(self, path):
+        #crc32 rather than hash, so every process picks the same stripe
+        if isinstance(path, unicode):
+            path = path.encode("utf8")
+        return (zlib.crc32(path) & 0xffffffff) % LOCK_STRIPES
+
+    def get_lock_file(self, directory):
+        #The file stays open, closing it would release the locks other threads hold on it
+        self.lock.acquire()
+        try:
+            if directory not in self.lock_files:
+                self.lock_files[directory] = open(os.path.join(directory, ".lock"), "a")
+            return self.lock_files[directory]
+        finally:
+            self.lock.release()
+
+    def get(self, size_name, filename, source_path):
+        """
+        Usage:  path = cache.get(size_name, filename, source_path)
+        Before: size_name is a key of sizes, source_path is the path to the original image
+        After:  path is the path to the size_name version of filename, which has been built
+                from source_path if it did not exist.
+                Concurrent requests for the same file, in this process or others, build it once.
+        """
+        path = self.utils.get_path_to_image(size_name, filename)
+        if os.path.exists(path):
+            self.touch(path)
+            return path
+
+        directory = os.path.dirname(path)
+        ensure_directory(directory)
+        stripe = self.get_stripe(path)
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            lock_file = self.get_lock_file(directory)
+            fcntl.lockf(lock_file, fcntl.LOCK_EX, 1, stripe)
+            try:
+                if not os.path.exists(path):
+                    for built_size_name, image in resize_to_sizes(source_path, {size_name: self.sizes[size_name]}):
+                        save_variant(image, path, self.quality)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN, 1, stripe)
+        finally:
+            lock.release()
+
+        self.add(path)
+        return path
+
+    def scan(self):
+        """
+        Usage:  cache.scan()
+        After:  entries contains every stored size, oldest access first
+        """
+        found = []
+        for size_name in self.sizes:
+            directory = os.path.join(self.utils.media_root, self.utils.get_directory(size_name))
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                found.append((stat.st_atime, path, stat.st_size))
+        found.sort()
+
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        for atime, path, size in found:
+            self.entries[path] = size
+            self.total_bytes += size
+
+    def touch(self, path):
+        if self.max_bytes is None:
+            return
+        self.lock.acquire()
+        try:
+            if self.entries is not None and path in self.entries:
+                self.entries[path] = self.entries.pop(path)
+        finally:
+            self.lock.release()
+
+    def add(self, path):
+        """
+        Usage:  cache.add(path)
+        After:  path is the most recently used entry and the least recently used entries
+                have been removed until the stored sizes take up at most max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        self.lock.acquire()
+        try:
+            if self.entries is None:
+                self.scan()
+            if path in self.entries:
+                self.total_bytes -= self.entries.pop(path)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            self.entries[path] = size
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest, size = self.entries.popitem(last = False)
+                self.total_bytes -= size
+                try:
+                    os.remove(oldest)
+                except OSError:
+                    pass
+        finally:
+            self.lock.release()
@@ -3,7 +3,7 @@
 
 from django.conf.urls.defaults import *
 
-from user_profile.views import show_profile
+from user_profile.views import show_profile, show_display_image, export_profiles, search_profiles
 
 urlpatterns = patterns('',
     url(r'^innskraning/$', 'django.contrib.auth.views.login',
@@ -13,6 +13,9 @@ urlpatterns = patterns('',
             kwargs = {'template_name': 'user_profile/change_password.html' }, name='change_password'),
     url(r'^lykilordinu-var-breytt/$', 'django.contrib.auth.views.password_change_done',
             kwargs = {'template_name': 'user_profile/change_password_success.html' }, name='change_password_success'),
+    url(r'^myndir/(?P<size>\w+)/(?P<filename>[^/]+)$', show_display_image, name = 'display_image'),
+    url(r'^leit/$', search_profiles, name = 'search_profiles'),
+    url(r'^utflutningur/(?P<format>\w+)/$', export_profiles, name = 'export_profiles'),
     url(r'^(?P<username>[\w-]+)/$', show_profile, name = 'user'),
 )
 
@@ -2,18 +2,18 @@
 # -*- coding: utf8 -*-
 import os
 
-from django.core.mail import send_mail
 from django.contrib.auth.models import User
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
-from emailer.forms import EmailWrappedObjectForm, ObjectToSendWrapper
+from user_profile.instrumentation import instrumented
 
 class DisplayImageLocation(object):
-    def __init__(self, url, path):
+    def __init__(self, url, path, formats = None):
         self.url = url
         self.path = path
+        self.formats = formats or {}
 
 class DisplayImageLocationFactory(object):
     def __init__(self, filename, size, utils):
@@ -53,45 +53,72 @@ class DisplayImageUtils(object):
         """
         return os.path.join(self.media_url, self.get_directory(size), filename)
 
-class ResetPasswordWrapper(ObjectToSendWrapper):
+    def get_path_to_original(self, name):
+        """
+        Returns a path on the filesystem to the original image, name is relative to the media root
+        """
+        return os.path.join(self.media_root, name)
+
+    def get_url_to_original(self, name):
+        """
+        Returns a url to the original image, name is relative to the media root
+        """
+        return os.path.join(self.media_url, name)
+
+class LazyResetPasswordWrapperType(type):
+    """
+    Makes ResetPasswordWrapper stand for user_profile.emails.ResetPasswordWrapper, which
+    is imported, with emailer, the first time the class is used rather than with utils.
+    Calling it creates a wrapper of the real class, instances of the real class are its
+    instances, and classes derived from it are derived from the real class.
+    """
+    def get_class(cls):
+        from user_profile.emails import ResetPasswordWrapper
+        return ResetPasswordWrapper
 
-    def get_email_subject(self):
-        return u"Nýtt lykilorð - New password"
+    def __new__(metaclass, name, bases, attributes):
+        if bases == (object, ):
+            return type.__new__(metaclass, name, bases, attributes)
+        bases = tuple([isinstance(base, LazyResetPasswordWrapperType) and base.get_class() or base
+                        for base in bases])
+        return type(bases[0])(name, bases, attributes)
 
-    def get_email_template(self):
-        return u"user_profile/emails/reset_password.txt"
+    def __call__(cls, *args, **kwargs):
+        return cls.get_class()(*args, **kwargs)
 
-    def get_email_context(self):
-        return {'user': self.instance, 'new_password': self.new_password }
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, cls.get_class())
 
-    def get_email_recipients(self):
-        return [self.instance.email,]
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, cls.get_class())
 
-    def process_pre_email(self):
-        self.new_password = User.objects.make_random_password()
-        self.instance.set_password(self.new_password)
-        self.instance.save()
+class ResetPasswordWrapper(object):
+    """
+    The wrapper now lives in user_profile.emails. This name is kept for imports from
+    utils and for emails naming user_profile.utils as their wrapped module
+    """
+    __metaclass__ = LazyResetPasswordWrapperType
 
 def reset_password_link(user):
+    #emailer is imported here so that importing utils, and models with it, does not load it
+    from emailer.forms import EmailWrappedObjectForm
+
     form = EmailWrappedObjectForm(initial = {'appname': 'auth',
                                                 'modelname': 'User',
                                                 'instance_id': user.id,
-                                                'wrapped_appname': 'user_profile.utils',
+                                                'wrapped_appname': 'user_profile.emails',
                                                 'wrapped_classname': 'ResetPasswordWrapper'})
     return form.render(u'Frumstilla lykilorð',u'Frumstilla lykilorð')
 reset_password_link.short_description = _(u"Frumstilla lykilorð")
 reset_password_link.allow_tags = True
 
-def reset_password(user):
+def password_reset_message(user, password):
     """
-    Usage:  reset_password(user)
-    After:  A new random password has been generated for user and is now his new password
-            If user has an email the new password has been sent to him
-            else the new password has been sent to the administrators
+    Usage:  (subject, message, recipients) = password_reset_message(user, password)
+    After:  message tells user that password is the new password
+            recipients is the email address of user if he has one, else the
+            email addresses of the administrators
     """
-    password = User.objects.make_random_password()
-    user.set_password(password)
-
     if user.first_name != '':
         first_name = user.first_name
     else:
@@ -102,15 +129,25 @@ def reset_password(user):
 
     subject = u"Nýtt lykilorð - New password"
     if user.email is not None and user.email != '':
-        try:
-            user.email_user(subject = subject,
-                        message = message)
-        except:
-            #TODO: Logga eða láta einhvern vita
-            pass
+        recipients = [user.email]
     else:
-        for name, email in settings.ADMINS:
-            send_mail(subject = subject,
-                    message = message,
-                    from_email = settings.DEFAULT_FROM_EMAIL)
+        recipients = [email for name, email in settings.ADMINS]
+    return subject, message, recipients
+
+def reset_password(user):
+    """
+    Usage:  reset_password(user)
+    After:  A new random password has been generated for user and is now his new password,
+            user has been saved
+            If user has an email the new password has been queued to be sent to him
+            else the new password has been queued to be sent to the administrators
+    """
+    from user_profile.models import QueuedEmail
+
+    password = User.objects.make_random_password()
+    user.set_password(password)
+    user.save()
 
+    subject, message, recipients = password_reset_message(user, password)
+    QueuedEmail.objects.enqueue(subject, message, recipients)
+reset_password = instrumented('reset_password')(reset_password)
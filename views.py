@@ -1,16 +1,109 @@
 #! /usr/bin/env python
 # -*- coding: utf8 -*-
 
+import os
+import time
+
+from datetime import datetime, date
+
+from django.http import Http404, HttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import get_object_or_404, render_to_response
+from django.views.static import serve
+from django.views.decorators.http import condition
 from django.template import RequestContext
 from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import get_language
+from django.utils import simplejson
 
 from user_profile.settings import controller
+from user_profile.export import FORMATS, export_profiles as export
+from user_profile.page_cache import PROFILE_CACHE_TIMEOUT, get_profile_version, get_profile_etag
+from user_profile.instrumentation import instrumented
+from user_profile.models import DISPLAY_IMAGE_SIZE, VARIANT_CACHE, ProfileSearchTerm, get_original_path
+
+def profile_etag(request, username):
+    version = get_profile_version(username)
+    if version is None:
+        return None
+    return get_profile_etag(request, username, version, get_language(), date.today())
+
+def profile_last_modified(request, username):
+    version = get_profile_version(username)
+    if version is None:
+        return None
+    #The page shows the age of the user, so it changes every day
+    return max(datetime.utcfromtimestamp(version / 1000000.0), datetime.utcfromtimestamp(time.mktime(date.today().timetuple())))
 
 def show_profile(request, username):
-    user = get_object_or_404(controller.get_profile_model(), user__username = username)
+    """
+    Shows the profile of the user username
+
+    The profile is only loaded from the database if a fragment of profile_base.html
+    is not in the cache, and browsers that already have the page get a 304 response
+    """
+    version = get_profile_version(username)
+    if version is None:
+        raise Http404
+    user = SimpleLazyObject(lambda: get_object_or_404(controller.get_profile_model(), user__username = username))
 
     profile_base = getattr(settings, 'PROFILE_BASE', 'user_profile/user_profile_base.html')
     extends_from = getattr(settings, 'EXTENDS_FROM', 'base.html')
-    context = {'profile': user, 'extends_from': extends_from }
-    return render_to_response(profile_base, context, context_instance = RequestContext(request))
\ No newline at end of file
+    context = {'profile': user, 'extends_from': extends_from,
+                'username': username, 'profile_version': version,
+                'profile_language': get_language(), 'profile_date': date.today(),
+                'profile_cache_timeout': PROFILE_CACHE_TIMEOUT }
+    response = render_to_response(profile_base, context, context_instance = RequestContext(request))
+    patch_vary_headers(response, ('Cookie', 'Accept-Language'))
+    return response
+show_profile = condition(etag_func = profile_etag, last_modified_func = profile_last_modified)(show_profile)
+show_profile = instrumented('show_profile')(show_profile)
+
+def show_display_image(request, size, filename):
+    """
+    Serves the size version of the display image filename, building it first if it
+    does not exist yet
+    """
+    if size not in DISPLAY_IMAGE_SIZE or filename != os.path.basename(filename):
+        raise Http404
+    source_path = get_original_path(filename)
+    if not os.path.exists(source_path):
+        raise Http404
+
+    try:
+        path = VARIANT_CACHE.get(size, filename, source_path)
+    except IOError:
+        raise Http404
+    head, filename = os.path.split(path)
+    return serve(request, filename, document_root = head)
+
+def export_profiles(request, format):
+    """
+    Streams every profile as a file in format, one of the keys of FORMATS
+    """
+    if format not in FORMATS:
+        raise Http404
+    lines, mimetype = FORMATS[format]
+    response = HttpResponse(export(format), mimetype = mimetype)
+    response['Content-Disposition'] = 'attachment; filename=simaskra.%s' % format
+    return response
+export_profiles = staff_member_required(export_profiles)
+
+def search_profiles(request):
+    """
+    Returns a JSON list of the profiles matching the query q by name, username or city
+    """
+    query = request.GET.get('q', '')
+    limit = getattr(settings, 'PROFILE_SEARCH_LIMIT', 20)
+    user_ids = list(ProfileSearchTerm.objects.search(query, public_only = True)[:limit])
+    profiles = controller.get_profile_model().objects.filter(user__in = user_ids).select_related('user')
+
+    results = []
+    for profile in profiles:
+        results.append({'username': profile.user.username,
+                        'fullname': profile.get_fullname(),
+                        'city': profile.city,
+                        'url': profile.get_absolute_url() })
+    return HttpResponse(simplejson.dumps(results), mimetype = 'application/json')